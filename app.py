@@ -3,18 +3,34 @@ import pandas as pd
 import dash
 import string    
 import random
-from dash import dcc, html, Input, Output, State
+from dash import dcc, html, Input, Output, State, MATCH, ALL, no_update
 import dash_bootstrap_components as dbc
 from jupyter_dash import JupyterDash
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 from datetime import datetime, timedelta
-import base64
-from read_apple_watch_data import AppleWatchData
+from read_apple_watch_data import AppleWatchData, hourly_rollup_range, time_range, read_profile, SLEEP_STAGE_COLUMNS
+from job_scheduler import JobScheduler, QueueFull
+from dataframe_cache import DataFrameCache
+from figure_cache import FigureCache
+from cache_apple_watch_data import atomic_path, hash_file, remember_hash
+from stage_timing import timings
+from plot_apple_watch_data import min_max_downsample, daily_traces
 from save_apple_watch_data import *
-from flask import session, send_file  
+import re
+import shutil
+import threading
+import time
+import zlib
+import json
+import hashlib
+import zipfile
+import mimetypes
+from flask import session, send_file, request, jsonify, abort, Response, stream_with_context, g
+from werkzeug.utils import secure_filename
 from dash.exceptions import PreventUpdate
+from plotly.io.json import to_json_plotly
 
 # Initialize the Dash app
 app = JupyterDash(__name__, external_stylesheets=[
@@ -31,8 +47,83 @@ current_datetime = datetime.now()
 # Set default end date and time (1 day ahead)
 default_end_date = (current_datetime + timedelta(days=1)).date()
 
-# Initialize processing variable
-processing = False
+# Parsed exports are cached here, one directory per upload content hash
+CACHE_DIR = './cache'
+# Loaded DataFrames are kept in memory up to this many bytes, shared by all sessions
+FRAME_CACHE_BYTES = 512 * 1024 * 1024
+frame_cache = DataFrameCache(max_bytes=FRAME_CACHE_BYTES)
+# Built graph panels are kept as JSON, in memory and on disk shared by worker processes,
+# so flipping back to a date range already viewed skips pandas and Plotly
+FIGURE_CACHE_BYTES = 64 * 1024 * 1024
+FIGURE_CACHE_DISK_BYTES = 1024 * 1024 * 1024
+# bump whenever the panels change how their figures look, so stale cached figures are never served
+FIGURE_VERSION = 2
+figure_cache = FigureCache(max_bytes=FIGURE_CACHE_BYTES, cache_dir=os.path.join(CACHE_DIR, 'figures'),
+                           max_disk_bytes=FIGURE_CACHE_DISK_BYTES)
+# The heart rate chart is downsampled to this many points unless full resolution is asked for,
+# and switches to WebGL traces above WEBGL_MIN_POINTS
+HEART_RATE_MAX_POINTS = 20000
+WEBGL_MIN_POINTS = 5000
+# Worker processes used to parse large exports
+INGEST_WORKERS = os.cpu_count() or 1
+
+# Partial chunked uploads are kept here until their last chunk arrives
+UPLOAD_DIR = './uploads'
+# finished uploads are kept in a directory of their own, an export.zip extracted to its export.xml
+# and workout-routes/ folder, so each upload's workout routes sit next to its export
+EXPORT_XML = 'export.xml'
+ROUTE_DIR = 'workout-routes'
+ROUTE_NAME_PATTERN = re.compile(r'[A-Za-z0-9_.-]{1,200}\.gpx')
+UPLOAD_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,200}')
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+UPLOAD_COPY_BYTES = 1024 * 1024
+# partial upload path -> (SHA-256 of its bytes so far, bytes hashed); uploads are hashed as they arrive,
+# so a finished upload is never read again just to hash it
+upload_digests = {}
+upload_digests_lock = threading.Lock()
+
+# Exports are written to one directory per session, so concurrent users never overwrite each other's files
+EXPORT_DIR = './download'
+# exports worth gzipping on the fly; zip, parquet and feather files are compressed already
+GZIP_EXTENSIONS = ('.csv', '.sqlite')
+GZIP_CHUNK_BYTES = 1024 * 1024
+
+# Uploads are ingested and graph panels built here, off the request threads, one active job per key
+scheduler = JobScheduler(max_workers=2, max_queued=8)
+# Graph panels expanded, and so built, as soon as the graphs are generated; the rest wait to be opened
+PANELS_OPEN = 2
+# How often panels waiting for their figures are polled; a poll still running when the next is due is dropped
+PROGRESS_INTERVAL_MS = 500
+
+
+def session_id():
+    if 'session_id' not in session:
+        session['session_id'] = ''.join(random.choices(string.ascii_uppercase + string.digits, k=16))
+    return session['session_id']
+
+
+def session_export_dir():
+    path = os.path.join(EXPORT_DIR, session_id())
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def open_upload(xml_data_file_path, content_hash=None):
+    """
+    Open an upload through its incremental Parquet cache; every callback and route opens uploads here,
+    so an export is ingested once however many requests open it at the same time
+
+    :param content_hash: the upload's hash from session_content_hash, so the file is never hashed again
+    """
+    return AppleWatchData(xml_data_file_path, 'A’s Apple Watch', streaming=True, cache_dir=CACHE_DIR,
+                          content_hash=content_hash, workers=INGEST_WORKERS, frame_cache=frame_cache,
+                          incremental=True)
+
+
+def session_content_hash(xml_data_file_path):
+    # hashed by upload_chunk while the upload was written; sessions from before that hash it once here
+    return session.get('content_hash') or hash_file(os.path.expanduser(xml_data_file_path))
+
 # Define the content of the about section
 about_content = dbc.Card(
     dbc.CardBody(
@@ -65,7 +156,10 @@ download_links = dbc.Card(
         dbc.CardBody(
             className="card-body",
             children=[
-                html.H3("Download CSV Files", className="card-title"),
+                html.H3("Download Data", className="card-title"),
+                # every table in one ZIP per format, streamed by the /export route while it is built;
+                # parquet and feather keep column types, sqlite holds all tables in one indexed database
+                # that the /download route builds on first request
                 dbc.Row([
                     dbc.Col(
                         dbc.Card(
@@ -73,96 +167,16 @@ download_links = dbc.Card(
                             children=[
                                 dbc.CardBody(
                                     children=[
-                                        html.A('Heart Rate', href='/download/heart_rate.csv', target='_blank', className='download-link'),
-                                    ]
-                                )
-                            ]
-                        )
-                    ),
-                    dbc.Col(
-                        dbc.Card(
-                            className="download-link-card",
-                            children=[
-                                dbc.CardBody(
-                                    children=[
-                                        html.A('Heart Rate Variability', href='/download/heart_rate_variability.csv', target='_blank', className='download-link'),
-                                    ]
-                                )
-                            ]
-                        )
-                    ),
-                    dbc.Col(
-                        dbc.Card(
-                            className="download-link-card",
-                            children=[
-                                dbc.CardBody(
-                                    children=[
-                                        html.A('Resting Heart Rate', href='/download/resting_heart_rate.csv', target='_blank', className='download-link'),
-                                    ]
-                                )
-                            ]
-                        )
-                    ),
-                    dbc.Col(
-                        dbc.Card(
-                            className="download-link-card",
-                            children=[
-                                dbc.CardBody(
-                                    children=[
-                                        html.A('Walking Heart Rate', href='/download/walking_heart_rate.csv', target='_blank', className='download-link'),
-                                    ]
-                                )
-                            ]
-                        )
-                    ),
-                    dbc.Col(
-                        dbc.Card(
-                            className="download-link-card",
-                            children=[
-                                dbc.CardBody(
-                                    children=[
-                                        html.A('Distance Walked', href='/download/distance_walked_ran.csv', target='_blank', className='download-link'),
-                                    ]
-                                )
-                            ]
-                        )
-                    ),
-                    dbc.Col(
-                        dbc.Card(
-                            className="download-link-card",
-                            children=[
-                                dbc.CardBody(
-                                    children=[
-                                        html.A('Basal Energy', href='/download/basal_energy.csv', target='_blank', className='download-link'),
-                                    ]
-                                )
-                            ]
-                        )
-                    ),
-                    dbc.Col(
-                        dbc.Card(
-                            className="download-link-card",
-                            children=[
-                                dbc.CardBody(
-                                    children=[
-                                        html.A('Stand Hours', href='/download/stand_hour.csv', target='_blank', className='download-link'),
-                                    ]
-                                )
-                            ]
-                        )
-                    ),
-                    dbc.Col(
-                        dbc.Card(
-                            className="download-link-card",
-                            children=[
-                                dbc.CardBody(
-                                    children=[
-                                        html.A('Steps Count', href='/download/step_counts.csv', target='_blank', className='download-link'),
+                                        html.A(label, href=href, target='_blank', className='download-link'),
                                     ]
                                 )
                             ]
                         )
                     )
+                    for href, label in [('/export/apple_watch_csv.zip?format=csv', 'CSV Files (ZIP)'),
+                                        ('/export/apple_watch_parquet.zip?format=parquet', 'Parquet Files (ZIP)'),
+                                        ('/export/apple_watch_feather.zip?format=feather', 'Feather Files (ZIP)'),
+                                        (f'/download/{SQLITE_FILENAME}', 'SQLite Database')]
                 ])
             ]
         )
@@ -178,11 +192,12 @@ app.layout = dbc.Container([
     html.Hr(),
     html.Div([
         html.H3("Import File"),
-        dcc.Upload(
+        # assets/chunked_upload.js sends the file picked or dropped here to the /upload route in chunks
+        html.Div(
             id='upload-data',
             children=html.Div([
                 'Drag and Drop or ',
-                html.A('Select XML File')
+                html.A('Select export.zip or export.xml')
             ]),
             style={
                 'width': '100%',
@@ -192,14 +207,14 @@ app.layout = dbc.Container([
                 'borderStyle': 'dashed',
                 'borderRadius': '5px',
                 'textAlign': 'center',
-                'margin': '10px'
-            },
-            multiple=False
+                'margin': '10px',
+                'cursor': 'pointer'
+            }
         ),
         dbc.Progress(id="progress", value=0),
         html.Div([
             html.Button('Upload File', id='upload-button', n_clicks=0, style={'margin-right': '10px'}),
-            html.Button('Download CSV', id='download-csv-button', n_clicks=0, style={'background-color': 'green', 'color': 'white'}),
+            html.Button('Download Data', id='download-csv-button', n_clicks=0, style={'background-color': 'green', 'color': 'white'}),
         ], style={'display': 'flex', 'justify-content': 'space-between'}),
         html.Div(id='output-data-upload'),
     ]),
@@ -209,7 +224,7 @@ app.layout = dbc.Container([
         dbc.Tab(label="About", tab_id="about"),
     ], id="tabs", active_tab="import-file"),
     html.Div(id="tab-content"),
-    dcc.Interval(id='progress-interval', interval=100, n_intervals=0),
+    dcc.Interval(id='progress-interval', interval=PROGRESS_INTERVAL_MS, n_intervals=0, disabled=True),
     html.Div(id='output-Personal-info', style={'display': 'none'}),  # Hidden div to store personal info output
 ])
 
@@ -291,7 +306,14 @@ def render_tab_content(active_tab):
                         value='23:59',
                         style={'margin': '10px'}
                     ),
+                    dcc.Checklist(
+                        id='full-resolution',
+                        options=[{'label': ' Full resolution heart rate', 'value': 'full'}],
+                        value=[],
+                        style={'margin': '10px'}
+                    ),
                     html.Button('Generate Graphs', id='generate-graphs-button', n_clicks=0, style={'margin': '10px'}),
+                    html.Button('Cancel', id='cancel-graphs-button', n_clicks=0, style={'margin': '10px'}),
                     html.Hr()
                 ], md=4),
                 dbc.Col([
@@ -308,46 +330,28 @@ def render_tab_content(active_tab):
                             about_content,
                         ])
 
-# Callback to update the upload text when a file is selected
-@app.callback(
-    Output('upload-data', 'children'),
-    [Input('upload-data', 'filename')]
-)
-def update_upload_text(filename):
-    if filename:
-        return html.Div([f"File {filename} selected. Please click the upload button."])
-    else:
-        return html.Div([
-            'Drag and Drop or ',
-            html.A('Select XML File')
-        ])
-
 # Callback to handle file upload
 @app.callback(
     [Output('output-data-upload', 'children'), Output('progress', 'value'), Output('output-Personal-info', 'children')],
-    [Input('upload-button', 'n_clicks')],
-    [State('upload-data', 'filename'),
-     State('upload-data', 'contents')]
+    [Input('upload-button', 'n_clicks')]
 )
-def update_output(n_clicks, filename, contents):
+def update_output(n_clicks):
     if n_clicks > 0:
-        if filename is None or contents is None:
+        # the /upload route stores the file and its path once the last chunk arrives
+        file_path = session.get('xml_data_file_path')
+        if not file_path:
             raise PreventUpdate
+        filename = session.get('upload_filename', file_path)
 
-        content_type, content_string = contents.split(',')
-        decoded = base64.b64decode(content_string)
-        S = 10  # number of characters in the string.  
-        # call random.choices() string module to find the string in Uppercase + numeric data.  
-        ran = ''.join(random.choices(string.ascii_uppercase + string.digits, k = S))   
-        file_path = f"{ran}_{filename}"
-        with open(file_path, 'wb') as f:
-            f.write(decoded)
-
-        # Save file path in session
-        session['xml_data_file_path'] = file_path
-        apple_watch = AppleWatchData(file_path, 'A’s Apple Watch')
-        data=apple_watch.load_Personal_data()
+        # the profile card only needs the export's first few elements; the full ingest runs in the background
+        with timings.span('upload.profile'):
+            data=read_profile(file_path)
         session['personal_data']=data
+        try:
+            scheduler.submit(f'{session_id()}:ingest', ingest_upload, file_path, session_content_hash(file_path))
+        except QueueFull:
+            # the first graph panel opened ingests the upload instead
+            logger.warning('Too many jobs queued to ingest the upload in the background')
         
         personal_info = html.Div([
             html.Div(className="card card-primary card-outline", children=[
@@ -390,48 +394,51 @@ def update_output(n_clicks, filename, contents):
     else:
         raise PreventUpdate
 
-# Callback to generate graphs based on selected dates
-@app.callback(
-    Output('output-graphs', 'children'),
-    [Input('generate-graphs-button', 'n_clicks')],
-    [State('date-picker-range', 'start_date'),
-     State('date-picker-range', 'end_date'),
-     State('start-time', 'value'),
-     State('end-time', 'value')]
-)
-def generate_graphs(n_clicks, start_date, end_date, start_time, end_time):
-    global processing
+def build_sqlite(job, xml_data_file_path, content_hash, directory):
+    """
+    Write an upload's SQLite database to its session's export directory on a JobScheduler worker
+    """
+    job.update(10, 'Writing the SQLite database')
+    tocsv(open_upload(xml_data_file_path, content_hash), directory, formats=('sqlite',))
 
-    if n_clicks > 0 and not processing:
-        processing = True
 
-        # Get file path from session
-        xml_data_file_path = session.get('xml_data_file_path', '')
+def ingest_upload(job, xml_data_file_path, content_hash):
+    """
+    Parse an upload into the Parquet and frame caches on a JobScheduler worker, so its graph panels open warm
+    """
+    job.update(10, 'Reading the export')
+    open_upload(xml_data_file_path, content_hash)
 
-        if not xml_data_file_path:
-            processing = False
-            return html.Div([
-                dbc.Progress(id="progress", value=0, animated=True),
-                html.Div("No file Uploaded.")
-            ])
 
-        source_name = 'A’s Apple Watch'
+def graph_range(start_date, end_date, start_time, end_time):
+    """
+    :return: naive start and end datetimes picked on the Graphs tab
+    """
+    try:
+        start = datetime.strptime(f"{start_date} {start_time}", '%Y-%m-%d %H:%M')
+        end = datetime.strptime(f"{end_date} {end_time}", '%Y-%m-%d %H:%M')
+    except ValueError:
+        start = datetime.strptime(start_date, '%Y-%m-%d')
+        end = datetime.strptime(end_date, '%Y-%m-%d')
+    return start, end
 
-        try:
-            START_DATE = datetime.strptime(f"{start_date} {start_time}", '%Y-%m-%d %H:%M')
-            END_DATE = datetime.strptime(f"{end_date} {end_time}", '%Y-%m-%d %H:%M')
-        except ValueError:
-            START_DATE = datetime.strptime(start_date, '%Y-%m-%d')
-            END_DATE = datetime.strptime(end_date, '%Y-%m-%d')
 
-        apple_watch = AppleWatchData(xml_data_file_path, source_name)
-        
-        # Initialize list to store figures
-        figures = []
+def panel_cache_key(content_hash, panel, start_date, end_date, start_time, end_time, full_resolution):
+    """
+    :return: figure_cache key of one panel of an upload over the picked range
+    """
+    start, end = graph_range(start_date, end_date, start_time, end_time)
+    return (content_hash, FIGURE_VERSION, panel, start.isoformat(), end.isoformat(), bool(full_resolution))
 
-        # Heart Rate Variability Data
+
+# Heart Rate Variability Data
+def panel_heart_rate_variability(apple_watch, start, end, full_resolution, clock):
+    figures = []
+    try:
         df = apple_watch.load_heart_rate_variability_data()
-        df = df[(df['start_timestamp'] > START_DATE) & (df['start_timestamp'] < END_DATE)]
+        clock.lap('graphs.load', len(df))
+        df = time_range(df, start, end)
+        clock.lap('graphs.filter', len(df))
         if not df.empty:
             df['date'] = df['start_timestamp'].dt.strftime('%Y-%m-%d')
             df['time'] = df['start_timestamp'].dt.strftime('%H:%M:%S')
@@ -451,27 +458,29 @@ def generate_graphs(n_clicks, start_date, end_date, start_time, end_time):
                 html.H3("Apple Watch Heart Rate Variability (SDNN)"),
                 dcc.Graph(figure=fig)
             ]))
-            figures.append(html.Hr())
+            clock.lap('graphs.figure', len(df))
+    except (IndexError, ValueError):
+        logger.warning('Missing heart rate variability data!')
+
+    return figures
 
-        # Heart Rate Data
+
+# Heart Rate Data
+def panel_heart_rate(apple_watch, start, end, full_resolution, clock):
+    figures = []
+    try:
         df = apple_watch.load_heart_rate_data()
-        df = df[(df['start_timestamp'] > START_DATE) & (df['start_timestamp'] < END_DATE)]
+        clock.lap('graphs.load', len(df))
+        df = time_range(df, start, end)
+        clock.lap('graphs.filter', len(df))
         if not df.empty:
-            df['date'] = df['start_timestamp'].dt.strftime('%m/%d/%y')
-            df['time'] = df['start_timestamp'].dt.time
+            # keep the shape of long ranges within a point budget the browser can draw
+            if not full_resolution:
+                df = df.iloc[min_max_downsample(df['heart_rate'], HEART_RATE_MAX_POINTS)]
+                clock.lap('graphs.downsample', len(df))
             fig2 = make_subplots(rows=1, cols=1)
-            color_palette = px.colors.qualitative.T10
-            dates = df['date'].unique()
-            for idx, dt in enumerate(dates):
-                sub_df = df[df['date'] == dt]
-                fig2.add_trace(go.Scatter(
-                    x=sub_df['time'],
-                    y=sub_df['heart_rate'],
-                    mode='markers',
-                    marker=dict(color=color_palette[idx % len(color_palette)]),
-                    name=dt,
-                    text=[f"Date: {d}, Time: {t}, BPM: {bpm}" for d, t, bpm in zip(sub_df['date'], sub_df['start_timestamp'], sub_df['heart_rate'])]
-                ))
+            scatter = go.Scattergl if len(df) > WEBGL_MIN_POINTS else go.Scatter
+            fig2.add_traces(daily_traces(df, 'heart_rate', scatter, px.colors.qualitative.T10))
             fig2.update_layout(
                 width=800,
                 height=600,
@@ -484,11 +493,21 @@ def generate_graphs(n_clicks, start_date, end_date, start_time, end_time):
                 html.H3("Apple Watch Heart Rate Data"),
                 dcc.Graph(figure=fig2)
             ]))
-            figures.append(html.Hr())
+            clock.lap('graphs.figure', len(df))
+    except (IndexError, ValueError):
+        logger.warning('Missing heart rate data!')
+
+    return figures
+
 
-        # Resting Heart Rate Data
+# Resting Heart Rate Data
+def panel_resting_heart_rate(apple_watch, start, end, full_resolution, clock):
+    figures = []
+    try:
         df = apple_watch.load_resting_heart_rate_data()
-        df = df[(df['start_timestamp'] > START_DATE) & (df['start_timestamp'] < END_DATE)]
+        clock.lap('graphs.load', len(df))
+        df = time_range(df, start, end)
+        clock.lap('graphs.filter', len(df))
         if not df.empty:
             df['date'] = df['start_timestamp'].dt.strftime('%m/%d/%y')
             fig3 = px.bar(
@@ -508,171 +527,440 @@ def generate_graphs(n_clicks, start_date, end_date, start_time, end_time):
                 html.H3("Apple Watch Resting Heart Rate"),
                 dcc.Graph(figure=fig3)
             ]))
-            figures.append(html.Hr())
-
-        # Walking Heart Rate Data
-        try:
-            df = apple_watch.load_walking_heart_rate_data()
-            df = df[(df['start_timestamp'] > START_DATE) & (df['start_timestamp'] < END_DATE)]
-            if not df.empty:
-                df['date'] = df['start_timestamp'].dt.strftime('%m/%d/%y')
-                fig4 = px.line(
-                    df, x='start_timestamp', y='walking_heart_rate',
-                    title='Apple Watch Walking Heart Rate',
-                    labels={'start_timestamp': 'Date', 'walking_heart_rate': 'Average Beats Per Minute'},
-                    hover_data=['date']
-                )
-                fig4.update_layout(
-                    width=800,
-                    height=600,
-                    xaxis_title='Date',
-                    yaxis_title='Average Beats Per Minute',
-                    hovermode='closest'
-                )
-                figures.append(html.Div([
-                    html.H3("Apple Watch Walking Heart Rate"),
-                    dcc.Graph(figure=fig4)
-                ]))
-                figures.append(html.Hr())
-        except (IndexError, ValueError):
-            logger.warning('Missing walking heart rate data!')
+            clock.lap('graphs.figure', len(df))
+    except (IndexError, ValueError):
+        logger.warning('Missing resting heart rate data!')
 
-        # Hourly Distance Walked/Ran Data
-        try:
-            df = apple_watch.load_distance_data()
-            df = df[(df['start_timestamp'] > START_DATE) & (df['start_timestamp'] < END_DATE)]
-            if not df.empty:
-                df['date'] = df['start_timestamp'].dt.strftime('%m/%d/%y')
-                df['hour'] = df['start_timestamp'].dt.hour
-                hourly_distance = df.groupby(['hour', 'date'])['distance_walk_run'].sum().reset_index()
-                hourly_distance['datetime'] = pd.to_datetime(hourly_distance['date'])
-                hourly_distance.sort_values(by=['datetime'], inplace=True)
-                fig5 = px.density_heatmap(
-                    hourly_distance, x='hour', y='date', z='distance_walk_run',
-                    title='Apple Watch Hourly Distance Walked/Ran',
-                    labels={'hour': 'Hour', 'date': 'Date', 'distance_walk_run': 'Miles'},
-                    color_continuous_scale='Viridis'
-                )
-                fig5.update_layout(
-                    width=800,
-                    height=600,
-                    xaxis_nticks=24,
-                    yaxis={'categoryorder': 'category ascending'},
-                    hovermode='closest'
-                )
-                figures.append(html.Div([
-                    html.H3("Apple Watch Hourly Distance Walked/Ran"),
-                    dcc.Graph(figure=fig5)
-                ]))
-                figures.append(html.Hr())
-        except (IndexError, ValueError):
-            logger.warning('Missing hourly distance walked/ran data!')
+    return figures
 
-        # Hourly Basal Energy Data
-        try:
-            df = apple_watch.load_basal_energy_data()
-            df = df[(df['start_timestamp'] > START_DATE) & (df['start_timestamp'] < END_DATE)]
-            if not df.empty:
-                df['date'] = df['start_timestamp'].dt.strftime('%m/%d/%y')
-                df['hour'] = df['start_timestamp'].dt.hour
-                basal_energy = df.groupby(['hour', 'date'])['energy_burned'].sum().reset_index()
-                basal_energy['datetime'] = pd.to_datetime(basal_energy['date'])
-                basal_energy.sort_values(by=['datetime'], inplace=True)
-                fig6 = px.density_heatmap(
-                    basal_energy, x='hour', y='date', z='energy_burned',
-                    title='Apple Watch Hourly Calories Burned',
-                    labels={'hour': 'Hour', 'date': 'Date', 'energy_burned': 'Calories'},
-                    color_continuous_scale='Viridis'
-                )
-                fig6.update_layout(
-                    width=800,
-                    height=600,
-                    xaxis_nticks=24,
-                    yaxis={'categoryorder': 'category ascending'},
-                    hovermode='closest'
-                )
-                figures.append(html.Div([
-                    html.H3("Apple Watch Hourly Calories Burned"),
-                    dcc.Graph(figure=fig6)
-                ]))
-                figures.append(html.Hr())
-        except (IndexError, ValueError):
-            logger.warning('Missing hourly calories burned data!')
 
-        # Hourly Stand Hours Data
-        try:
-            df = apple_watch.load_stand_hour_data()
-            df = df[(df['start_timestamp'] > START_DATE) & (df['start_timestamp'] < END_DATE)]
-            if not df.empty:
-                df['date'] = df['start_timestamp'].dt.strftime('%m/%d/%y')
-                df['hour'] = df['start_timestamp'].dt.hour
-                df['stand_hour'] = list(map(lambda label: 1 if label == 'Stood' else 0, df['stand_hour']))
-                stand_hours = df.groupby(['hour', 'date'])['stand_hour'].sum().reset_index()
-
-                stand_hours['datetime'] = pd.to_datetime(stand_hours['date'])
-                stand_hours.sort_values(by=['datetime'], inplace=True)
-                fig7 = px.density_heatmap(
-                    stand_hours, x='hour', y='date', z='stand_hour',
-                    title='Apple Watch Hourly Stand Hours',
-                    labels={'hour': 'Hour', 'date': 'Date', 'stand_hour': 'Standing Hours'},
-                    color_continuous_scale='Viridis'
-                )
-                fig7.update_layout(
-                    width=800,
-                    height=600,
-                    xaxis_nticks=24,
-                    yaxis={'categoryorder': 'category ascending'},
-                    hovermode='closest'
-                )
-                figures.append(html.Div([
-                    html.H3("Apple Watch Hourly Stand Hours"),
-                    dcc.Graph(figure=fig7)
-                ]))
-                figures.append(html.Hr())
-        except (IndexError, ValueError):
-            logger.warning('Missing hourly stand hours data!')
-        try:
-            df = apple_watch.load_step_data()
-            df = df[(df['start_timestamp'] > START_DATE) & (df['start_timestamp'] < END_DATE)]
+# Walking Heart Rate Data
+def panel_walking_heart_rate(apple_watch, start, end, full_resolution, clock):
+    figures = []
+    try:
+        df = apple_watch.load_walking_heart_rate_data()
+        clock.lap('graphs.load', len(df))
+        df = time_range(df, start, end)
+        clock.lap('graphs.filter', len(df))
+        if not df.empty:
             df['date'] = df['start_timestamp'].dt.strftime('%m/%d/%y')
-            df['hour'] = df['start_timestamp'].dt.hour
-        
-            # Group by hour and date and calculate sum of steps
-            step_counts = df.groupby(['hour', 'date'])['steps'].sum().reset_index()
-        
-            # Create a grid heatmap of hourly counts grouped by date
-            fig8 = go.Figure(data=go.Heatmap(
-                z=step_counts['steps'],
-                x=step_counts['hour'],
-                y=step_counts['date'],
-                colorscale='Viridis',
-                hoverongaps = False
-            ))
-        
-            fig8.update_layout(
-                title='Apple Watch Hourly Step Counts',
-                xaxis_title='Hour',
-                yaxis_title='Date',
-                xaxis={'tickvals': list(range(24))},
+            fig4 = px.line(
+                df, x='start_timestamp', y='walking_heart_rate',
+                title='Apple Watch Walking Heart Rate',
+                labels={'start_timestamp': 'Date', 'walking_heart_rate': 'Average Beats Per Minute'},
+                hover_data=['date']
+            )
+            fig4.update_layout(
+                width=800,
+                height=600,
+                xaxis_title='Date',
+                yaxis_title='Average Beats Per Minute',
+                hovermode='closest'
+            )
+            figures.append(html.Div([
+                html.H3("Apple Watch Walking Heart Rate"),
+                dcc.Graph(figure=fig4)
+            ]))
+            clock.lap('graphs.figure', len(df))
+    except (IndexError, ValueError):
+        logger.warning('Missing walking heart rate data!')
+
+    return figures
+
+
+# Hourly Distance Walked/Ran Data
+def panel_distance(apple_watch, start, end, full_resolution, clock):
+    figures = []
+    try:
+        hourly_distance = hourly_rollup_range(apple_watch.load_hourly_rollup('distance'),
+                                              start, end, 'distance_walk_run')
+        clock.lap('graphs.rollup', len(hourly_distance))
+        if not hourly_distance.empty:
+            fig5 = px.density_heatmap(
+                hourly_distance, x='hour', y='date', z='distance_walk_run',
+                title='Apple Watch Hourly Distance Walked/Ran',
+                labels={'hour': 'Hour', 'date': 'Date', 'distance_walk_run': 'Miles'},
+                color_continuous_scale='Viridis'
+            )
+            fig5.update_layout(
+                width=800,
+                height=600,
+                xaxis_nticks=24,
                 yaxis={'categoryorder': 'category ascending'},
+                hovermode='closest'
+            )
+            figures.append(html.Div([
+                html.H3("Apple Watch Hourly Distance Walked/Ran"),
+                dcc.Graph(figure=fig5)
+            ]))
+            clock.lap('graphs.figure', len(hourly_distance))
+    except (IndexError, ValueError):
+        logger.warning('Missing hourly distance walked/ran data!')
+
+    return figures
+
+
+# Hourly Basal Energy Data
+def panel_basal_energy(apple_watch, start, end, full_resolution, clock):
+    figures = []
+    try:
+        basal_energy = hourly_rollup_range(apple_watch.load_hourly_rollup('basal_energy'),
+                                           start, end, 'energy_burned')
+        clock.lap('graphs.rollup', len(basal_energy))
+        if not basal_energy.empty:
+            fig6 = px.density_heatmap(
+                basal_energy, x='hour', y='date', z='energy_burned',
+                title='Apple Watch Hourly Calories Burned',
+                labels={'hour': 'Hour', 'date': 'Date', 'energy_burned': 'Calories'},
+                color_continuous_scale='Viridis'
+            )
+            fig6.update_layout(
                 width=800,
                 height=600,
-                font=dict(
-                    size=12
-                )
+                xaxis_nticks=24,
+                yaxis={'categoryorder': 'category ascending'},
+                hovermode='closest'
+            )
+            figures.append(html.Div([
+                html.H3("Apple Watch Hourly Calories Burned"),
+                dcc.Graph(figure=fig6)
+            ]))
+            clock.lap('graphs.figure', len(basal_energy))
+    except (IndexError, ValueError):
+        logger.warning('Missing hourly calories burned data!')
+
+    return figures
+
+
+# Hourly Stand Hours Data
+def panel_stand_hour(apple_watch, start, end, full_resolution, clock):
+    figures = []
+    try:
+        stand_hours = hourly_rollup_range(apple_watch.load_hourly_rollup('stand_hour'),
+                                          start, end, 'stand_hour')
+        clock.lap('graphs.rollup', len(stand_hours))
+        if not stand_hours.empty:
+            fig7 = px.density_heatmap(
+                stand_hours, x='hour', y='date', z='stand_hour',
+                title='Apple Watch Hourly Stand Hours',
+                labels={'hour': 'Hour', 'date': 'Date', 'stand_hour': 'Standing Hours'},
+                color_continuous_scale='Viridis'
+            )
+            fig7.update_layout(
+                width=800,
+                height=600,
+                xaxis_nticks=24,
+                yaxis={'categoryorder': 'category ascending'},
+                hovermode='closest'
+            )
+            figures.append(html.Div([
+                html.H3("Apple Watch Hourly Stand Hours"),
+                dcc.Graph(figure=fig7)
+            ]))
+            clock.lap('graphs.figure', len(stand_hours))
+    except (IndexError, ValueError):
+        logger.warning('Missing hourly stand hours data!')
+
+    return figures
+
+
+# Hourly Step Counts Data
+def panel_steps(apple_watch, start, end, full_resolution, clock):
+    figures = []
+    try:
+        # Hourly sums of steps by date, sliced from the rollup built at ingest
+        step_counts = hourly_rollup_range(apple_watch.load_hourly_rollup('steps'),
+                                          start, end, 'steps')
+        clock.lap('graphs.rollup', len(step_counts))
+    
+        # Create a grid heatmap of hourly counts grouped by date
+        fig8 = go.Figure(data=go.Heatmap(
+            z=step_counts['steps'],
+            x=step_counts['hour'],
+            y=step_counts['date'],
+            colorscale='Viridis',
+            hoverongaps = False
+        ))
+    
+        fig8.update_layout(
+            title='Apple Watch Hourly Step Counts',
+            xaxis_title='Hour',
+            yaxis_title='Date',
+            xaxis={'tickvals': list(range(24))},
+            yaxis={'categoryorder': 'category ascending'},
+            width=800,
+            height=600,
+            font=dict(
+                size=12
+            )
+        )
+        figures.append(html.Div([
+                    html.H3("Apple Watch Hourly Step Counts"),
+                    dcc.Graph(figure=fig8)
+                ]))
+        clock.lap('graphs.figure', len(step_counts))
+    except (IndexError, ValueError):
+        logger.warning('Missing Hourly Step Counts data!')
+
+    return figures
+
+
+# Sleep Analysis Data
+def panel_sleep(apple_watch, start, end, full_resolution, clock):
+    figures = []
+    try:
+        nights = apple_watch.load_sleep_nights_data()
+        clock.lap('graphs.load', len(nights))
+        # nights are labelled by the date they end on
+        nights = nights.loc[start.tz_localize(None).normalize():end.tz_localize(None).normalize()]
+        timeline = time_range(apple_watch.load_sleep_timeline_data(), start, end)
+        clock.lap('graphs.filter', len(timeline))
+        if not nights.empty:
+            fig9 = go.Figure()
+            for stage, column in SLEEP_STAGE_COLUMNS.items():
+                if nights[column].any():
+                    fig9.add_trace(go.Bar(x=nights.index, y=nights[column], name=stage))
+            fig9.add_trace(go.Scatter(x=nights.index, y=nights['in_bed'], mode='lines+markers', name='In Bed'))
+            fig9.update_layout(
+                width=800,
+                height=600,
+                barmode='stack',
+                title='Apple Watch Sleep per Night',
+                xaxis_title='Night',
+                yaxis_title='Hours',
+                hovermode='x unified'
+            )
+            figures.append(html.Div([
+                html.H3("Apple Watch Sleep per Night"),
+                dcc.Graph(figure=fig9)
+            ]))
+        if not timeline.empty:
+            fig10 = px.timeline(
+                timeline, x_start='start_timestamp', x_end='end_timestamp', y='sleep_stage', color='sleep_stage',
+                title='Apple Watch Sleep Stages',
+                labels={'sleep_stage': 'Stage'},
+                category_orders={'sleep_stage': list(SLEEP_STAGE_COLUMNS) + ['In Bed']}
+            )
+            fig10.update_layout(
+                width=800,
+                height=600,
+                xaxis_title='Time',
+                yaxis_title='Stage',
+                hovermode='closest'
+            )
+            figures.append(html.Div([
+                html.H3("Apple Watch Sleep Stages"),
+                dcc.Graph(figure=fig10)
+            ]))
+        clock.lap('graphs.figure', len(nights) + len(timeline))
+    except (IndexError, ValueError):
+        logger.warning('Missing sleep analysis data!')
+
+    return figures
+
+
+# Workouts Data
+def panel_workouts(apple_watch, start, end, full_resolution, clock):
+    figures = []
+    try:
+        workouts = apple_watch.load_workout_data()
+        clock.lap('graphs.load', len(workouts))
+        workouts = time_range(workouts, start, end)
+        clock.lap('graphs.filter', len(workouts))
+        if not workouts.empty:
+            workouts = workouts.assign(date=workouts['start_timestamp'].dt.strftime('%Y-%m-%d'))
+            fig11 = px.bar(
+                workouts, x='date', y='duration', color='activity',
+                title='Apple Watch Workouts',
+                labels={'date': 'Date', 'duration': 'Minutes', 'activity': 'Workout'}
+            )
+            fig11.update_layout(
+                width=800,
+                height=600,
+                barmode='stack',
+                xaxis_title='Date',
+                yaxis_title='Minutes',
+                hovermode='closest'
             )
+            # routes are only decoded once a workout is picked, by show_workout_route
+            routed = workouts[workouts['route'].notna()]
             figures.append(html.Div([
-                        html.H3("Apple Watch Hourly Step Counts"),
-                        dcc.Graph(figure=fig8)
-                    ]))
-            figures.append(html.Hr())
-        except (IndexError, ValueError):
-            logger.warning('Missing Hourly Step Counts data!')
-
-        processing = False
+                html.H3("Apple Watch Workouts"),
+                dcc.Graph(figure=fig11),
+                dcc.Dropdown(
+                    id='workout-select',
+                    options=[{'label': f"{start:%m/%d/%y %H:%M} {activity} ({duration:.0f} min)", 'value': int(label)}
+                             for label, start, activity, duration in zip(routed.index, routed['start_timestamp'],
+                                                                         routed['activity'], routed['duration'])],
+                    placeholder='Select a workout to show its route'
+                ),
+                html.Div(id='workout-route')
+            ]))
+            clock.lap('graphs.figure', len(workouts))
+    except (IndexError, ValueError):
+        logger.warning('Missing workouts data!')
+
+    return figures
+
+
+# panel name -> (title, function adding its figures to a list), in page order
+GRAPH_PANELS = {
+    'heart_rate_variability': ('Heart Rate Variability', panel_heart_rate_variability),
+    'heart_rate': ('Heart Rate', panel_heart_rate),
+    'resting_heart_rate': ('Resting Heart Rate', panel_resting_heart_rate),
+    'walking_heart_rate': ('Walking Heart Rate', panel_walking_heart_rate),
+    'distance': ('Hourly Distance Walked/Ran', panel_distance),
+    'basal_energy': ('Hourly Basal Energy', panel_basal_energy),
+    'stand_hour': ('Hourly Stand Hours', panel_stand_hour),
+    'steps': ('Hourly Step Counts', panel_steps),
+    'sleep': ('Sleep Analysis', panel_sleep),
+    'workouts': ('Workouts', panel_workouts),
+}
+
+
+
+def build_panel(job, panel, xml_data_file_path, content_hash, start_date, end_date, start_time, end_time,
+                full_resolution=False):
+    """
+    Build one Graphs tab panel; runs on a JobScheduler worker thread, outside the request
+
+    :param job: Job to report progress to; raises JobCancelled once cancelled
+    :param panel: name in GRAPH_PANELS
+    :param content_hash: the upload's hash from session_content_hash
+    :param full_resolution: plot every heart rate sample instead of a downsampled series
+    :return: Div holding the panel's figures, also kept in figure_cache
+    """
+    title, add_figures = GRAPH_PANELS[panel]
+    start, end = graph_range(start_date, end_date, start_time, end_time)
+
+    job.update(5, 'Loading data')
+    # times the panel's load, filter and figure steps one after another
+    clock = timings.clock(section=panel)
+    # panels are built side by side; the first one to open a cold upload ingests it while the others
+    # wait on that upload's cache alone, and warm uploads open without waiting on anything
+    apple_watch = open_upload(xml_data_file_path, content_hash)
+    clock.lap('graphs.open')
+    # loaded timestamps are tz-aware, so compare them in the export's time zone
+    start = pd.Timestamp(start, tz=apple_watch.timezone)
+    end = pd.Timestamp(end, tz=apple_watch.timezone)
+
+    job.update(50, f'Building {title} graphs')
+    figures = add_figures(apple_watch, start, end, full_resolution, clock)
+    panel_div = html.Div(figures) if figures else html.Div(f"No {title} data in the selected range.")
+    cache_key = panel_cache_key(content_hash, panel, start_date, end_date, start_time, end_time, full_resolution)
+    figure_cache.put(cache_key, to_json_plotly(panel_div).encode())
+    clock.lap('graphs.serialize')
+    return panel_div
+
+
+# Callback drawing the route of the workout picked in the Workouts section
+@app.callback(
+    Output('workout-route', 'children'),
+    [Input('workout-select', 'value')],
+    prevent_initial_call=True
+)
+def show_workout_route(workout):
+    xml_data_file_path = session.get('xml_data_file_path', '')
+    if workout is None or not xml_data_file_path:
+        raise PreventUpdate
+    apple_watch = open_upload(xml_data_file_path, session_content_hash(xml_data_file_path))
+    try:
+        with timings.span('graphs.route') as span:
+            route = apple_watch.load_workout_route_data(workout)
+            span.items = len(route)
+    except (IndexError, ValueError):
+        logger.warning('Missing workout route data!')
+        if not os.path.isdir(os.path.join(os.path.dirname(xml_data_file_path), ROUTE_DIR)):
+            return html.Div("Routes are only included when the export.zip archive is uploaded.")
+        return html.Div("No route file found for this workout in the uploaded archive.")
+    fig12 = go.Figure(go.Scattermap(
+        lat=route['latitude'],
+        lon=route['longitude'],
+        mode='lines',
+        customdata=route['elevation'],
+        text=route['timestamp'].dt.strftime('%H:%M:%S'),
+        hovertemplate='%{text}<br>Elevation: %{customdata:.0f} m<extra></extra>'
+    ))
+    fig12.update_layout(
+        width=800,
+        height=600,
+        title='Apple Watch Workout Route',
+        map={'style': 'open-street-map', 'zoom': 13,
+                'center': {'lat': route['latitude'].mean(), 'lon': route['longitude'].mean()}},
+        margin={'l': 0, 'r': 0, 't': 40, 'b': 0}
+    )
+    return dcc.Graph(figure=fig12)
+
+
+def job_progress(job):
+    return html.Div([
+        dbc.Progress(value=job.progress, animated=True, striped=True),
+        html.Div(job.message or "Waiting for a free worker...")
+    ])
+
+
+def panel_job_key(panel):
+    # the scheduler keeps one active job per key, so each panel of a session has its own
+    return f'{session_id()}:{panel}'
+
+
+def cancel_panel_jobs(forget=False):
+    """
+    Cancel this session's panel jobs
+
+    :param forget: also drop them, so their results are never shown
+    """
+    for panel in GRAPH_PANELS:
+        job = scheduler.cancel(panel_job_key(panel))
+        if forget and job is not None:
+            scheduler.discard(job)
+
+
+def graph_panel(panel, is_open):
+    """
+    Collapsible card for one panel; its figures are only built once it is first expanded
+    """
+    title, _ = GRAPH_PANELS[panel]
+    return dbc.Card([
+        dbc.CardHeader(html.Button(title, id={'type': 'panel-toggle', 'panel': panel}, n_clicks=0,
+                                   className='btn btn-link')),
+        dbc.Collapse(
+            dbc.CardBody(html.Div(f"Expand to load the {title} graphs.", id={'type': 'graph-panel', 'panel': panel})),
+            id={'type': 'panel-collapse', 'panel': panel},
+            is_open=is_open
+        )
+    ], style={'margin-bottom': '10px'})
+
+
+# Callback laying out the graph panels for the selected dates; each panel then loads on its own
+@app.callback(
+    Output('output-graphs', 'children'),
+    [Input('generate-graphs-button', 'n_clicks')],
+    [State('date-picker-range', 'start_date'),
+     State('date-picker-range', 'end_date'),
+     State('start-time', 'value'),
+     State('end-time', 'value'),
+     State('full-resolution', 'value')]
+)
+def generate_graphs(n_clicks, start_date, end_date, start_time, end_time, full_resolution):
+    if n_clicks > 0:
+        # Get file path from session
+        xml_data_file_path = session.get('xml_data_file_path', '')
+
+        if not xml_data_file_path:
+            return html.Div([
+                dbc.Progress(id="progress", value=0, animated=True),
+                html.Div("No file Uploaded.")
+            ])
+
+        # the panels of a previous selection are replaced, so their figures are no longer wanted
+        cancel_panel_jobs(forget=True)
+        graph_request = {'start_date': start_date, 'end_date': end_date, 'start_time': start_time,
+                         'end_time': end_time, 'full_resolution': 'full' in (full_resolution or [])}
         return html.Div([
             html.H3("Generated Graphs"),
-            *figures
+            dcc.Store(id='graph-request', data=graph_request),
+            *[graph_panel(panel, position < PANELS_OPEN) for position, panel in enumerate(GRAPH_PANELS)]
         ])
     else:
         if not session.get('xml_data_file_path'):
@@ -686,6 +974,104 @@ def generate_graphs(n_clicks, start_date, end_date, start_time, end_time):
         ])
 
 
+# Expanding and collapsing a panel needs no round trip to the server
+app.clientside_callback(
+    "function (n_clicks, is_open) { return n_clicks ? !is_open : is_open; }",
+    Output({'type': 'panel-collapse', 'panel': MATCH}, 'is_open'),
+    [Input({'type': 'panel-toggle', 'panel': MATCH}, 'n_clicks')],
+    [State({'type': 'panel-collapse', 'panel': MATCH}, 'is_open')],
+    prevent_initial_call=True
+)
+
+
+# Callback queueing a panel's figures the first time it is expanded
+@app.callback(
+    [Output({'type': 'graph-panel', 'panel': MATCH}, 'children'),
+     Output({'type': 'graph-panel', 'panel': MATCH}, 'className')],
+    [Input({'type': 'panel-collapse', 'panel': MATCH}, 'is_open')],
+    [State({'type': 'graph-panel', 'panel': MATCH}, 'id'),
+     State({'type': 'graph-panel', 'panel': MATCH}, 'className'),
+     State('graph-request', 'data')]
+)
+def load_panel(is_open, panel_id, requested, graph_request):
+    xml_data_file_path = session.get('xml_data_file_path', '')
+    if not is_open or requested in ('panel-requested', 'panel-loaded') or not graph_request or not xml_data_file_path:
+        raise PreventUpdate
+    content_hash = session_content_hash(xml_data_file_path)
+    # a panel already built for this upload and range is sent as is, without queueing a job
+    figure_json = figure_cache.get(panel_cache_key(content_hash, panel_id['panel'], **graph_request))
+    if figure_json is not None:
+        return json.loads(figure_json), 'panel-loaded'
+    try:
+        job = scheduler.submit(panel_job_key(panel_id['panel']), build_panel, panel_id['panel'], xml_data_file_path,
+                               content_hash, graph_request['start_date'], graph_request['end_date'], graph_request['start_time'],
+                               graph_request['end_time'], graph_request['full_resolution'])
+    except QueueFull:
+        return html.Div("The server is busy, collapse and expand this panel to try again."), ''
+    return job_progress(job), 'panel-requested'
+
+
+def poll_panel(panel):
+    """
+    :return: children and className of a requested panel, as its job stands
+    """
+    job = scheduler.get(panel_job_key(panel))
+    if job is None:
+        # e.g. the job expired, or was queued by another server process; expanding the panel again requeues it
+        return html.Div("Collapse and expand this panel to load its graphs."), ''
+    if not job.finished:
+        return job_progress(job), no_update
+    if job.status == 'done':
+        return job.result, 'panel-loaded'
+    if job.status == 'failed':
+        return html.Div(f"Error generating graphs: {job.error}"), ''
+    return html.Div("Graph generation cancelled."), ''
+
+
+# Callback polling this session's panel jobs, showing each panel as soon as its figures are ready.
+# Finished jobs are kept until the scheduler drops them, so a result lost with a poll dropped by the
+# browser (Dash drops a running callback's response once a newer request for it is queued) is sent again
+@app.callback(
+    [Output({'type': 'graph-panel', 'panel': ALL}, 'children', allow_duplicate=True),
+     Output({'type': 'graph-panel', 'panel': ALL}, 'className', allow_duplicate=True)],
+    [Input('progress-interval', 'n_intervals')],
+    [State({'type': 'graph-panel', 'panel': ALL}, 'id'),
+     State({'type': 'graph-panel', 'panel': ALL}, 'className')],
+    prevent_initial_call=True
+)
+def poll_graphs(n_intervals, panel_ids, requested):
+    children = [no_update] * len(panel_ids)
+    classes = [no_update] * len(panel_ids)
+    for position, (panel_id, panel_class) in enumerate(zip(panel_ids, requested)):
+        if panel_class == 'panel-requested':
+            children[position], classes[position] = poll_panel(panel_id['panel'])
+    if all(update is no_update for update in children):
+        raise PreventUpdate
+    return children, classes
+
+
+# Polling only runs while some panel waits for its figures
+app.clientside_callback(
+    "function (requested) { return !requested.includes('panel-requested'); }",
+    Output('progress-interval', 'disabled'),
+    [Input({'type': 'graph-panel', 'panel': ALL}, 'className')]
+)
+
+
+# Callback to cancel this session's panel jobs; cancelled panels load again when reopened
+@app.callback(
+    Output({'type': 'graph-panel', 'panel': ALL}, 'className', allow_duplicate=True),
+    [Input('cancel-graphs-button', 'n_clicks')],
+    [State({'type': 'graph-panel', 'panel': ALL}, 'className')],
+    prevent_initial_call=True
+)
+def cancel_graphs(n_clicks, requested):
+    if not n_clicks or not requested:
+        raise PreventUpdate
+    cancel_panel_jobs()
+    return [''] * len(requested)
+
+
 # Callback to handle CSV download
 @app.callback(
     Output('output-data-upload', 'children', allow_duplicate=True),
@@ -702,27 +1088,258 @@ def download_csv(n_clicks):
                 html.P("No file uploaded.")
             ])
 
-        source_name = 'A’s Apple Watch'
-        apple_watch = AppleWatchData(xml_data_file_path, source_name)
-        tocsv(apple_watch)
-        
+        return download_links
+
+# Flask routes receiving the export in chunks, so large files never pass through callback memory
+def partial_upload_path(upload_id):
+    if not UPLOAD_ID_PATTERN.fullmatch(upload_id):
+        abort(400)
+    # partial files are per session, so two users uploading the same file never share one
+    return os.path.join(UPLOAD_DIR, f"{session_id()}_{upload_id}.part")
+
+
+@app.server.route('/upload/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    path = partial_upload_path(upload_id)
+    return jsonify(received=os.path.getsize(path) if os.path.exists(path) else 0)
+
+
+def upload_digest(path, start):
+    """
+    :return: hash of the bytes of a partial upload before start, or None if this process did not see them all
+    """
+    with upload_digests_lock:
+        if start == 0:
+            return hashlib.sha256()
+        digest, hashed = upload_digests.get(path, (None, None))
+        return digest if hashed == start else None
+
+
+@app.server.route('/upload/<upload_id>', methods=['POST'])
+def upload_chunk(upload_id):
+    path = partial_upload_path(upload_id)
+    match = CONTENT_RANGE_PATTERN.fullmatch(request.headers.get('Content-Range', ''))
+    if not match:
+        abort(400)
+    start, total = int(match.group(1)), int(match.group(3))
+
+    # a chunk must continue exactly where the stored bytes end; otherwise tell the client where to resume
+    received = os.path.getsize(path) if os.path.exists(path) else 0
+    if start != received:
+        return jsonify(received=received), 409
+
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    digest = upload_digest(path, start)
+    with open(path, 'ab') as f:
+        for chunk in iter(lambda: request.stream.read(UPLOAD_COPY_BYTES), b''):
+            f.write(chunk)
+            if digest is not None:
+                digest.update(chunk)
+    received = os.path.getsize(path)
+    if digest is not None:
+        with upload_digests_lock:
+            upload_digests[path] = (digest, received)
+    if received < total:
+        return jsonify(received=received)
+
+    filename = secure_filename(request.args.get('filename', '')) or EXPORT_XML
+    S = 10  # number of characters in the string.  
+    # call random.choices() string module to find the string in Uppercase + numeric data.  
+    ran = ''.join(random.choices(string.ascii_uppercase + string.digits, k = S))   
+    upload_dir = os.path.join(UPLOAD_DIR, ran)
+    os.makedirs(upload_dir)
+    with upload_digests_lock:
+        upload_digests.pop(path, None)
+    if filename.lower().endswith('.zip'):
         try:
-            return download_links
-        except Exception as e:
-            return html.Div([
-                html.P(f"Error generating CSV: {str(e)}")
-            ])
-# Flask route to serve the CSV file
+            file_path, content_hash = extract_export(path, upload_dir)
+        except (zipfile.BadZipFile, ValueError) as e:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+            os.remove(path)
+            return jsonify(error=f'{filename} is not an Apple Health export: {e}'), 400
+        os.remove(path)
+    else:
+        file_path = os.path.join(upload_dir, filename)
+        # chunks written by another worker process, or before a restart, were not hashed here
+        content_hash = digest.hexdigest() if digest is not None else hash_file(path)
+        os.replace(path, file_path)
+    remember_hash(file_path, content_hash)
+
+    # the session's previous upload will not be viewed again, so free its DataFrames and exports
+    if session.get('xml_data_file_path'):
+        frame_cache.invalidate(os.path.expanduser(session['xml_data_file_path']))
+    shutil.rmtree(os.path.join(EXPORT_DIR, session_id()), ignore_errors=True)
+
+    # Save file path in session
+    session['xml_data_file_path'] = file_path
+    session['upload_filename'] = filename
+    session['content_hash'] = content_hash
+    return jsonify(received=received, complete=True)
+
+def extract_export(zip_path, directory):
+    """
+    Extract export.xml and its workout routes from an Apple Health export.zip
+
+    :param directory: the upload's own directory
+    :return: path of the extracted export.xml and its SHA-256, computed while it is written
+    :raises ValueError: if the archive holds no export.xml
+    """
+    with zipfile.ZipFile(zip_path) as archive:
+        names = archive.namelist()
+        # export.xml sits in the archive's top folder, e.g. apple_health_export/export.xml
+        exports = [name for name in names if name.rsplit('/', 1)[-1] == EXPORT_XML]
+        if not exports:
+            raise ValueError(f'no {EXPORT_XML} found')
+        export_name = min(exports, key=lambda name: name.count('/'))
+        xml_data_file_path = os.path.join(directory, EXPORT_XML)
+        digest = hashlib.sha256()
+        with archive.open(export_name) as source, open(xml_data_file_path, 'wb') as target:
+            for chunk in iter(lambda: source.read(UPLOAD_COPY_BYTES), b''):
+                target.write(chunk)
+                digest.update(chunk)
+
+        route_prefix = f'{export_name[:-len(EXPORT_XML)]}{ROUTE_DIR}/'
+        for name in names:
+            route = name[len(route_prefix):]
+            # names come from the upload, so only plain file names are written, never paths
+            if name.startswith(route_prefix) and ROUTE_NAME_PATTERN.fullmatch(route):
+                os.makedirs(os.path.join(directory, ROUTE_DIR), exist_ok=True)
+                with archive.open(name) as source, open(os.path.join(directory, ROUTE_DIR, route), 'wb') as target:
+                    shutil.copyfileobj(source, target, UPLOAD_COPY_BYTES)
+    return xml_data_file_path, digest.hexdigest()
+
+
+def send_download(path, download_name):
+    """
+    Send an export with validators, so unchanged files are answered with 304 and interrupted
+    downloads resume with a Range request; text files are gzipped on the fly when the client accepts it
+    """
+    if (os.path.splitext(path)[1] in GZIP_EXTENSIONS and request.range is None
+            and 'gzip' in request.accept_encodings):
+        stat = os.stat(path)
+
+        def compress():
+            compressor = zlib.compressobj(wbits=31)  # gzip container
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(GZIP_CHUNK_BYTES), b''):
+                    yield compressor.compress(chunk)
+            yield compressor.flush()
+
+        response = Response(compress(), mimetype=mimetypes.guess_type(download_name)[0] or 'application/octet-stream')
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Content-Disposition'] = f'attachment; filename={download_name}'
+        # the encoded body differs from the file, so it gets its own validator
+        response.set_etag(f'{stat.st_mtime_ns:x}-{stat.st_size:x}-gzip')
+        response.last_modified = stat.st_mtime
+        response.make_conditional(request)
+    else:
+        response = send_file(os.path.abspath(path), as_attachment=True, download_name=download_name,
+                             conditional=True, etag=True)
+    response.vary.add('Accept-Encoding')
+    # exports are per session: keep them out of shared caches, and revalidate before reuse
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def save_while_sending(chunks, path):
+    """
+    Pass a generated download through while writing it to path, which only appears once complete
+    """
+    with atomic_path(path) as tmp_path, open(tmp_path, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+            yield chunk
+
+
+def load_session_data():
+    xml_data_file_path = session.get('xml_data_file_path', '')
+    if not xml_data_file_path:
+        abort(404)
+    return open_upload(xml_data_file_path, session_content_hash(xml_data_file_path))
+
+
+# Flask route streaming every table of the session's upload as one ZIP, written as it is sent.
+# The ZIP is kept in the session's export directory, so later requests are served as a file
+@app.server.route('/export/<name>.zip')
+def export_zip(name):
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+    download_name = f'{secure_filename(name)}.zip'
+    path = os.path.join(session_export_dir(), f'apple_watch_{export_format}.zip')
+    if os.path.exists(path):
+        return send_download(path, download_name)
+    apple_watch = load_session_data()
+    return Response(stream_with_context(save_while_sending(stream_export_zip(apple_watch, export_format), path)),
+                    mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={download_name}'})
+
+# Flask route to serve a file from the session's export directory; the SQLite database is built on first request,
+# by a scheduler worker that requests arriving while it runs wait on together
 @app.server.route('/download/<path:filename>')
 def download_file(filename):
-    try:
-        # Construct the full path to the file within the 'download' folder
-        file_path = f"./download/{filename}"
-        
-        # Use send_file to send the file as an attachment
-        return send_file(file_path, as_attachment=True)
-    except Exception as e:
-        return str(e), 404
+    filename = secure_filename(filename)
+    directory = session_export_dir()
+    file_path = os.path.join(directory, filename)
+    if filename == SQLITE_FILENAME and not os.path.exists(file_path):
+        xml_data_file_path = session.get('xml_data_file_path', '')
+        if not xml_data_file_path:
+            abort(404)
+        try:
+            job = scheduler.submit(f'{session_id()}:{SQLITE_FILENAME}', build_sqlite, xml_data_file_path,
+                                   session_content_hash(xml_data_file_path), directory, replace=False)
+        except QueueFull:
+            abort(503)
+        job.future.result()
+        if job.status != 'done':
+            abort(500)
+    if not os.path.exists(file_path):
+        abort(404)
+    return send_download(file_path, filename)
+
+# Time every Dash callback request as a whole; for callbacks handing over ready-made results,
+# like poll_graphs delivering the figures, this is mostly their JSON serialization
+@app.server.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.server.after_request
+def record_callback_time(response):
+    if request.path.endswith('/_dash-update-component') and 'request_started' in g:
+        output = (request.get_json(silent=True) or {}).get('output', '')
+        timings.observe('dash.callback', time.perf_counter() - g.request_started, response.content_length,
+                        output=output)
+    return response
+
+
+def collect_app_metrics():
+    stats = frame_cache.stats()
+    figures = figure_cache.stats()
+    statuses = [job.status for job in list(scheduler.jobs.values())]
+    return [
+        ('frame_cache_bytes', 'gauge', 'Bytes of DataFrames held in memory.', stats['bytes']),
+        ('frame_cache_frames', 'gauge', 'DataFrames held in memory.', stats['frames']),
+        ('frame_cache_hits_total', 'counter', 'DataFrames served from memory.', stats['hits']),
+        ('frame_cache_misses_total', 'counter', 'DataFrames not found in memory.', stats['misses']),
+        ('frame_cache_evictions_total', 'counter', 'DataFrames evicted to stay within budget.', stats['evictions']),
+        ('figure_cache_bytes', 'gauge', 'Bytes of serialized figures held in memory.', figures['bytes']),
+        ('figure_cache_hits_total', 'counter', 'Graph panels served from memory.', figures['hits']),
+        ('figure_cache_disk_hits_total', 'counter', 'Graph panels served from disk.', figures['disk_hits']),
+        ('figure_cache_misses_total', 'counter', 'Graph panels built from scratch.', figures['misses']),
+        ('jobs_queued', 'gauge', 'Graph jobs waiting for a worker.', statuses.count('queued')),
+        ('jobs_running', 'gauge', 'Graph jobs running.', statuses.count('running')),
+    ]
+
+
+timings.add_collector(collect_app_metrics)
+
+
+# Flask route exposing stage timings and cache statistics to Prometheus
+@app.server.route('/metrics')
+def metrics():
+    return Response(timings.render(), mimetype='text/plain; version=0.0.4')
 
 app.css.append_css({
     'external_url': 'https://stackpath.bootstrapcdn.com/bootstrap/4.5.0/css/bootstrap.min.css'
@@ -0,0 +1,125 @@
+// Uploads the export picked or dropped on #upload-data to the /upload route in chunks.
+// The server reports how many bytes it already holds, so a dropped connection resumes
+// from there instead of starting over.
+(function () {
+    var CHUNK_SIZE = 8 * 1024 * 1024;
+    var MAX_RETRIES = 5;
+
+    function setStatus(text) {
+        var zone = document.getElementById('upload-data');
+        if (zone) {
+            zone.textContent = text;
+        }
+    }
+
+    function setProgress(fraction) {
+        var bar = document.querySelector('#progress .progress-bar');
+        if (bar) {
+            var percent = Math.floor(fraction * 100);
+            bar.style.width = percent + '%';
+            bar.setAttribute('aria-valuenow', percent);
+        }
+    }
+
+    function receivedBytes(url) {
+        return fetch(url, {credentials: 'same-origin'})
+            .then(function (response) { return response.json(); })
+            .then(function (result) { return result.received; });
+    }
+
+    function sleep(ms) {
+        return new Promise(function (resolve) { setTimeout(resolve, ms); });
+    }
+
+    async function upload(file) {
+        if (!file.size) {
+            setStatus('File ' + file.name + ' is empty.');
+            return;
+        }
+        // the same file always maps to the same id, so selecting it again resumes the upload
+        var uploadId = [file.name, file.size, file.lastModified].join('-').replace(/[^A-Za-z0-9_-]/g, '_');
+        var url = '/upload/' + encodeURIComponent(uploadId) + '?filename=' + encodeURIComponent(file.name);
+        var offset = 0;
+        var retries = 0;
+
+        while (true) {
+            try {
+                if (retries) {
+                    offset = await receivedBytes(url);
+                }
+                if (offset >= file.size) {
+                    break;
+                }
+                var end = Math.min(offset + CHUNK_SIZE, file.size);
+                var response = await fetch(url, {
+                    method: 'POST',
+                    credentials: 'same-origin',
+                    headers: {
+                        'Content-Type': 'application/octet-stream',
+                        'Content-Range': 'bytes ' + offset + '-' + (end - 1) + '/' + file.size
+                    },
+                    body: file.slice(offset, end)
+                });
+                if (response.status === 400) {
+                    // the file was received but rejected, e.g. an archive without export.xml; resending will not help
+                    var rejected = await response.json();
+                    setStatus(rejected.error || 'Upload of ' + file.name + ' was rejected.');
+                    return;
+                }
+                if (!response.ok && response.status !== 409) {
+                    throw new Error('HTTP ' + response.status);
+                }
+                var result = await response.json();
+                offset = result.received;
+                retries = 0;
+                if (result.complete) {
+                    break;
+                }
+            } catch (err) {
+                retries += 1;
+                if (retries > MAX_RETRIES) {
+                    setStatus('Upload of ' + file.name + ' failed. Select the file again to resume.');
+                    return;
+                }
+                await sleep(1000 * retries);
+                continue;
+            }
+            setProgress(offset / file.size);
+            setStatus('Uploading ' + file.name + ': ' + Math.floor(100 * offset / file.size) + '%');
+        }
+        setProgress(1);
+        setStatus('File ' + file.name + ' uploaded. Please click the upload button.');
+    }
+
+    function inDropZone(event) {
+        return event.target.closest && event.target.closest('#upload-data');
+    }
+
+    document.addEventListener('click', function (event) {
+        if (!inDropZone(event)) {
+            return;
+        }
+        var input = document.createElement('input');
+        input.type = 'file';
+        input.accept = '.xml,.zip';
+        input.onchange = function () {
+            if (input.files.length) {
+                upload(input.files[0]);
+            }
+        };
+        input.click();
+    });
+
+    document.addEventListener('dragover', function (event) {
+        if (inDropZone(event)) {
+            event.preventDefault();
+        }
+    });
+
+    document.addEventListener('drop', function (event) {
+        if (inDropZone(event) && event.dataTransfer.files.length) {
+            event.preventDefault();
+            upload(event.dataTransfer.files[0]);
+        }
+    });
+})();
@@ -0,0 +1,69 @@
+'''
+Benchmark building the heart rate chart's traces with a scan per date against the single-pass daily_traces
+
+Samples are spread over three years, as in a long-worn watch's export, and plotted at full resolution.
+
+usage: python benchmarks/bench_heart_rate_chart.py [number of samples]
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+
+from plot_apple_watch_data import daily_traces
+
+DAYS = 3 * 365
+
+
+def make_heart_rate(count):
+    rng = np.random.default_rng(0)
+    seconds = np.sort(rng.integers(0, DAYS * 24 * 3600, count))
+    start = pd.Timestamp('2021-01-01', tz='America/New_York')
+    return pd.DataFrame({'start_timestamp': start + pd.to_timedelta(seconds, unit='s'),
+                         'heart_rate': rng.normal(75, 12, count).round().astype('float32')})
+
+
+def traces_per_date(df):
+    # what the heart rate chart used to do: one full scan and one hover string per point for every date
+    df = df.copy()
+    df['date'] = df['start_timestamp'].dt.strftime('%m/%d/%y')
+    df['time'] = df['start_timestamp'].dt.time
+    color_palette = px.colors.qualitative.T10
+    traces = []
+    for idx, dt in enumerate(df['date'].unique()):
+        sub_df = df[df['date'] == dt]
+        traces.append(go.Scattergl(
+            x=sub_df['time'],
+            y=sub_df['heart_rate'],
+            mode='markers',
+            marker=dict(color=color_palette[idx % len(color_palette)]),
+            name=dt,
+            text=[f"Date: {d}, Time: {t}, BPM: {bpm}"
+                  for d, t, bpm in zip(sub_df['date'], sub_df['start_timestamp'], sub_df['heart_rate'])]
+        ))
+    return traces
+
+
+def single_pass(df):
+    return daily_traces(df, 'heart_rate', go.Scattergl, px.colors.qualitative.T10)
+
+
+def seconds(func, df):
+    start = time.perf_counter()
+    traces = func(df)
+    return time.perf_counter() - start, len(traces)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    df = make_heart_rate(count)
+    before, days = seconds(traces_per_date, df)
+    after, _ = seconds(single_pass, df)
+    print(f'samples:          {count:,} over {days:,} days')
+    print(f'scan per date:    {before:.2f}s ({count / before:,.0f} samples/sec)')
+    print(f'daily_traces:     {after:.2f}s ({count / after:,.0f} samples/sec, {before / after:.1f}x)')
@@ -0,0 +1,50 @@
+'''
+Report the in-memory footprint of each loaded metric against the object-dtype layout
+the loaders used to build: datetime objects for timestamps, float64 or str for values
+
+usage: python benchmarks/bench_memory.py export.xml
+'''
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from read_apple_watch_data import AppleWatchData
+
+
+def object_layout(df):
+    """
+    The same frame with Python objects per cell, as parsing records into tuples produced it
+    """
+    columns = {}
+    for column in df.columns:
+        series = df[column]
+        if isinstance(series.dtype, pd.DatetimeTZDtype):
+            columns[column] = pd.Series([stamp.to_pydatetime() for stamp in series], index=df.index, dtype=object)
+        elif isinstance(series.dtype, pd.CategoricalDtype):
+            columns[column] = series.astype(str).astype(object)
+        else:
+            columns[column] = series.astype(np.float64)
+    return pd.DataFrame(columns, index=df.index)
+
+
+def footprint(df):
+    return int(df.memory_usage(deep=True).sum())
+
+
+if __name__ == '__main__':
+    apple_watch = AppleWatchData(sys.argv[1], 'Apple Watch', streaming=True)
+    metrics = apple_watch.load_metrics()
+
+    total_before = total_after = 0
+    print(f'{"metric":<24} {"rows":>10} {"before MB":>10} {"after MB":>10} {"ratio":>6}')
+    for metric, df in metrics.items():
+        before = footprint(object_layout(df))
+        after = footprint(df)
+        total_before += before
+        total_after += after
+        print(f'{metric:<24} {len(df):>10,} {before / 1e6:>10.2f} {after / 1e6:>10.2f} {before / after:>5.1f}x')
+    print(f'{"total":<24} {"":>10} {total_before / 1e6:>10.2f} {total_after / 1e6:>10.2f} '
+          f'{total_before / total_after:>5.1f}x')
@@ -0,0 +1,38 @@
+'''
+Benchmark how streamed ingest scales with the number of worker processes
+
+usage: python benchmarks/bench_parallel_ingest.py export.xml [max workers]
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from read_apple_watch_data import parallel_stream_records, stream_records
+
+
+def time_ingest(file_path, workers):
+    start = time.perf_counter()
+    if workers == 1:
+        streamed = stream_records(file_path)
+    else:
+        streamed = parallel_stream_records(file_path, workers=workers)
+    elapsed = time.perf_counter() - start
+    return elapsed, sum(len(columns['startDate']) for columns in streamed.record_columns.values())
+
+
+if __name__ == '__main__':
+    file_path = sys.argv[1]
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count() or 1
+    worker_counts = [1]
+    while worker_counts[-1] * 2 <= max_workers:
+        worker_counts.append(worker_counts[-1] * 2)
+    if worker_counts[-1] != max_workers:
+        worker_counts.append(max_workers)
+
+    print(f'{os.path.getsize(file_path) / 1e6:,.0f} MB, {os.cpu_count()} CPUs')
+    baseline = None
+    for workers in worker_counts:
+        elapsed, count = time_ingest(file_path, workers)
+        baseline = baseline or elapsed
+        print(f'workers={workers:<3} {elapsed:8.2f}s  {count / elapsed:12,.0f} records/sec  {baseline / elapsed:5.2f}x')
@@ -0,0 +1,160 @@
+'''
+Benchmark the ingest-to-chart pipeline on one export and record the results as JSON
+
+Times AppleWatchData construction (plain, with a cold and a warm Parquet cache), every loader,
+tocsv, and building each of the app's graph panels, with its throughput and the
+process's resident and peak resident memory after the step. Peak RSS never goes down within a
+process, so a step's peak is the highest seen up to and including it.
+
+usage: python benchmarks/bench_pipeline.py export.xml [results.json] [previous results.json]
+       python benchmarks/bench_pipeline.py --generate 1000000 [results.json] [previous results.json]
+'''
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..'))
+import pandas as pd
+
+from generate_export import generate_export
+from job_scheduler import Job
+from cache_apple_watch_data import hash_file
+from read_apple_watch_data import AppleWatchData, METRIC_LOADERS
+from save_apple_watch_data import tocsv
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return None
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+class Recorder:
+    def __init__(self):
+        self.stages = []
+
+    def add(self, name, seconds, items=None):
+        stage = {'name': name, 'seconds': round(seconds, 4), 'items': items,
+                 'items_per_second': round(items / seconds) if items and seconds else None,
+                 'rss_mb': rss_mb(), 'peak_rss_mb': peak_rss_mb()}
+        self.stages.append(stage)
+        rate = f'{stage["items_per_second"]:>12,}/s' if stage['items_per_second'] else ' ' * 14
+        print(f'{name:<48} {seconds:9.3f}s {rate} {stage["peak_rss_mb"]:9.0f} MB peak')
+
+    def time(self, name, func, items=None):
+        start = time.perf_counter()
+        result = func()
+        self.add(name, time.perf_counter() - start, items(result) if callable(items) else items)
+        return result
+
+
+def count_records(apple_watch):
+    return sum(len(columns['startDate']) for columns in apple_watch.record_columns.values())
+
+
+def bench_graphs(recorder, file_path, apple_watch, work_dir):
+    # the app keeps its caches relative to the working directory
+    os.chdir(work_dir)
+    import app
+
+    heart_rate = apple_watch.load_heart_rate_data()['start_timestamp']
+    first, last = heart_rate.min(), heart_rate.max()
+    args = (file_path, hash_file(file_path), f'{first:%Y-%m-%d}', f'{last:%Y-%m-%d}', '00:00', '23:59')
+    # the first run ingests into the app's caches, the second shows the steady state
+    for prefix in ('graphs_cold', 'graphs_warm'):
+        start = time.perf_counter()
+        for panel in app.GRAPH_PANELS:
+            recorder.time(f'{prefix}/{panel}', lambda: app.build_panel(Job(prefix), panel, *args))
+        recorder.add(f'{prefix}/total', time.perf_counter() - start)
+
+
+def run(file_path):
+    recorder = Recorder()
+    with tempfile.TemporaryDirectory() as work_dir:
+        apple_watch = recorder.time('construct', lambda: AppleWatchData(file_path, 'Apple Watch', streaming=True),
+                                    count_records)
+        records = count_records(apple_watch)
+        for metric, loader in METRIC_LOADERS.items():
+            recorder.time(f'load/{metric}', getattr(apple_watch, loader), len)
+        recorder.time('load_Personal_data', apple_watch.load_Personal_data)
+
+        cache_dir = os.path.join(work_dir, 'parquet')
+        recorder.time('construct_cached/cold',
+                      lambda: AppleWatchData(file_path, 'Apple Watch', streaming=True, cache_dir=cache_dir), records)
+        cached = recorder.time('construct_cached/warm',
+                               lambda: AppleWatchData(file_path, 'Apple Watch', streaming=True, cache_dir=cache_dir))
+        recorder.time('load_metrics/warm', cached.load_metrics, lambda metrics: sum(map(len, metrics.values())))
+
+        rows = sum(len(df) for df in apple_watch.load_metrics().values())
+        recorder.time('tocsv', lambda: tocsv(apple_watch, os.path.join(work_dir, 'csv')), rows)
+
+        cwd = os.getcwd()
+        try:
+            bench_graphs(recorder, os.path.abspath(file_path), apple_watch, work_dir)
+        finally:
+            os.chdir(cwd)
+    return records, recorder.stages
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARK_DIR,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(stages, previous_path):
+    with open(previous_path) as f:
+        previous = {stage['name']: stage for stage in json.load(f)['stages']}
+    print(f'\n{"stage":<48} {"before":>9} {"after":>9} {"change":>8}')
+    for stage in stages:
+        before = previous.get(stage['name'])
+        if before and before['seconds']:
+            change = stage['seconds'] / before['seconds'] - 1
+            print(f'{stage["name"]:<48} {before["seconds"]:8.3f}s {stage["seconds"]:8.3f}s {change:+8.1%}')
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args[0] == '--generate':
+        file_path = os.path.join(tempfile.gettempdir(), f'export_{args[1]}.xml')
+        if not os.path.exists(file_path):
+            generate_export(file_path, int(args[1]))
+        args = args[2:]
+    else:
+        file_path = args.pop(0)
+    output_path = args[0] if args else 'benchmark_results.json'
+
+    records, stages = run(file_path)
+    results = {
+        'export': os.path.basename(file_path),
+        'export_bytes': os.path.getsize(file_path),
+        'records': records,
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'cpus': os.cpu_count(),
+        'stages': stages,
+    }
+    with open(output_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'\nresults written to {output_path}')
+    if len(args) > 1:
+        compare(stages, args[1])
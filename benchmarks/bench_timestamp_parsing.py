@@ -0,0 +1,40 @@
+'''
+Benchmark per-record strptime against the vectorized parse_timestamps
+
+usage: python benchmarks/bench_timestamp_parsing.py [number of records]
+'''
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from read_apple_watch_data import parse_timestamps
+
+
+def make_timestamps(count):
+    start = datetime(2020, 1, 1)
+    offsets = ['-0600', '-0500']
+    return [(start + timedelta(minutes=5 * i)).strftime('%Y-%m-%d %H:%M:%S ') + offsets[(i // 50000) % 2]
+            for i in range(count)]
+
+
+def strptime_per_record(timestamp_strings):
+    # what parse_record used to do for every start and end date
+    return [datetime.strptime(s, '%Y-%m-%d %H:%M:%S %z') for s in timestamp_strings]
+
+
+def records_per_second(func, timestamp_strings):
+    start = time.perf_counter()
+    func(timestamp_strings)
+    return len(timestamp_strings) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    timestamp_strings = make_timestamps(count)
+    before = records_per_second(strptime_per_record, timestamp_strings)
+    after = records_per_second(parse_timestamps, timestamp_strings)
+    print(f'records:             {count:,}')
+    print(f'strptime per record: {before:,.0f} records/sec')
+    print(f'parse_timestamps:    {after:,.0f} records/sec ({after / before:.1f}x)')
@@ -0,0 +1,225 @@
+'''
+Write a synthetic Apple Health export.xml with the record types AppleWatchData loads
+
+Records are grouped by type and in time order within a type, as in real exports. Rates per day follow
+a typical Apple Watch wearer, so the number of days covered grows with the number of records.
+Workouts follow the records; with --routes their GPX files are written to workout-routes/ next to
+the export, as in the export archive.
+
+usage: python benchmarks/generate_export.py export.xml [number of records] [seed] [--routes]
+'''
+import argparse
+import math
+import os
+import random
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE HealthData [
+<!ELEMENT HealthData (ExportDate,Me,(Record|Correlation|Workout|ActivitySummary)*)>
+<!ELEMENT Record ((MetadataEntry|HeartRateVariabilityMetadataList)*)>
+]>
+<HealthData locale="en_US">
+ <ExportDate value="{export_date}"/>
+ <Me HKCharacteristicTypeIdentifierDateOfBirth="1988-04-12" HKCharacteristicTypeIdentifierBiologicalSex="HKBiologicalSexFemale" HKCharacteristicTypeIdentifierBloodType="HKBloodTypeNotSet" HKCharacteristicTypeIdentifierFitzpatrickSkinType="HKFitzpatrickSkinTypeNotSet" HKCharacteristicTypeIdentifierCardioFitnessMedicationsUse="None"/>
+'''
+FOOTER = '</HealthData>\n'
+SOURCE = 'sourceName="Apple Watch" sourceVersion="10.1" device="&lt;&lt;HKDevice: 0x0&gt;, name:Apple Watch, manufacturer:Apple Inc., model:Watch, hardware:Watch6,2, software:10.1&gt;"'
+
+# record type -> (records per day, unit, seconds covered by one record, value generator)
+RECORD_TYPES = {
+    'HKQuantityTypeIdentifierHeartRate': (300, 'count/min', 0, lambda r: f'{r.gauss(75, 12):.0f}'),
+    'HKQuantityTypeIdentifierHeartRateVariabilitySDNN': (6, 'ms', 60, lambda r: f'{r.lognormvariate(3.7, 0.4):.3f}'),
+    'HKQuantityTypeIdentifierRestingHeartRate': (1, 'count/min', 0, lambda r: f'{r.gauss(60, 4):.0f}'),
+    'HKQuantityTypeIdentifierWalkingHeartRateAverage': (1, 'count/min', 0, lambda r: f'{r.gauss(100, 8):.1f}'),
+    'HKQuantityTypeIdentifierDistanceWalkingRunning': (100, 'mi', 120, lambda r: f'{r.expovariate(40):.5f}'),
+    'HKQuantityTypeIdentifierBasalEnergyBurned': (120, 'Cal', 600, lambda r: f'{r.uniform(8, 14):.3f}'),
+    'HKCategoryTypeIdentifierAppleStandHour': (24, None, 3600, lambda r: r.choice(
+        ('HKCategoryValueAppleStandHourIdle', 'HKCategoryValueAppleStandHourStood', 'HKCategoryValueAppleStandHourStood'))),
+    'HKQuantityTypeIdentifierStepCount': (100, 'count', 120, lambda r: f'{r.randint(1, 300)}'),
+    'HKQuantityTypeIdentifierBodyMass': (0.1, 'lb', 0, lambda r: f'{r.gauss(150, 2):.1f}'),
+    'HKQuantityTypeIdentifierHeight': (0.01, 'ft', 0, lambda r: '5.6'),
+}
+SLEEP_TYPE = 'HKCategoryTypeIdentifierSleepAnalysis'
+IPHONE_SOURCE = 'sourceName="iPhone" sourceVersion="17.1"'
+# watch sleep stages and their typical minutes per segment, cycled through the night
+SLEEP_CYCLE = (('AsleepCore', 25), ('AsleepDeep', 20), ('AsleepCore', 15), ('AsleepREM', 20), ('Awake', 2))
+# watch segments per night, plus the phone's in-bed segment
+SLEEP_RECORDS_PER_DAY = 36
+# chance of a run on any day
+WORKOUT_CHANCE = 0.6
+RECORDS_PER_DAY = sum(rate for rate, _, _, _ in RECORD_TYPES.values()) + SLEEP_RECORDS_PER_DAY
+START = datetime(2021, 1, 1)
+TIMEZONE = ZoneInfo('America/Chicago')
+
+
+def utc_offset(moment):
+    # US Central time, daylight saving time included
+    return f'{moment.replace(tzinfo=TIMEZONE):%z}'
+
+
+def format_date(moment):
+    # round trip through UTC, so times in the hour skipped when the clocks go forward move past it
+    local = moment.replace(tzinfo=TIMEZONE).astimezone(timezone.utc).astimezone(TIMEZONE)
+    return f'{local:%Y-%m-%d %H:%M:%S %z}'
+
+
+def beats_metadata(rng, start):
+    lines = ['  <HeartRateVariabilityMetadataList>']
+    moment = start
+    for _ in range(rng.randint(40, 70)):
+        moment += timedelta(seconds=rng.uniform(0.6, 1.2))
+        lines.append(f'   <InstantaneousBeatsPerMinute bpm="{rng.randint(55, 95)}" '
+                     f'time="{moment:%I:%M:%S}.{moment.microsecond // 10000:02d} {moment:%p}"/>')
+    lines.append('  </HeartRateVariabilityMetadataList>')
+    return '\n'.join(lines) + '\n'
+
+
+def write_records(f, rng, record_type, count, days):
+    rate, unit, duration, value = RECORD_TYPES[record_type]
+    unit_attribute = f' unit="{unit}"' if unit else ''
+    step = days * 86400 / max(count, 1)
+    for i in range(count):
+        if record_type == 'HKCategoryTypeIdentifierAppleStandHour':
+            start = START + timedelta(hours=i)
+        else:
+            start = START + timedelta(seconds=int(i * step + rng.uniform(0, step)))
+        end = start + timedelta(seconds=duration)
+        created = end + timedelta(seconds=rng.randint(1, 600))
+        f.write(f' <Record type="{record_type}" {SOURCE}{unit_attribute} creationDate="{format_date(created)}" '
+                f'startDate="{format_date(start)}" endDate="{format_date(end)}" value="{value(rng)}"')
+        if record_type == 'HKQuantityTypeIdentifierHeartRateVariabilitySDNN':
+            f.write('>\n' + beats_metadata(rng, start) + ' </Record>\n')
+        elif record_type == 'HKQuantityTypeIdentifierHeartRate':
+            f.write('>\n  <MetadataEntry key="HKMetadataKeyHeartRateMotionContext" value="0"/>\n </Record>\n')
+        else:
+            f.write('/>\n')
+
+
+def write_sleep_record(f, source, start, end, stage):
+    f.write(f' <Record type="{SLEEP_TYPE}" {source} creationDate="{format_date(end + timedelta(minutes=5))}" '
+            f'startDate="{format_date(start)}" endDate="{format_date(end)}" '
+            f'value="HKCategoryValueSleepAnalysis{stage}"/>\n')
+
+
+def write_sleep(f, rng, days):
+    """
+    One night per day: the phone's in-bed segment, overlapped by the watch's stage segments,
+    which may start before it and run past it
+    """
+    count = 0
+    for day in range(days):
+        bedtime = START + timedelta(days=day, hours=22, minutes=rng.randint(0, 120))
+        moment = bedtime + timedelta(minutes=rng.randint(-10, 20))
+        stages = []
+        for _ in range(SLEEP_RECORDS_PER_DAY - 1):
+            stage, minutes = SLEEP_CYCLE[len(stages) % len(SLEEP_CYCLE)]
+            end = moment + timedelta(minutes=max(1, rng.gauss(minutes, minutes / 3)))
+            stages.append((moment, end, stage))
+            moment = end
+        wake = moment + timedelta(minutes=rng.randint(-20, 10))
+        write_sleep_record(f, IPHONE_SOURCE, bedtime, wake, 'InBed')
+        for start, end, stage in stages:
+            write_sleep_record(f, SOURCE, start, end, stage)
+        count += len(stages) + 1
+    return count
+
+
+def write_route(file_path, rng, start, seconds):
+    # a loop around a point in Austin at a steady pace, one point per second
+    latitude, longitude = 30.2672 + rng.uniform(-0.05, 0.05), -97.7431 + rng.uniform(-0.05, 0.05)
+    radius = 0.002 + rng.uniform(0, 0.01)
+    with open(file_path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.1" creator="Apple Health Export" '
+                'xmlns="http://www.topografix.com/GPX/1/1">\n <trk>\n  <name>Route</name>\n  <trkseg>\n')
+        elevation = rng.uniform(100, 200)
+        # GPX times are in UTC
+        utc_start = start - timedelta(hours=int(utc_offset(start)[:3]))
+        for second in range(seconds):
+            angle = 2 * math.pi * second / seconds
+            elevation += rng.gauss(0, 0.2)
+            moment = utc_start + timedelta(seconds=second)
+            f.write(f'   <trkpt lon="{longitude + radius * math.cos(angle):.6f}" '
+                    f'lat="{latitude + radius * math.sin(angle):.6f}"><ele>{elevation:.3f}</ele>'
+                    f'<time>{moment:%Y-%m-%dT%H:%M:%S}Z</time><extensions><speed>{rng.uniform(2.5, 3.5):.2f}</speed>'
+                    f'<hAcc>{rng.uniform(1, 5):.1f}</hAcc></extensions></trkpt>\n')
+        f.write('  </trkseg>\n </trk>\n</gpx>\n')
+
+
+def write_workouts(f, rng, days, route_dir=None):
+    """
+    Morning runs on about WORKOUT_CHANCE of the days, with statistics, a pause and a route reference
+
+    :param route_dir: directory the GPX files are written to, or None to only reference them
+    :return: number of workouts written
+    """
+    count = 0
+    for day in range(days):
+        if rng.random() > WORKOUT_CHANCE:
+            continue
+        start = START + timedelta(days=day, hours=6, minutes=rng.randint(0, 90))
+        seconds = rng.randint(20, 60) * 60
+        end = start + timedelta(seconds=seconds)
+        route = f'/workout-routes/route_{start:%Y-%m-%d_%I.%M%p}.gpx'.lower()
+        miles = seconds / 600
+        f.write(f' <Workout workoutActivityType="HKWorkoutActivityTypeRunning" duration="{seconds / 60:.2f}" '
+                f'durationUnit="min" {SOURCE} creationDate="{format_date(end)}" startDate="{format_date(start)}" '
+                f'endDate="{format_date(end)}">\n'
+                f'  <MetadataEntry key="HKIndoorWorkout" value="0"/>\n'
+                f'  <WorkoutEvent type="HKWorkoutEventTypePause" date="{format_date(start + timedelta(seconds=seconds // 2))}" '
+                f'duration="0" durationUnit="min"/>\n'
+                f'  <WorkoutEvent type="HKWorkoutEventTypeResume" date="{format_date(start + timedelta(seconds=seconds // 2 + 30))}" '
+                f'duration="0" durationUnit="min"/>\n'
+                f'  <WorkoutStatistics type="HKQuantityTypeIdentifierActiveEnergyBurned" startDate="{format_date(start)}" '
+                f'endDate="{format_date(end)}" sum="{miles * rng.uniform(90, 110):.3f}" unit="Cal"/>\n'
+                f'  <WorkoutStatistics type="HKQuantityTypeIdentifierDistanceWalkingRunning" startDate="{format_date(start)}" '
+                f'endDate="{format_date(end)}" sum="{miles:.4f}" unit="mi"/>\n'
+                f'  <WorkoutStatistics type="HKQuantityTypeIdentifierHeartRate" startDate="{format_date(start)}" '
+                f'endDate="{format_date(end)}" average="{rng.gauss(150, 8):.1f}" minimum="{rng.gauss(110, 8):.0f}" '
+                f'maximum="{rng.gauss(175, 5):.0f}" unit="count/min"/>\n'
+                f'  <WorkoutRoute {SOURCE} creationDate="{format_date(end)}" startDate="{format_date(start)}" '
+                f'endDate="{format_date(end)}">\n'
+                f'   <FileReference path="{route}"/>\n'
+                f'  </WorkoutRoute>\n'
+                f' </Workout>\n')
+        if route_dir is not None:
+            write_route(os.path.join(route_dir, os.path.basename(route)), rng, start, seconds)
+        count += 1
+    return count
+
+
+def generate_export(file_path, records=100_000, seed=0, routes=False):
+    """
+    :param file_path: export.xml to write
+    :param records: approximate number of Record elements
+    :param seed: random seed, so the same arguments always write the same file
+    :param routes: also write the workouts' GPX files to workout-routes/ next to file_path
+    :return: number of records written
+    """
+    rng = random.Random(seed)
+    days = max(1, round(records / RECORDS_PER_DAY))
+    counts = {record_type: max(1, round(rate * days)) for record_type, (rate, _, _, _) in RECORD_TYPES.items()}
+    with open(file_path, 'w', buffering=1 << 20) as f:
+        f.write(HEADER.format(export_date=format_date(START + timedelta(days=days))))
+        for record_type, count in counts.items():
+            write_records(f, rng, record_type, count, days)
+        sleep_records = write_sleep(f, rng, days)
+        route_dir = None
+        if routes:
+            route_dir = os.path.join(os.path.dirname(os.path.abspath(file_path)), 'workout-routes')
+            os.makedirs(route_dir, exist_ok=True)
+        write_workouts(f, rng, days, route_dir)
+        f.write(FOOTER)
+    return sum(counts.values()) + sleep_records
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('file_path', help='export.xml to write')
+    parser.add_argument('records', nargs='?', type=int, default=100_000, help='approximate number of records')
+    parser.add_argument('seed', nargs='?', type=int, default=0, help='random seed')
+    parser.add_argument('--routes', action='store_true', help="also write the workouts' GPX files")
+    args = parser.parse_args()
+    written = generate_export(args.file_path, args.records, args.seed, routes=args.routes)
+    print(f'{written:,} records over {max(1, round(args.records / RECORDS_PER_DAY))} days written to {args.file_path}')
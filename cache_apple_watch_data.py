@@ -0,0 +1,158 @@
+'''
+Content-addressed Parquet cache of parsed Apple Watch exports
+'''
+import os
+import json
+import hashlib
+import threading
+from contextlib import contextmanager
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks on Windows; the cache is then only locked against the threads of one process
+    fcntl = None
+
+from stage_timing import timings
+
+# bump whenever loaders change what they return, so stale cached frames are never served
+CACHE_VERSION = 9
+# (path, size, mtime) -> content hash, so an unchanged upload is only hashed once per process
+_content_hashes = {}
+# cache directory -> lock held by the thread of this process ingesting into it
+_directory_locks = {}
+_directory_locks_lock = threading.Lock()
+
+
+def hash_file(file_path, chunk_size=1 << 20):
+    """
+    SHA-256 of a file's contents, read in chunks
+
+    :param file_path: path of the export
+    :param chunk_size: bytes read per step
+    :return: hex digest
+    """
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    if key not in _content_hashes:
+        digest = hashlib.sha256()
+        with timings.span('content_hash') as span, open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+            span.items = stat.st_size
+        _content_hashes[key] = digest.hexdigest()
+    return _content_hashes[key]
+
+
+@contextmanager
+def atomic_path(path):
+    """
+    Temporary path to write a file at, renamed over path once the block completes, so readers in other
+    threads and processes never see a partial file; it is removed instead if the block fails
+
+    :param path: file to replace
+    """
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def remember_hash(file_path, content_hash):
+    """
+    Record the hash of a file computed elsewhere, e.g. while it was uploaded, so hash_file never reads it
+    """
+    stat = os.stat(file_path)
+    _content_hashes[(os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)] = content_hash
+
+
+class ParquetCache:
+    """
+    One directory per export content hash, holding a zstd-compressed Parquet file per metric
+    and a manifest.json of metrics without records and other small parsed values.
+
+    With a key, the directory is shared by every export it identifies (e.g. all exports of one user),
+    and the manifest's content_hashes tell which of them the cached frames hold every record of.
+    """
+    def __init__(self, cache_dir, xml_data_file_path, content_hash=None, key=None):
+        self.content_hash = content_hash or hash_file(xml_data_file_path)
+        self.path = os.path.join(os.path.expanduser(cache_dir), f'{key or self.content_hash}-v{CACHE_VERSION}')
+        os.makedirs(self.path, exist_ok=True)
+        self.manifest = self.read_manifest()
+
+    @contextmanager
+    def lock(self):
+        """
+        Hold the directory exclusively, against other threads and, where fcntl exists, other processes,
+        e.g. while ingesting into it
+        """
+        with _directory_locks_lock:
+            thread_lock = _directory_locks.setdefault(self.path, threading.Lock())
+        with thread_lock, open(os.path.join(self.path, '.lock'), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            # closing the file releases the flock
+            yield
+
+    def reload(self):
+        """
+        Re-read the manifest, which another thread or process may have moved on since it was read
+        """
+        self.manifest = self.read_manifest()
+
+    def metric_path(self, metric):
+        return os.path.join(self.path, f'{metric}.parquet')
+
+    def read_manifest(self):
+        try:
+            with open(os.path.join(self.path, 'manifest.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'missing': []}
+
+    def write_manifest(self):
+        with atomic_path(os.path.join(self.path, 'manifest.json')) as tmp_path, open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f)
+
+    def get(self, key, default=None):
+        return self.manifest.get(key, default)
+
+    def set(self, key, value):
+        self.manifest[key] = value
+        self.write_manifest()
+
+    def update(self, values):
+        """
+        Set several manifest values in one write, so readers see all of them change or none
+        """
+        self.manifest.update(values)
+        self.write_manifest()
+
+    def has(self, metric):
+        return metric in self.manifest['missing'] or os.path.exists(self.metric_path(metric))
+
+    def read(self, metric):
+        """
+        Memory-map a cached metric
+
+        :raises IndexError: if the export has no records for the metric, like the loaders do
+        """
+        if metric in self.manifest['missing']:
+            raise IndexError(f'No {metric} records found')
+        return pd.read_parquet(self.metric_path(metric), memory_map=True)
+
+    def write(self, metric, df):
+        with atomic_path(self.metric_path(metric)) as tmp_path:
+            df.to_parquet(tmp_path, compression='zstd')
+        if metric in self.manifest['missing']:
+            self.manifest['missing'].remove(metric)
+            self.write_manifest()
+
+    def write_missing(self, metric):
+        if metric not in self.manifest['missing']:
+            self.manifest['missing'].append(metric)
+            self.write_manifest()
@@ -0,0 +1,64 @@
+'''
+Process-level LRU cache of loaded metric DataFrames with a memory budget
+'''
+import threading
+from collections import OrderedDict
+
+
+class DataFrameCache:
+    """
+    Loaded DataFrames keyed by (upload, metric), evicted least recently used first
+    once their combined size passes max_bytes.
+
+    Frames are handed out as shallow copies, so callers adding columns never change the cached frame.
+    """
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            df = self.frames.get(key)
+            if df is None:
+                self.misses += 1
+                return None
+            self.frames.move_to_end(key)
+            self.hits += 1
+        return df.copy(deep=False)
+
+    def put(self, key, df):
+        size = int(df.memory_usage(deep=True).sum())
+        with self.lock:
+            self.remove(key)
+            if size > self.max_bytes:
+                return
+            while self.total_bytes + size > self.max_bytes:
+                self.remove(next(iter(self.frames)))
+                self.evictions += 1
+            self.frames[key] = df
+            self.sizes[key] = size
+            self.total_bytes += size
+
+    def remove(self, key):
+        if key in self.frames:
+            del self.frames[key]
+            self.total_bytes -= self.sizes.pop(key)
+
+    def invalidate(self, upload):
+        """
+        Drop every metric of one upload, e.g. when its session uploads a new file
+        """
+        with self.lock:
+            for key in [key for key in self.frames if key[0] == upload]:
+                self.remove(key)
+
+    def stats(self):
+        with self.lock:
+            return {'frames': len(self.frames), 'bytes': self.total_bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
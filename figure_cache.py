@@ -0,0 +1,126 @@
+'''
+LRU cache of serialized dashboard figures, in memory and on local disk
+'''
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from cache_apple_watch_data import atomic_path
+
+logger = logging.getLogger(__name__)
+
+
+class FigureCache:
+    """
+    Serialized figure JSON keyed by (upload content hash, panel, start, end, resolution),
+    evicted least recently used first once its size passes max_bytes.
+
+    With a cache_dir, entries are also written there, one file per key, so worker processes
+    serving the same uploads share them; the directory is pruned of its least recently used files
+    once they pass max_disk_bytes.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, cache_dir=None, max_disk_bytes=1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.cache_dir = os.path.expanduser(cache_dir) if cache_dir else None
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self.figures = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def file_path(self, key):
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f'{digest}.json')
+
+    def get(self, key):
+        """
+        :return: the figure JSON, or None if neither tier has it
+        """
+        with self.lock:
+            figure_json = self.figures.get(key)
+            if figure_json is not None:
+                self.figures.move_to_end(key)
+                self.hits += 1
+                return figure_json
+        figure_json = self.read_file(key) if self.cache_dir else None
+        with self.lock:
+            if figure_json is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self.remember(key, figure_json)
+        return figure_json
+
+    def put(self, key, figure_json):
+        with self.lock:
+            self.remember(key, figure_json)
+        if self.cache_dir:
+            self.write_file(key, figure_json)
+
+    def remember(self, key, figure_json):
+        if key in self.figures:
+            self.total_bytes -= len(self.figures.pop(key))
+        if len(figure_json) > self.max_bytes:
+            return
+        while self.total_bytes + len(figure_json) > self.max_bytes:
+            _, evicted = self.figures.popitem(last=False)
+            self.total_bytes -= len(evicted)
+            self.evictions += 1
+        self.figures[key] = figure_json
+        self.total_bytes += len(figure_json)
+
+    def read_file(self, key):
+        path = self.file_path(key)
+        try:
+            with open(path, 'rb') as f:
+                figure_json = f.read()
+            # the access time of a file is not reliably kept, so its mtime marks when it was last used
+            os.utime(path)
+        except OSError:
+            return None
+        return figure_json
+
+    def write_file(self, key, figure_json):
+        try:
+            with atomic_path(self.file_path(key)) as tmp_path, open(tmp_path, 'wb') as f:
+                f.write(figure_json)
+            self.prune()
+        except OSError as e:
+            logger.warning(f'Could not cache figures on disk: {e}')
+
+    def prune(self):
+        """
+        Delete the least recently used files until the directory is within max_disk_bytes
+        """
+        entries = []
+        with os.scandir(self.cache_dir) as files:
+            for entry in files:
+                if entry.name.endswith('.json'):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # another process pruned it first
+                pass
+            total -= size
+
+    def stats(self):
+        with self.lock:
+            return {'figures': len(self.figures), 'bytes': self.total_bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'evictions': self.evictions}
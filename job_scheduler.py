@@ -0,0 +1,138 @@
+'''
+Bounded background job scheduler, keeping one active job per browser session
+'''
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, session_id):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.status = 'queued'
+        self.progress = 0
+        self.message = ''
+        self.result = None
+        self.error = None
+        self.future = None
+        self.cancelled = threading.Event()
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    def finish(self, status):
+        self.finished_at = time.monotonic()
+        self.status = status
+
+    def update(self, progress, message=''):
+        """
+        Report progress from inside the job
+
+        :param progress: percentage done
+        :param message: what the job is working on
+        :raises JobCancelled: once the job has been cancelled, so the work stops at the next step
+        """
+        if self.cancelled.is_set():
+            raise JobCancelled()
+        self.progress = progress
+        self.message = message
+
+
+class JobScheduler:
+    """
+    Runs jobs on a fixed pool of worker threads, off the web request threads.
+
+    Each session id (or any other key, such as a session's dashboard panel) has at most one active job:
+    submitting again cancels the previous one, so one user's clicks never wait behind another user's work.
+    Finished jobs whose results were never collected, e.g. of sessions closed before polling,
+    are dropped finished_ttl seconds after they finish.
+    """
+    def __init__(self, max_workers=2, max_queued=8, finished_ttl=600):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.max_queued = max_queued
+        self.finished_ttl = finished_ttl
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, session_id, func, *args, replace=True):
+        """
+        Queue func(job, *args) for a session
+
+        :param replace: cancel the session's active job; otherwise return that job and queue nothing
+        :raises QueueFull: if max_queued jobs are already waiting for a worker
+        :return: Job
+        """
+        with self.lock:
+            self.prune()
+            previous = self.jobs.get(session_id)
+            if previous is not None and not previous.finished:
+                if not replace:
+                    return previous
+                self.cancel_job(previous)
+            queued = sum(1 for job in self.jobs.values() if job.status == 'queued')
+            if queued >= self.max_queued:
+                raise QueueFull(f'{queued} jobs are already waiting')
+            job = Job(session_id)
+            self.jobs[session_id] = job
+            job.future = self.executor.submit(self.run, job, func, *args)
+        return job
+
+    def prune(self):
+        expired = time.monotonic() - self.finished_ttl
+        for key, job in list(self.jobs.items()):
+            if job.finished_at is not None and job.finished_at < expired:
+                del self.jobs[key]
+
+    def run(self, job, func, *args):
+        if job.cancelled.is_set():
+            job.finish('cancelled')
+            return
+        job.status = 'running'
+        try:
+            job.result = func(job, *args)
+            job.progress = 100
+            job.finish('done')
+        except JobCancelled:
+            job.finish('cancelled')
+        except Exception as e:
+            logger.exception('Job %s failed', job.id)
+            job.error = str(e)
+            job.finish('failed')
+
+    def cancel_job(self, job):
+        job.cancelled.set()
+        if job.future is not None and job.future.cancel():
+            job.finish('cancelled')
+
+    def cancel(self, session_id):
+        with self.lock:
+            job = self.jobs.get(session_id)
+        if job is not None and not job.finished:
+            self.cancel_job(job)
+        return job
+
+    def get(self, session_id):
+        return self.jobs.get(session_id)
+
+    def discard(self, job):
+        """
+        Forget a finished job once its result has been delivered
+        """
+        with self.lock:
+            if self.jobs.get(job.session_id) is job:
+                del self.jobs[job.session_id]
@@ -4,6 +4,7 @@ Visualizing Apple Watch Health Data w/ Plotly
 import os
 from datetime import datetime
 import logging
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 from read_apple_watch_data import *
@@ -12,6 +13,74 @@ from read_apple_watch_data import *
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def min_max_downsample(values, max_points):
+    """
+    Pick at most max_points samples of a series while keeping its visual shape
+
+    The series is cut into max_points // 2 equal buckets and the minimum and maximum
+    sample of each bucket are kept, so peaks and troughs survive.
+
+    :param values: numeric values in plotting order
+    :param max_points: point budget
+    :return: sorted positions of the samples to keep
+    """
+    values = np.asarray(values, dtype=float)
+    count = len(values)
+    if count <= max_points:
+        return np.arange(count)
+
+    buckets = max(max_points // 2, 1)
+    bucket_size = -(-count // buckets)
+    padded = np.full(buckets * bucket_size, np.nan)
+    padded[:count] = values
+    padded = padded.reshape(buckets, bucket_size)
+    missing = np.isnan(padded)
+    lowest = np.where(missing, np.inf, padded).argmin(axis=1)
+    highest = np.where(missing, -np.inf, padded).argmax(axis=1)
+
+    offsets = np.arange(buckets) * bucket_size
+    keep = np.unique(np.concatenate([offsets + lowest, offsets + highest]))
+    return keep[keep < count]
+
+def daily_traces(df, column, scatter=go.Scatter, colors=None, label='BPM'):
+    """
+    Superpose one day per marker trace, x being the time of day, in a single pass over the samples
+
+    Each day's samples are one slice of the frame sorted by day, and the hover text is a template
+    filled in by the browser rather than a string per point.
+
+    :param df: data frame with tz-aware start_timestamp, plotted in its own time zone
+    :param column: column plotted on the y axis
+    :param scatter: go.Scatter, or go.Scattergl for many points
+    :param colors: palette cycled through the days, Plotly's default colours if None
+    :param label: name of the y values in the hover text
+    :return: list of traces in date order
+    """
+    # wall-clock time in the export's time zone, as strftime would print it
+    local = df['start_timestamp'].dt.tz_localize(None).to_numpy(dtype='datetime64[s]')
+    days = local.astype('datetime64[D]')
+    order = np.argsort(days, kind='stable')
+    local, days, values = local[order], days[order], df[column].to_numpy()[order]
+    # 'YYYY-MM-DDTHH:MM:SS' -> 'HH:MM:SS', by viewing the strings as rows of characters
+    characters = np.datetime_as_string(local, unit='s').view('U1').reshape(len(local), -1)
+    times = np.ascontiguousarray(characters[:, 11:19]).view('U8').ravel()
+
+    starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+    ends = np.r_[starts[1:], len(days)]
+    traces = []
+    for idx, (first, last) in enumerate(zip(starts, ends)):
+        date = pd.Timestamp(days[first]).strftime('%m/%d/%y')
+        marker = dict(color=colors[idx % len(colors)]) if colors else None
+        traces.append(scatter(
+            x=times[first:last],
+            y=values[first:last],
+            mode='markers',
+            marker=marker,
+            name=date,
+            hovertemplate=f'Date: {date}, Time: %{{x}}, {label}: %{{y}}<extra></extra>'
+        ))
+    return traces
+
 def plot_heart_rate(apple_watch):
     """
     Superposition multiple time series plots of heart data
@@ -21,17 +90,10 @@ def plot_heart_rate(apple_watch):
     """
     logger.info('Loading and Plotting Heart Rate Data')
     df = apple_watch.load_heart_rate_data()
-    df = df[(df['start_timestamp'] > START_DATE) & (df['start_timestamp'] < END_DATE)]
-    df['date'] = list(map(lambda dt: dt.strftime('%m/%d/%y'), df['start_timestamp']))
-    df['time'] = list(map(lambda d: d.time(), df['start_timestamp']))
-
-    fig = go.Figure()
+    df = time_range(df, START_DATE, END_DATE)
 
     # superpose time series plots for each date
-    dates = df['date'].unique()
-    for idx, dt in enumerate(dates):
-        sub_df = df[df['date'] == dt][['time', 'heart_rate']]
-        fig.add_trace(go.Scatter(x=sub_df['time'], y=sub_df['heart_rate'], mode='markers', name=dt))
+    fig = go.Figure(data=daily_traces(df, 'heart_rate'))
 
     fig.update_layout(
         title='Apple Watch Heart Rate Data',
@@ -51,7 +113,7 @@ def plot_heart_rate_variability(apple_watch):
     """
     logger.info('Loading and Plotting Heart Rate Variability Data')
     df = apple_watch.load_heart_rate_variability_data()
-    df = df[(df['start_timestamp'] > START_DATE) & (df['start_timestamp'] < END_DATE)]
+    df = time_range(df, START_DATE, END_DATE)
     df['date'] = list(map(lambda d: d.strftime('%m/%d/%y'), df['start_timestamp']))
     df['time'] = list(map(lambda d: d.strftime('%H:%M:%S'), df['start_timestamp']))
     dates = list(df['date'].unique())
@@ -84,3 +146,7 @@ def run(apple_watch, start_date, end_date, show_plots):
     except Exception as e:
         logger.error('Unrecognized date format...raising ValueError.')
         raise ValueError()
+
+    # loaded timestamps are tz-aware, so compare them in the export's time zone
+    START_DATE = pd.Timestamp(START_DATE, tz=apple_watch.timezone)
+    END_DATE = pd.Timestamp(END_DATE, tz=apple_watch.timezone)
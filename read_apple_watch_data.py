@@ -1,205 +1,1537 @@
 import os
-from datetime import datetime
+import mmap
+import multiprocessing
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, wraps
+from zoneinfo import ZoneInfo, available_timezones
 import pandas as pd
 import xml.etree.ElementTree as ET
 import numpy as np
 
+from cache_apple_watch_data import ParquetCache
+from stage_timing import timings
+
+# attributes kept per record when streaming; everything else is dropped on ingest
+RECORD_ATTRIBUTES = ('startDate', 'endDate', 'value')
+# record types whose InstantaneousBeatsPerMinute children are kept as a beats table
+METADATA_TYPES = ('HKQuantityTypeIdentifierHeartRateVariabilitySDNN',)
+# columns of the beats table: parent record, bpm and local time of day as exported
+BEAT_ATTRIBUTES = ('record', 'bpm', 'time')
+# metric name -> loader, used by load_metrics
+METRIC_LOADERS = {
+    'heart_rate': 'load_heart_rate_data',
+    'heart_rate_variability': 'load_heart_rate_variability_data',
+    'resting_heart_rate': 'load_resting_heart_rate_data',
+    'walking_heart_rate': 'load_walking_heart_rate_data',
+    'distance': 'load_distance_data',
+    'basal_energy': 'load_basal_energy_data',
+    'stand_hour': 'load_stand_hour_data',
+    'steps': 'load_step_data',
+    'heart_rate_beats': 'load_heart_rate_beats_data',
+    'sleep': 'load_sleep_data',
+    'workouts': 'load_workout_data',
+    'workout_statistics': 'load_workout_statistics_data',
+    'workout_events': 'load_workout_events_data',
+}
+# metric -> (metric whose index labels one of its columns, that column)
+PARENT_METRICS = {
+    'heart_rate_beats': ('heart_rate_variability', 'record'),
+    'workout_statistics': ('workouts', 'workout'),
+    'workout_events': ('workouts', 'workout'),
+}
+# metric -> value column summed into the date x hour rollups behind the heatmaps
+ROLLUP_COLUMNS = {
+    'distance': 'distance_walk_run',
+    'basal_energy': 'energy_burned',
+    'stand_hour': 'stand_hour',
+    'steps': 'steps',
+}
+# smaller exports are parsed in-process even when workers are requested
+PARALLEL_MIN_BYTES = 64 * 1024 * 1024
+# byte ranges per worker process, so uneven ranges still balance out
+RANGES_PER_WORKER = 4
+# local part of an export timestamp; the UTC offset follows after a space
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+# tz-aware columns of the loaded metrics, converted to the instance's time zone
+TIMESTAMP_COLUMNS = ('start_timestamp', 'end_timestamp', 'timestamp')
+# time of day of an instantaneous beat, 12-hour in most locales, 24-hour in the rest
+BEAT_TIME_FORMATS = ('%I:%M:%S.%f %p', '%H:%M:%S.%f')
+# a beat this far before its measurement's start was recorded after midnight
+BEAT_ROLLOVER = pd.Timedelta(hours=12)
+# top-level element of a workout, read alongside the records
+WORKOUT_TAG = 'Workout'
+# attributes kept per workout, plus 'route', the path of its GPX file as the export refers to it
+WORKOUT_ATTRIBUTES = ('workoutActivityType', 'duration', 'durationUnit', 'sourceName', 'startDate', 'endDate',
+                      'route')
+# columns of the WorkoutStatistics and WorkoutEvent tables; 'workout' is the parent's row among the workouts
+WORKOUT_STATISTIC_ATTRIBUTES = ('workout', 'type', 'sum', 'average', 'minimum', 'maximum', 'unit')
+WORKOUT_EVENT_ATTRIBUTES = ('workout', 'type', 'date', 'duration', 'durationUnit')
+# duration unit -> minutes
+DURATION_MINUTES = {'s': 1 / 60, 'min': 1, 'hr': 60}
+# sleep analysis value -> stage; 'Asleep' is sleep of no particular stage, as older exports
+# and most third-party sources record it
+SLEEP_STAGES = {
+    'HKCategoryValueSleepAnalysisInBed': 'In Bed',
+    'HKCategoryValueSleepAnalysisAsleep': 'Asleep',
+    'HKCategoryValueSleepAnalysisAsleepUnspecified': 'Asleep',
+    'HKCategoryValueSleepAnalysisAwake': 'Awake',
+    'HKCategoryValueSleepAnalysisAsleepREM': 'REM',
+    'HKCategoryValueSleepAnalysisAsleepCore': 'Core',
+    'HKCategoryValueSleepAnalysisAsleepDeep': 'Deep',
+}
+# where segments overlap the first stage listed wins: measured stages over unspecified sleep,
+# anything over plain time in bed
+SLEEP_STAGE_PRIORITY = ('Deep', 'REM', 'Core', 'Awake', 'Asleep', 'In Bed')
+# stage -> its column in the nightly summary
+SLEEP_STAGE_COLUMNS = {'Awake': 'awake', 'REM': 'rem', 'Core': 'core', 'Deep': 'deep', 'Asleep': 'asleep_unspecified'}
+ASLEEP_STAGES = ('REM', 'Core', 'Deep', 'Asleep')
+# nights run from noon to noon and are labelled by the date they end on
+NIGHT_SHIFT = pd.Timedelta(hours=12)
+# timestamps sampled from an export to find the time zone it was recorded in, by their dates and offsets
+TIMEZONE_SAMPLES = 200000
+# changes of UTC offset checked against every candidate zone before its offsets are compared in full
+TIMEZONE_CHANGES_CHECKED = 64
+
+
+@lru_cache(maxsize=None)
+def parse_utc_offset(offset):
+    """
+    Convert an export UTC offset such as '-0600' to a timedelta.
+
+    An export only holds a handful of distinct offsets, so each one is parsed once.
+    """
+    sign = -1 if offset.startswith('-') else 1
+    return sign * timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5]))
+
+
+def parse_timestamps(timestamp_strings, tz=None):
+    """
+    Convert a column of export timestamps to tz-aware datetime64 values in bulk
+
+    :param timestamp_strings: strings like '2023-01-01 10:00:00 -0600'
+    :param tz: time zone of the result, defaults to the most common offset in the column
+    :return: datetime64[ns, tz] Series
+    """
+    strings = pd.Series(timestamp_strings, dtype=object)
+    local = pd.to_datetime(strings.str[:19], format=DATE_FORMAT)
+    offsets = pd.Categorical(strings.str[20:])
+    deltas = np.array([parse_utc_offset(offset) for offset in offsets.categories], dtype='timedelta64[ns]')
+    utc = (local - deltas[offsets.codes]).dt.tz_localize('UTC')
+    if tz is None:
+        tz = timezone(parse_utc_offset(offsets.categories[np.bincount(offsets.codes).argmax()]))
+    return utc.dt.tz_convert(tz)
+
+
+def offset_days(timestamp_strings):
+    """
+    Local dates an export has timestamps on, each with the UTC offsets it was recorded in
+
+    :param timestamp_strings: strings like '2023-01-01 10:00:00 -0600', in any order
+    :return: set of strings like '2023-01-01 -0600'
+    """
+    return {string[:10] + string[19:] for string in timestamp_strings if string}
+
+
+def infer_timezone(days):
+    """
+    Find the time zone an export was recorded in, so local dates and hours stay right across
+    daylight saving changes
+
+    Every timestamp carries its own UTC offset; the IANA zone whose offsets agree with the most of them
+    wins, or the most common fixed offset when the export never changes offset or no zone fits better.
+
+    :param days: dates and offsets as offset_days returns them; one per day is enough to see every change
+    :return: ZoneInfo, or a fixed-offset datetime.timezone
+    """
+    days = pd.Series(sorted(days), dtype=object)
+    if days.empty:
+        return timezone.utc
+    offsets = pd.Categorical(days.str[11:])
+    counts = np.bincount(offsets.codes)
+    fixed = timezone(parse_utc_offset(offsets.categories[counts.argmax()]))
+    if len(offsets.categories) == 1:
+        return fixed
+
+    deltas = np.array([parse_utc_offset(offset) for offset in offsets.categories], dtype='timedelta64[ns]')
+    # compared at local noon, clear of the small hours clocks are changed in
+    local = pd.to_datetime(days.str[:10], format='%Y-%m-%d').to_numpy() + np.timedelta64(12, 'h')
+    order = np.argsort(local - deltas[offsets.codes])
+    deltas = deltas[offsets.codes][order]
+    utc = pd.DatetimeIndex(local[order] - deltas)
+    changes = np.flatnonzero(np.r_[True, deltas[1:] != deltas[:-1]])
+    changes = changes[np.linspace(0, len(changes) - 1, min(len(changes), TIMEZONE_CHANGES_CHECKED)).astype(int)]
+    change_times = [moment.to_pydatetime() for moment in utc[changes].tz_localize('UTC')]
+
+    best, best_matches = fixed, counts.max()
+    for name in sorted(available_timezones()):
+        zone = ZoneInfo(name)
+        # most zones already disagree around the export's changes of offset
+        agreeing = sum(moment.astimezone(zone).utcoffset() == delta
+                       for moment, delta in zip(change_times, deltas[changes].astype('timedelta64[us]').tolist()))
+        if 2 * agreeing < len(changes):
+            continue
+        zone_deltas = utc.tz_localize('UTC').tz_convert(zone).tz_localize(None) - utc
+        matches = int((zone_deltas.to_numpy() == deltas).sum())
+        if matches > best_matches:
+            best, best_matches = zone, matches
+    return best
+
+
+def timezone_setting(tz):
+    """
+    :return: a time zone as the cache manifest keeps it, an IANA name or a UTC offset in seconds
+    """
+    if isinstance(tz, timezone):
+        return tz.utcoffset(None).total_seconds()
+    return getattr(tz, 'key', None) or str(tz)
+
+
+def timezone_from_setting(setting):
+    if isinstance(setting, str):
+        return ZoneInfo(setting)
+    return timezone(timedelta(seconds=setting))
+
+
+def cached_metric(metric):
+    """
+    Serve a loader from the instance's caches when they are configured, filling them on a miss:
+    the in-memory DataFrameCache first, then the ParquetCache, then the XML itself
+
+    :param metric: cache key, the loader's name in METRIC_LOADERS; loader arguments are appended to it
+    """
+    def decorator(loader):
+        @wraps(loader)
+        def wrapper(self, *args):
+            name = '_'.join((metric,) + tuple(map(str, args)))
+            key = (self.file_path, name)
+            # labelled with the metric alone, so per-argument loads (e.g. one per workout route) share a series
+            with timings.span('load', metric=metric) as span:
+                df = self.frame_cache.get(key) if self.frame_cache is not None else None
+                if df is not None:
+                    span.labels['source'] = 'memory'
+                else:
+                    span.labels['source'] = 'parquet' if self.cache is not None and self.cache.has(name) else 'xml'
+                    df = self.load_persisted(name, loader, *args)
+                    if self.frame_cache is not None:
+                        self.frame_cache.put(key, df)
+                        df = df.copy(deep=False)
+                for column in TIMESTAMP_COLUMNS:
+                    if column in df:
+                        df[column] = df[column].dt.tz_convert(self.timezone)
+                span.items = len(df)
+            return df
+        return wrapper
+    return decorator
+
+
+def time_range(df, start, end):
+    """
+    Rows of a metric strictly between two timestamps, found by binary search
+
+    Same rows as df[(df['start_timestamp'] > start) & (df['start_timestamp'] < end)],
+    but in O(log n) and returned as a slice of df instead of a masked copy.
+
+    :param df: metric sorted by start_timestamp, as the loaders return it
+    :param start: tz-aware start of the range
+    :param end: tz-aware end of the range
+    :return: DataFrame slice
+    """
+    first = df['start_timestamp'].searchsorted(start, side='right')
+    last = df['start_timestamp'].searchsorted(end, side='left')
+    return df.iloc[first:last]
+
+
+def append_rows(df, new_df, tz):
+    """
+    Append newly ingested rows to a cached metric, keeping it sorted by start time
+
+    :param df: cached metric
+    :param new_df: metric built from the new records only
+    :param tz: time zone of both results
+    :return: combined DataFrame
+    """
+    df = df.copy(deep=False)
+    for column in TIMESTAMP_COLUMNS:
+        if column in df:
+            df[column] = df[column].dt.tz_convert(tz)
+    # new rows follow the cached ones in document order
+    new_df = new_df.set_axis(new_df.index + len(df), axis=0)
+    for column in df.columns:
+        # categoricals only stay categorical through concat with identical categories
+        if isinstance(df[column].dtype, pd.CategoricalDtype) and column in new_df:
+            categories = df[column].cat.categories.union(new_df[column].cat.categories, sort=False)
+            df[column] = df[column].cat.set_categories(categories)
+            new_df[column] = new_df[column].cat.set_categories(categories)
+    combined = pd.concat([df, new_df])
+    for column in ('start_timestamp', 'timestamp'):
+        if column in combined:
+            combined.sort_values(column, inplace=True, kind='stable')
+            break
+    return combined
+
+
+def read_user_key(file_path):
+    """
+    Fingerprint the user behind an export from its Me element and its first record
+
+    Every new export of a user is a superset of the previous one and starts with the same record,
+    so the fingerprint stays the same from export to export.
+
+    :param file_path: path of the export
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    for event, elem in ET.iterparse(file_path, events=('end',)):
+        if elem.tag == 'Me':
+            digest.update(repr(sorted(elem.attrib.items())).encode())
+        elif elem.tag == 'Record':
+            digest.update(repr(sorted(elem.attrib.items())).encode())
+            break
+    return digest.hexdigest()
+
+
+def read_start_tag(data, position, chunk_size=4096):
+    """
+    Parse the start tag of the element beginning at a byte offset
+
+    :param data: memory-mapped export
+    :param position: offset of the element's '<'
+    :return: dict of the element's attributes, or None if no complete start tag begins there
+    """
+    parser = ET.XMLPullParser(events=('start',))
+    try:
+        for offset in range(position, len(data), chunk_size):
+            parser.feed(data[offset:offset + chunk_size])
+            for event, elem in parser.read_events():
+                return dict(elem.attrib)
+    except ET.ParseError:
+        pass
+    return None
+
+
+def find_first_record(data, record_type, tag_name='Record'):
+    """
+    Find the first record of a type by searching the raw bytes, without parsing the records before it
+
+    :param data: memory-mapped export
+    :param record_type: e.g. HKQuantityTypeIdentifierHeight
+    :return: dict of the record's attributes, or None if the export has none
+    """
+    marker = f'type="{record_type}"'.encode()
+    opening = b'<' + tag_name.encode() + b' '
+    position = data.find(marker)
+    while position != -1:
+        # the marker may also be the type of another element, e.g. a workout statistic
+        start = data.rfind(opening, 0, position)
+        if start != -1:
+            attrib = read_start_tag(data, start)
+            if attrib is not None and attrib.get('type') == record_type:
+                return attrib
+        position = data.find(marker, position + 1)
+    return None
+
+
+def personal_data(me, height_record, body_mass_record):
+    """
+    Profile shown after an upload
+
+    :param me: attributes of the Me element
+    :param height_record: attributes of the first height record, or None
+    :param body_mass_record: attributes of the first body mass record, or None
+    :return: list of the user's characteristics, then their height and body mass records where present
+    """
+    records = []
+
+    # Extract user information
+    me_data = {}
+    for key, value in me.items():
+        clean_key = key.replace("HKCharacteristicTypeIdentifier", "")
+        me_data[clean_key] = value.replace("HKBiologicalSex", "").replace("HKBloodType", "").replace("HKFitzpatrickSkinType", "")
+
+    # Extract height data
+    if height_record:
+        me_data['UserName'] = height_record['sourceName']
+    # Append user data to records
+    records.append(me_data)
+    for record in (height_record, body_mass_record):
+        if record:
+            records.append({
+                'type': record['type'].replace("HKQuantityTypeIdentifier", ""),
+                'unit': record['unit'],
+                'creationDate': record.get('creationDate', ''),
+                'startDate': record['startDate'],
+                'endDate': record['endDate'],
+                'value': record['value']
+            })
+    return records
+
+
+def read_profile(file_path):
+    """
+    Read the profile of an export without ingesting it
+
+    The Me element and the first height and body mass records are found by searching the
+    memory-mapped file, so only their own tags are parsed.
+
+    :param file_path: path of the export
+    :return: list as AppleWatchData.load_Personal_data returns it
+    """
+    if not os.path.getsize(file_path):
+        return personal_data({}, None, None)
+    with timings.span('profile_read'), open(file_path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        position = data.find(b'<Me ')
+        me = read_start_tag(data, position) if position != -1 else None
+        height_record = find_first_record(data, 'HKQuantityTypeIdentifierHeight')
+        body_mass_record = find_first_record(data, 'HKQuantityTypeIdentifierBodyMass')
+    return personal_data(me or {}, height_record, body_mass_record)
+
+
+def hourly_rollup(df, column):
+    """
+    Sum a metric per local date and hour of day
+
+    :param df: loaded metric with a start_timestamp column
+    :param column: value column; stand hours count the hours stood
+    :return: DataFrame indexed by date with float32 columns '00'-'23', NaN where there are no records
+    """
+    if column == 'stand_hour':
+        values = (df[column] == 'Stood').to_numpy()
+    else:
+        values = df[column].to_numpy()
+    days = df['start_timestamp'].dt.tz_localize(None).to_numpy().astype('datetime64[D]')
+    first_day = days.min()
+    cells = (days - first_day).astype(np.int64) * 24 + df['start_timestamp'].dt.hour.to_numpy()
+
+    size = (cells.max() // 24 + 1) * 24
+    totals = np.bincount(cells, weights=values.astype(float), minlength=size)
+    totals[np.bincount(cells, minlength=size) == 0] = np.nan
+    return pd.DataFrame(totals.astype(np.float32).reshape(-1, 24),
+                        index=pd.date_range(first_day, periods=size // 24, freq='D'),
+                        columns=[f'{hour:02d}' for hour in range(24)])
+
+
+def hourly_rollup_range(rollup, start, end, value_name):
+    """
+    Slice an hourly rollup to the hours between two timestamps, in long format for heatmaps
+
+    :param rollup: result of hourly_rollup
+    :param start: start of the range, in the rollup's time zone
+    :param end: end of the range
+    :param value_name: name of the value column
+    :return: DataFrame with hour, date ('%m/%d/%y'), value and datetime columns, sorted by date
+    """
+    start = pd.Timestamp(start).tz_localize(None)
+    end = pd.Timestamp(end).tz_localize(None)
+    days = rollup.loc[start.normalize():end.normalize()]
+    cells = days.to_numpy()
+    hours = np.arange(24)
+    day_starts = days.index.to_numpy()[:, None]
+    # hours partly inside the range are kept, as the minute filter on raw rows would keep some of their records
+    inside = ((day_starts + (hours + 1) * np.timedelta64(1, 'h') > start.to_datetime64())
+              & (day_starts + hours * np.timedelta64(1, 'h') < end.to_datetime64()))
+    day_index, hour = np.nonzero(inside & ~np.isnan(cells))
+
+    datetimes = days.index[day_index]
+    return pd.DataFrame({
+        'hour': hour,
+        'date': datetimes.strftime('%m/%d/%y'),
+        value_name: cells[day_index, hour],
+        'datetime': datetimes,
+    })
+
+
+def merge_intervals(starts, ends):
+    """
+    Union of possibly overlapping intervals, by sorting them once and sweeping the running end
+
+    :param starts: int64 array of interval starts
+    :param ends: int64 array of interval ends
+    :return: starts and ends of the disjoint intervals covering the same time, sorted
+    """
+    if not len(starts):
+        return starts, ends
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], ends[order]
+    reach = np.maximum.accumulate(ends)
+    # an interval opens a new group unless it starts before everything ahead of it has ended
+    opens = np.empty(len(starts), dtype=bool)
+    opens[0] = True
+    opens[1:] = starts[1:] > reach[:-1]
+    firsts = np.flatnonzero(opens)
+    return starts[firsts], np.maximum.reduceat(ends, firsts)
+
+
+def covered(starts, ends, points):
+    """
+    :param starts: sorted starts of disjoint intervals
+    :param ends: their ends
+    :param points: int64 array
+    :return: boolean array, True where a point falls inside one of the intervals
+    """
+    if not len(starts):
+        return np.zeros(len(points), dtype=bool)
+    position = np.searchsorted(starts, points, side='right') - 1
+    return (position >= 0) & (points < ends[np.maximum(position, 0)])
+
+
+def utc_nanoseconds(timestamps):
+    return timestamps.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy().astype(np.int64)
+
+
+def to_timestamps(nanoseconds, tz):
+    return pd.Series(pd.to_datetime(nanoseconds, unit='ns', utc=True).tz_convert(tz))
+
+
+def night_labels(nanoseconds, tz):
+    """
+    :return: datetime64[D] of the night (see NIGHT_SHIFT) each UTC timestamp falls in
+    """
+    local = to_timestamps(nanoseconds, tz).dt.tz_localize(None) + NIGHT_SHIFT
+    return local.to_numpy().astype('datetime64[D]')
+
+
+def sleep_timeline(df):
+    """
+    Resolve overlapping sleep segments, from several sources or stages, into one sequence of stages
+
+    Each stage's segments are merged first; the boundaries of all merged segments then cut time into
+    pieces, each taking the highest SLEEP_STAGE_PRIORITY stage covering it, and touching pieces of the
+    same stage are joined again.
+
+    :param df: segments as load_sleep_data returns them
+    :return: DataFrame of disjoint start_timestamp, end_timestamp and sleep_stage rows, sorted by start
+    """
+    stage_type = df['sleep_stage'].dtype
+    tz = df['start_timestamp'].dt.tz
+    starts = utc_nanoseconds(df['start_timestamp'])
+    ends = utc_nanoseconds(df['end_timestamp'])
+    codes = df['sleep_stage'].cat.codes.to_numpy()
+    valid = (ends > starts) & (codes >= 0)
+
+    merged = {}
+    for stage in SLEEP_STAGE_PRIORITY:
+        rows = valid & (codes == stage_type.categories.get_loc(stage))
+        merged[stage] = merge_intervals(starts[rows], ends[rows])
+    bounds = np.unique(np.concatenate([array for intervals in merged.values() for array in intervals]))
+    left, right = bounds[:-1], bounds[1:]
+
+    # lower priorities first, so higher ones overwrite them
+    piece_codes = np.full(len(left), -1, dtype=np.int8)
+    for stage in reversed(SLEEP_STAGE_PRIORITY):
+        piece_codes[covered(*merged[stage], left)] = stage_type.categories.get_loc(stage)
+    inside = piece_codes >= 0
+    left, right, piece_codes = left[inside], right[inside], piece_codes[inside]
+
+    opens = np.ones(len(left), dtype=bool)
+    opens[1:] = (piece_codes[1:] != piece_codes[:-1]) | (left[1:] != right[:-1])
+    firsts = np.flatnonzero(opens)
+    lasts = np.append(firsts[1:], len(left)) - 1
+    return pd.DataFrame({
+        'start_timestamp': to_timestamps(left[firsts], tz),
+        'end_timestamp': to_timestamps(right[lasts], tz),
+        'sleep_stage': pd.Categorical.from_codes(piece_codes[firsts], dtype=stage_type),
+    })
+
+
+def nightly_sleep(df):
+    """
+    Hours in bed, asleep and in each stage per night, from overlapping sleep segments
+
+    Time in bed is the union of every segment, whatever its stage or source; stage hours come from
+    sleep_timeline, so no time is counted twice.
+
+    :param df: segments as load_sleep_data returns them
+    :return: float32 DataFrame indexed by night with in_bed, asleep and SLEEP_STAGE_COLUMNS columns
+    """
+    tz = df['start_timestamp'].dt.tz
+    timeline = sleep_timeline(df)
+    starts = utc_nanoseconds(df['start_timestamp'])
+    ends = utc_nanoseconds(df['end_timestamp'])
+    bed_starts, bed_ends = merge_intervals(starts[ends > starts], ends[ends > starts])
+    stage_starts = utc_nanoseconds(timeline['start_timestamp'])
+    stage_hours = (utc_nanoseconds(timeline['end_timestamp']) - stage_starts) / 3.6e12
+
+    nights, night_index = np.unique(np.concatenate([night_labels(bed_starts, tz), night_labels(stage_starts, tz)]),
+                                    return_inverse=True)
+    bed_night, stage_night = night_index[:len(bed_starts)], night_index[len(bed_starts):]
+    categories = df['sleep_stage'].cat.categories
+    cells = stage_night * len(categories) + timeline['sleep_stage'].cat.codes.to_numpy()
+    stages = np.bincount(cells, weights=stage_hours, minlength=len(nights) * len(categories))
+    stages = stages.reshape(-1, len(categories))
+
+    nights_df = pd.DataFrame(index=pd.DatetimeIndex(nights.astype('datetime64[ns]'), name='night'))
+    nights_df['in_bed'] = np.bincount(bed_night, weights=(bed_ends - bed_starts) / 3.6e12, minlength=len(nights))
+    nights_df['asleep'] = stages[:, [categories.get_loc(stage) for stage in ASLEEP_STAGES]].sum(axis=1)
+    for stage, column in SLEEP_STAGE_COLUMNS.items():
+        nights_df[column] = stages[:, categories.get_loc(stage)]
+    return nights_df.astype(np.float32)
+
+
+# metric -> frames derived from the whole metric, rebuilt whenever it is written to the cache
+DERIVED_METRICS = {'sleep': {'sleep_timeline': sleep_timeline, 'sleep_nights': nightly_sleep}}
+
+
+def add_workout(tables, workout):
+    """
+    Append one Workout element to workout tables: its attributes, route file, statistics and events
+
+    :param tables: result of new_workout_tables
+    :param workout: Workout element
+    """
+    columns = tables['workouts']
+    position = len(columns['startDate'])
+    for name in WORKOUT_ATTRIBUTES[:-1]:
+        columns[name].append(workout.attrib.get(name))
+    route = workout.find('WorkoutRoute/FileReference')
+    columns['route'].append(route.attrib.get('path') if route is not None else None)
+    for tag, table, names in (('WorkoutStatistics', 'statistics', WORKOUT_STATISTIC_ATTRIBUTES),
+                              ('WorkoutEvent', 'events', WORKOUT_EVENT_ATTRIBUTES)):
+        for node in workout.iter(tag):
+            tables[table]['workout'].append(position)
+            for name in names[1:]:
+                tables[table][name].append(node.attrib.get(name))
+
+
+def new_workout_tables():
+    return {'workouts': {name: [] for name in WORKOUT_ATTRIBUTES},
+            'statistics': {name: [] for name in WORKOUT_STATISTIC_ATTRIBUTES},
+            'events': {name: [] for name in WORKOUT_EVENT_ATTRIBUTES}}
+
+
+def strip_prefix(values, prefix):
+    """
+    :return: categorical of the values with a type prefix such as 'HKWorkoutActivityType' removed
+    """
+    return pd.Categorical(values).rename_categories(lambda value: value.replace(prefix, ''))
+
+
+def duration_minutes(values, units):
+    """
+    :return: float32 durations in minutes, converted per row from their DURATION_MINUTES unit
+    """
+    units = pd.Categorical(units)
+    # the trailing factor is where the missing code -1 lands
+    factors = np.array([DURATION_MINUTES.get(unit, 1) for unit in units.categories] + [1])
+    return (pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy() * factors[units.codes]
+            ).astype(np.float32)
+
+
+def read_gpx_route(file_path):
+    """
+    Stream the track points out of a workout route GPX file
+
+    :param file_path: path of the GPX file
+    :return: dict of 'time', 'lat', 'lon' and 'ele' lists of strings, in file order
+    """
+    points = {name: [] for name in ('time', 'lat', 'lon', 'ele')}
+    for event, elem in ET.iterparse(file_path, events=('end',)):
+        namespace, _, tag = elem.tag.rpartition('}')
+        if tag != 'trkpt':
+            continue
+        namespace = namespace + '}' if namespace else ''
+        points['lat'].append(elem.attrib.get('lat'))
+        points['lon'].append(elem.attrib.get('lon'))
+        points['ele'].append(elem.findtext(namespace + 'ele'))
+        points['time'].append(elem.findtext(namespace + 'time'))
+        elem.clear()
+    return points
+
+
+def parse_values(value_strings):
+    """
+    Parse record values as float32, which holds every quantity an export records to its precision
+
+    :param value_strings: values as exported
+    :return: float32 array, or an object array if any value is not numeric
+    """
+    try:
+        return np.array(value_strings, dtype=np.float32)
+    except (TypeError, ValueError):
+        return np.array(value_strings, dtype=object)
+
+
+def add_beats(beats, record, position):
+    """
+    Append the instantaneous beats of one HRV record to a beats table
+
+    :param beats: dict of BEAT_ATTRIBUTES lists
+    :param record: HRV record element
+    :param position: row of the record among those of its type
+    """
+    for node in record.iter('InstantaneousBeatsPerMinute'):
+        bpm = node.attrib.get('bpm')
+        time = node.attrib.get('time')
+        if bpm and time:
+            beats['record'].append(position)
+            beats['bpm'].append(bpm)
+            beats['time'].append(time)
+
+
+def parse_beat_times(strings):
+    """
+    Parse beat times of day, e.g. '1:02:03.45 PM', into offsets from midnight
+
+    :param strings: times as exported
+    :return: TimedeltaIndex
+    """
+    strings = pd.Series(strings, dtype=object)
+    times = pd.to_datetime(strings, format=BEAT_TIME_FORMATS[0], errors='coerce')
+    for time_format in BEAT_TIME_FORMATS[1:]:
+        unparsed = times.isna()
+        if not unparsed.any():
+            break
+        times[unparsed] = pd.to_datetime(strings[unparsed], format=time_format, errors='coerce')
+    return pd.TimedeltaIndex(times - times.dt.normalize())
+
+
+class StreamedRecords:
+    """
+    Columns extracted by one streamed pass over an export, or over a byte range of one
+
+    :param since: naive UTC datetime; when given, only records created after it are kept
+    """
+    def __init__(self, since=None):
+        self.record_columns = {}
+        self.record_beats = {}
+        self.first_records = {}
+        self.workouts = new_workout_tables()
+        self.me_element = None
+        self.since = since
+        # UTC offset -> local threshold string / latest creation timestamp seen in that offset;
+        # within one offset, timestamp strings compare in time order
+        self.thresholds = {}
+        self.latest = {}
+
+    def is_new(self, element):
+        """
+        Note when a record or workout was created, and tell whether it is to be kept
+        """
+        stamp = element.attrib.get('creationDate') or element.attrib.get('startDate')
+        if stamp:
+            offset = stamp[20:]
+            # skipped records are already cached, so only kept ones move the checkpoint
+            if self.since is not None and stamp[:19] <= self.threshold(offset):
+                return False
+            if stamp > self.latest.get(offset, ''):
+                self.latest[offset] = stamp
+        return True
+
+    def add(self, record):
+        if not self.is_new(record):
+            return
+
+        record_type = record.attrib.get('type')
+        columns = self.record_columns.get(record_type)
+        if columns is None:
+            columns = self.record_columns[record_type] = {name: [] for name in RECORD_ATTRIBUTES}
+            self.first_records[record_type] = dict(record.attrib)
+        for name in RECORD_ATTRIBUTES:
+            columns[name].append(record.attrib.get(name))
+        if record_type in METADATA_TYPES:
+            beats = self.record_beats.setdefault(record_type, {name: [] for name in BEAT_ATTRIBUTES})
+            add_beats(beats, record, len(columns['startDate']) - 1)
+
+    def add_workout(self, workout):
+        if self.is_new(workout):
+            add_workout(self.workouts, workout)
+
+    def threshold(self, offset):
+        if offset not in self.thresholds:
+            self.thresholds[offset] = (self.since + parse_utc_offset(offset)).strftime(DATE_FORMAT)
+        return self.thresholds[offset]
+
+    def checkpoint(self):
+        """
+        Latest creation (or start) time of any record kept, as a naive UTC datetime;
+        never earlier than since, so reading an older export does not move it back
+        """
+        times = [datetime.strptime(stamp[:19], DATE_FORMAT) - parse_utc_offset(offset)
+                 for offset, stamp in self.latest.items()]
+        if self.since is not None:
+            times.append(self.since)
+        return max(times, default=None)
+
+    def extend(self, other):
+        """
+        Append the records of a later part of the same export, keeping document order
+        """
+        for record_type, other_beats in other.record_beats.items():
+            # beats refer to their parent by position, which moves down by the rows already held
+            shift = len(self.record_columns.get(record_type, {'startDate': ()})['startDate'])
+            beats = self.record_beats.setdefault(record_type, {name: [] for name in BEAT_ATTRIBUTES})
+            beats['record'].extend(position + shift for position in other_beats['record'])
+            beats['bpm'].extend(other_beats['bpm'])
+            beats['time'].extend(other_beats['time'])
+        # likewise statistics and events refer to their workout
+        shift = len(self.workouts['workouts']['startDate'])
+        for table, columns in self.workouts.items():
+            for name, values in other.workouts[table].items():
+                columns[name].extend(values if name != 'workout' else (position + shift for position in values))
+        for record_type, other_columns in other.record_columns.items():
+            columns = self.record_columns.get(record_type)
+            if columns is None:
+                self.record_columns[record_type] = other_columns
+                self.first_records[record_type] = other.first_records[record_type]
+                continue
+            for name in RECORD_ATTRIBUTES:
+                columns[name].extend(other_columns[name])
+        for offset, stamp in other.latest.items():
+            if stamp > self.latest.get(offset, ''):
+                self.latest[offset] = stamp
+        if self.me_element is None:
+            self.me_element = other.me_element
+
+
+def stream_records(source, tag_name='Record', since=None):
+    """
+    Extract records from an export with iterparse, clearing elements as soon as they are read
+
+    :param source: path or binary file object of an export
+    :param tag_name: element holding the records
+    :param since: naive UTC datetime; only records created after it are kept
+    :return: StreamedRecords
+    """
+    streamed = StreamedRecords(since)
+    depth = 0
+    root = None
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+
+        if elem.tag == tag_name:
+            streamed.add(elem)
+        elif elem.tag == WORKOUT_TAG and depth == 1:
+            streamed.add_workout(elem)
+        elif elem.tag == 'Me' and depth == 1:
+            streamed.me_element = elem
+            continue
+
+        if depth <= 1:
+            # drop finished top-level elements (and their children) from the root
+            elem.clear()
+            root.clear()
+    return streamed
+
+
+def inside_correlation(data, position, window=1 << 20):
+    # Correlation elements nest Record elements, so a split must not land between their tags
+    opening = data.rfind(b'<Correlation ', max(0, position - window), position)
+    closing = data.rfind(b'</Correlation>', max(0, position - window), position)
+    return opening > closing
+
+
+def record_ranges(file_path, tag_name, count):
+    """
+    Split an export into byte ranges that each start on a top-level record
+
+    :param file_path: path of the export
+    :param tag_name: element holding the records
+    :param count: number of ranges wanted; fewer come back for small files
+    :return: offset of the first record and a list of (start, end) byte offsets
+    """
+    marker = b'<' + tag_name.encode() + b' '
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        first = data.find(marker)
+        end = data.rfind(b'</HealthData>')
+        if first == -1 or end < first:
+            return first, []
+        boundaries = [first]
+        for k in range(1, count):
+            target = first + (end - first) * k // count
+            position = data.find(marker, max(target, boundaries[-1] + 1), end)
+            while position != -1 and inside_correlation(data, position):
+                position = data.find(marker, position + 1, end)
+            if position == -1:
+                break
+            boundaries.append(position)
+        boundaries.append(end)
+    return first, list(zip(boundaries[:-1], boundaries[1:]))
+
+
+class RecordRangeReader:
+    """
+    File-like view of one byte range of an export, wrapped in a root element so it parses on its own
+    """
+    def __init__(self, file_path, start, end):
+        self.file = open(file_path, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+        self.pending = [b'<HealthData>']
+
+    def read(self, size=-1):
+        if self.pending:
+            return self.pending.pop()
+        if self.remaining > 0:
+            data = self.file.read(self.remaining if size < 0 else min(size, self.remaining))
+            self.remaining -= len(data)
+            if data:
+                return data
+            self.remaining = 0
+        if not self.file.closed:
+            self.file.close()
+            return b'</HealthData>'
+        return b''
+
+
+def stream_record_range(args):
+    file_path, tag_name, since, start, end = args
+    return stream_records(RecordRangeReader(file_path, start, end), tag_name, since)
+
+
+def pool_context():
+    """
+    Start method of the ingest processes: forking a process with other threads running, such as a web
+    server's, can leave children waiting on locks those threads held, so workers come from a fork server
+    (or are spawned where there is none)
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def parallel_stream_records(file_path, tag_name='Record', workers=None, since=None):
+    """
+    Extract records with a process pool, one byte range per task
+
+    Ranges are merged back in file order, so the result matches stream_records exactly.
+
+    :param file_path: path of the export
+    :param tag_name: element holding the records
+    :param workers: number of processes, defaults to the CPU count
+    :param since: naive UTC datetime; only records created after it are kept
+    :return: StreamedRecords
+    """
+    workers = workers or os.cpu_count() or 1
+    first, ranges = record_ranges(file_path, tag_name, workers * RANGES_PER_WORKER)
+    if not ranges:
+        return stream_records(file_path, tag_name, since)
+
+    # the header before the first record holds the Me element
+    with open(file_path, 'rb') as f:
+        header = f.read(first)
+    streamed = StreamedRecords(since)
+    streamed.me_element = ET.fromstring(header + b'</HealthData>').find('Me')
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=pool_context()) as pool:
+        tasks = [(file_path, tag_name, since, start, end) for start, end in ranges]
+        for part in pool.map(stream_record_range, tasks):
+            streamed.extend(part)
+    return streamed
+
+
 class AppleWatchData:
-    def __init__(self, xml_data_file_path, source_name, tag_name='Record'):
+    def __init__(self, xml_data_file_path, source_name, tag_name='Record', streaming=False, tz=None,
+                 cache_dir=None, content_hash=None, workers=1, frame_cache=None, incremental=False):
         self.file_path = os.path.expanduser(xml_data_file_path)
         self.source_name = source_name
         self.tag_name = tag_name
-        self.tree = ET.parse(self.file_path)
-        self.root = self.tree.getroot()
-        self.records = self.root.findall('.//' + tag_name)
-        self.me_element=self.root.find('Me')
+        # parsing with several worker processes, or only the records added since the last export,
+        # are forms of streaming
+        self.workers = workers
+        self.streaming = streaming or workers > 1 or incremental
+        self.record_index = None
+        self.workout_tables = None
+        self.ingested = False
+        self.frame_cache = frame_cache
+        # the cache is keyed by the export's content, or with incremental=True by its user, so a newer
+        # export of the same user only ingests the records created since the cache's checkpoint
+        self.cache = None
+        if cache_dir:
+            key = read_user_key(self.file_path) if incremental else None
+            self.cache = ParquetCache(cache_dir, self.file_path, content_hash, key=key)
+        if self.cache is None:
+            self.ingest()
+        elif not self.cache_current():
+            # only one thread or process ingests into a cache at a time; the others wait, then find it
+            # warm, so a newer export's records are appended once however many open it at once
+            with self.cache.lock():
+                self.cache.reload()
+                if not self.cache_current():
+                    self.ingest(self.cache.get('checkpoint') if incremental else None)
+                    self.timezone = tz or self.detect_timezone()
+                    self.persist()
+        # every loader converts timestamps to this zone; defaults to the zone the export was recorded in
+        self.timezone = tz or self.detect_timezone()
 
-    def parse_tag(self, attribute):
-        record_list = []
-        for s in self.records:
-            if s.attrib.get('type') == attribute:
-                record_list.append(s)
-                # print("Record Found")
-        return record_list
-
-    def parse_record(self, record):
-        start_timestamp_string = record.attrib.get('startDate')
-        end_timestamp_string = record.attrib.get('endDate')
-        start_time = datetime.strptime(start_timestamp_string, '%Y-%m-%d %H:%M:%S -0600')
-        end_time = datetime.strptime(end_timestamp_string, '%Y-%m-%d %H:%M:%S -0600')
+    def cache_current(self):
+        # a warm cache (one that has recorded this export's content hash) never touches the XML; with
+        # incremental=True that includes older exports of the user, whose records it already holds
+        return self.cache.content_hash in self.cache.get('content_hashes', [])
+
+    def ingest(self, checkpoint=None):
+        """
+        :param checkpoint: ISO UTC time; when given, only records created after it are read
+        """
+        self.since = datetime.fromisoformat(checkpoint) if checkpoint else None
+        self.offset_days = None
+        if not self.streaming:
+            mode = 'tree'
+        elif self.parallel():
+            mode = 'parallel'
+        else:
+            mode = 'streaming'
+        with timings.span('ingest', mode=mode, incremental=self.since is not None) as span:
+            if self.streaming:
+                self.stream_records()
+                span.items = sum(len(columns['startDate']) for columns in self.record_columns.values())
+            else:
+                self.tree = ET.parse(self.file_path)
+                self.root = self.tree.getroot()
+                self.records = self.root.findall('.//' + self.tag_name)
+                self.me_element=self.root.find('Me')
+                span.items = len(self.records)
+        self.ingested = True
+
+    def ensure_ingested(self):
+        if not self.ingested:
+            self.ingest()
+
+    def persist(self):
+        """
+        Write every metric, its hourly rollup and the profile to the cache while the parsed XML is at hand.
+
+        After an incremental ingest the new rows are appended to the cached frames, and the rollups are
+        rebuilt from them. The row count of every frame, the checkpoint and the content hash are committed
+        together by the last manifest write, so an interrupted run leaves the cache cold, and rows it
+        appended past the committed counts are dropped when the ingest is retried.
+        """
+        with timings.span('persist', incremental=self.since is not None):
+            self.write_cache()
+
+    def write_cache(self):
+        # metric -> rows committed to the cache, by which the labels of appended rows move down
+        committed = self.cache.get('rows', {}) if self.since is not None else {}
+        rows = dict(committed)
+        # the zone is inferred again from the cached and the new records, and may have changed
+        rezoned = self.cache.get('timezone') != timezone_setting(self.timezone)
+        for metric, loader in METRIC_LOADERS.items():
+            try:
+                # the undecorated loader, which builds the frame from the records just ingested
+                df = getattr(AppleWatchData, loader).__wrapped__(self)
+            except IndexError:
+                if metric in committed and rezoned:
+                    # nothing new, but in another zone the cached rows fall on other local dates and hours
+                    self.write_rollups(metric, self.committed_frame(metric, committed[metric]))
+                elif not self.cache.has(metric):
+                    self.cache.write_missing(metric)
+                    if metric in ROLLUP_COLUMNS:
+                        self.cache.write_missing(f'hourly_{metric}')
+                    for name in DERIVED_METRICS.get(metric, ()):
+                        self.cache.write_missing(name)
+                continue
+            except ValueError:
+                continue
+            if metric in PARENT_METRICS:
+                parent, column = PARENT_METRICS[metric]
+                df[column] += committed.get(parent, 0)
+
+            if metric in committed:
+                df = append_rows(self.committed_frame(metric, committed[metric]), df, self.timezone)
+            self.cache.write(metric, df)
+            rows[metric] = len(df)
+            self.write_rollups(metric, df)
+
+        if self.me_element is not None and self.cache.get('personal_data') is None:
+            self.cache.set('personal_data', self.load_Personal_data())
+        manifest = {'rows': rows, 'content_hashes': self.cache.get('content_hashes', []) + [self.cache.content_hash]}
+        if self.streaming:
+            checkpoint = self.streamed_checkpoint
+            manifest['checkpoint'] = checkpoint.isoformat() if checkpoint else None
+        manifest['timezone'] = timezone_setting(self.timezone)
+        manifest['offset_days'] = sorted(self.recorded_days())
+        self.cache.update(manifest)
+
+    def committed_frame(self, metric, rows):
+        """
+        :param rows: rows of the metric the manifest has committed
+        :return: the cached metric without rows appended by an interrupted run, in the instance's zone
+        """
+        cached = self.cache.read(metric)
+        # appended rows are labelled from the committed count up, so those of an interrupted run go
+        cached = cached[cached.index < rows].copy(deep=False)
+        for column in TIMESTAMP_COLUMNS:
+            if column in cached:
+                cached[column] = cached[column].dt.tz_convert(self.timezone)
+        return cached
+
+    def write_rollups(self, metric, df):
+        """
+        Cache the hourly rollup and the metrics derived from a metric, all by local time in the instance's zone
+        """
+        if metric in ROLLUP_COLUMNS:
+            self.cache.write(f'hourly_{metric}', hourly_rollup(df, ROLLUP_COLUMNS[metric]))
+        for name, derive in DERIVED_METRICS.get(metric, {}).items():
+            self.cache.write(name, derive(df))
+
+    def load_persisted(self, metric, loader, *args):
+        if self.cache is None:
+            return loader(self, *args)
+        if self.cache.has(metric):
+            return self.cache.read(metric)
         try:
-            biometric = float(record.attrib.get('value'))
-        except ValueError:
-            biometric = record.attrib.get('value')
-        return start_time, end_time, biometric
-
-    def parse_metadata(self, record):
-        meta_data = {'bpm': [], 'time': []}
-        nodes = record.findall('.//InstantaneousBeatsPerMinute')
-        for node in nodes:
-            bpm = node.attrib.get('bpm')
-            time = node.attrib.get('time')
-            if bpm and time:
-                meta_data['bpm'].append(bpm)
-                meta_data['time'].append(time)
-        return meta_data
-
-    def parse_record_list(self, record_list):
-        apple_data = [self.parse_record(record) for record in record_list]
-        apple_array = np.array(apple_data)
-        return apple_array
+            df = loader(self, *args)
+        except IndexError:
+            self.cache.write_missing(metric)
+            raise
+        self.cache.write(metric, df)
+        return df
+
+    def detect_timezone(self):
+        # a warm cache keeps the zone inferred from every record it holds
+        if self.cache is not None and self.cache_current():
+            return timezone_from_setting(self.cache.get('timezone'))
+        return infer_timezone(self.recorded_days())
+
+    def recorded_days(self):
+        """
+        Dates and offsets of a sample of the ingested records, plus after an incremental ingest those of
+        the records cached before, so the zone is inferred from every record the cache will hold
+
+        :return: see offset_days
+        """
+        if self.offset_days is None:
+            if self.streaming:
+                start_dates = [columns['startDate'] for columns in self.record_columns.values()]
+                step = max(1, sum(map(len, start_dates)) // TIMEZONE_SAMPLES)
+                sample = [date for dates in start_dates for date in dates[::step]]
+            else:
+                step = max(1, len(self.records) // TIMEZONE_SAMPLES)
+                sample = [record.attrib.get('startDate') for record in self.records[::step]]
+            self.offset_days = offset_days(sample)
+            if self.since is not None:
+                self.offset_days.update(self.cache.get('offset_days', []))
+        return self.offset_days
+
+    def parallel(self):
+        return self.workers > 1 and os.path.getsize(self.file_path) >= PARALLEL_MIN_BYTES
+
+    def stream_records(self):
+        """
+        Ingest the export with iterparse, keeping only the attributes the loaders need.
+
+        Elements are cleared as soon as they are read, so peak memory follows the size of
+        the extracted columns rather than the XML tree.
+        """
+        if self.parallel():
+            streamed = parallel_stream_records(self.file_path, self.tag_name, self.workers, self.since)
+        else:
+            streamed = stream_records(self.file_path, self.tag_name, self.since)
+        self.record_columns = streamed.record_columns
+        self.record_beats = streamed.record_beats
+        self.first_records = streamed.first_records
+        self.workout_tables = streamed.workouts
+        self.me_element = streamed.me_element
+        self.streamed_checkpoint = streamed.checkpoint()
+
+    def index_records(self):
+        """
+        Bucket records by type in a single traversal.
+
+        :return: dict of record type -> list of record elements, in document order
+        """
+        record_index = {}
+        for record in self.records:
+            record_index.setdefault(record.attrib.get('type'), []).append(record)
+        return record_index
+
+    def parse_tag(self, attribute):
+        self.ensure_ingested()
+        if self.record_index is None:
+            self.record_index = self.index_records()
+        return self.record_index.get(attribute, [])
+
+    def raw_record_columns(self, attribute):
+        self.ensure_ingested()
+        if self.streaming:
+            return self.record_columns.get(attribute, {name: [] for name in RECORD_ATTRIBUTES})
+        record_list = self.parse_tag(attribute)
+        return {name: [record.attrib.get(name) for record in record_list] for name in RECORD_ATTRIBUTES}
+
+    def load_record_columns(self, attribute):
+        """
+        Parse the start, end and value columns of one record type
 
+        :param attribute: record type, e.g. HKQuantityTypeIdentifierHeartRate
+        :return: start timestamps, end timestamps and values
+        """
+        columns = self.raw_record_columns(attribute)
+        if not columns['startDate']:
+            raise IndexError(f'No {attribute} records found')
+
+        start_timestamps = parse_timestamps(columns['startDate'], self.timezone)
+        end_timestamps = parse_timestamps(columns['endDate'], self.timezone)
+        return start_timestamps, end_timestamps, parse_values(columns['value'])
+
+    def load_record_beats(self, attribute):
+        """
+        :return: dict of BEAT_ATTRIBUTES lists, the beats of every record of the type in document order
+        """
+        self.ensure_ingested()
+        if self.streaming:
+            return self.record_beats.get(attribute, {name: [] for name in BEAT_ATTRIBUTES})
+        beats = {name: [] for name in BEAT_ATTRIBUTES}
+        for position, record in enumerate(self.parse_tag(attribute)):
+            add_beats(beats, record, position)
+        return beats
+
+    def raw_workout_tables(self):
+        """
+        :return: workout tables as new_workout_tables builds them, of every workout in document order
+        """
+        self.ensure_ingested()
+        if self.workout_tables is None:
+            self.workout_tables = new_workout_tables()
+            for workout in self.root.iterfind(WORKOUT_TAG):
+                add_workout(self.workout_tables, workout)
+        return self.workout_tables
+
+    def first_record(self, attribute):
+        self.ensure_ingested()
+        if not self.streaming:
+            record_list = self.parse_tag(attribute)
+            return dict(record_list[0].attrib) if record_list else None
+        return self.first_records.get(attribute)
+
+    @cached_metric('heart_rate')
     def load_heart_rate_data(self):
         attribute = 'HKQuantityTypeIdentifierHeartRate'
-        record_list = self.parse_tag(attribute)
         hr_data_df = pd.DataFrame()
 
-        apple_array = self.parse_record_list(record_list)
-        hr_data_df['start_timestamp'] = apple_array[:, 0]
-        hr_data_df['end_timestamp'] = apple_array[:, 1]
-        hr_data_df['heart_rate'] = pd.to_numeric(apple_array[:, 2], errors='ignore')
+        start_timestamps, end_timestamps, values = self.load_record_columns(attribute)
+        hr_data_df['start_timestamp'] = start_timestamps
+        hr_data_df['end_timestamp'] = end_timestamps
+        hr_data_df['heart_rate'] = pd.to_numeric(values, errors='ignore')
 
         hr_data_df.sort_values('start_timestamp', inplace=True)
 
         return hr_data_df
 
+    @cached_metric('heart_rate_variability')
     def load_heart_rate_variability_data(self):
         attribute = 'HKQuantityTypeIdentifierHeartRateVariabilitySDNN'
-        record_list = self.parse_tag(attribute)
         hrv_data_df = pd.DataFrame()
 
-        apple_array = self.parse_record_list(record_list)
-        instantaneous_bpm = [self.parse_metadata(record) for record in record_list]
+        start_timestamps, end_timestamps, values = self.load_record_columns(attribute)
 
-        hrv_data_df['start_timestamp'] = apple_array[:, 0]
-        hrv_data_df['end_timestamp'] = apple_array[:, 1]
-        hrv_data_df['heart_rate_variability'] = pd.to_numeric(apple_array[:, 2], errors='ignore')
-        hrv_data_df['instantaneous_bpm'] = instantaneous_bpm
+        hrv_data_df['start_timestamp'] = start_timestamps
+        hrv_data_df['end_timestamp'] = end_timestamps
+        hrv_data_df['heart_rate_variability'] = pd.to_numeric(values, errors='ignore')
+
+        hrv_data_df.sort_values('start_timestamp', inplace=True)
 
         return hrv_data_df
 
+    @cached_metric('heart_rate_beats')
+    def load_heart_rate_beats_data(self):
+        """
+        Instantaneous beats recorded with each HRV measurement, one row per beat
+
+        :return: DataFrame of the parent's row label in load_heart_rate_variability_data ('record'),
+            the beat's timestamp and its bpm as float32, sorted by timestamp
+        """
+        attribute = 'HKQuantityTypeIdentifierHeartRateVariabilitySDNN'
+        beats = self.load_record_beats(attribute)
+        if not beats['record']:
+            raise IndexError('No instantaneous beats found')
+
+        # beats carry only a local time of day: anchor them to the parent's local midnight,
+        # rolling over to the next day for measurements that span it. startDate is truncated to the second,
+        # so a beat slightly before it belongs to the same day; only one far before it is past midnight
+        start_dates = self.raw_record_columns(attribute)['startDate']
+        starts = pd.DatetimeIndex(parse_timestamps(start_dates, self.timezone))
+        midnights = pd.DatetimeIndex(
+            parse_timestamps([date[:11] + '00:00:00' + date[19:] for date in start_dates], self.timezone))
+        record = np.asarray(beats['record'], dtype=np.int32)
+        timestamps = midnights[record] + parse_beat_times(beats['time'])
+        rolled_over = timestamps < starts[record] - BEAT_ROLLOVER
+        timestamps = timestamps.where(~rolled_over, timestamps + pd.Timedelta(days=1))
+
+        beats_df = pd.DataFrame({'record': record,
+                                 'timestamp': timestamps,
+                                 'bpm': np.asarray(beats['bpm'], dtype=np.float32)})
+        beats_df.sort_values('timestamp', inplace=True)
+
+        return beats_df
+
+    @cached_metric('resting_heart_rate')
     def load_resting_heart_rate_data(self):
         attribute = 'HKQuantityTypeIdentifierRestingHeartRate'
-        record_list = self.parse_tag(attribute)
         resting_hr_data_df = pd.DataFrame()
 
-        apple_array = self.parse_record_list(record_list)
-        resting_hr_data_df['start_timestamp'] = apple_array[:, 0]
-        resting_hr_data_df['end_timestamp'] = apple_array[:, 1]
-        resting_hr_data_df['resting_heart_rate'] = pd.to_numeric(apple_array[:, 2], errors='ignore')
+        start_timestamps, end_timestamps, values = self.load_record_columns(attribute)
+        resting_hr_data_df['start_timestamp'] = start_timestamps
+        resting_hr_data_df['end_timestamp'] = end_timestamps
+        resting_hr_data_df['resting_heart_rate'] = pd.to_numeric(values, errors='ignore')
 
         resting_hr_data_df.sort_values('start_timestamp', inplace=True)
 
         return resting_hr_data_df
 
+    @cached_metric('walking_heart_rate')
     def load_walking_heart_rate_data(self):
         attribute = 'HKQuantityTypeIdentifierWalkingHeartRateAverage'
-        record_list = self.parse_tag(attribute)
         walking_hr_data_df = pd.DataFrame()
 
-        apple_array = self.parse_record_list(record_list)
-        print(apple_array)
-        walking_hr_data_df['start_timestamp'] = apple_array[:, 0]
-        walking_hr_data_df['end_timestamp'] = apple_array[:, 1]
-        walking_hr_data_df['walking_heart_rate'] = pd.to_numeric(apple_array[:, 2], errors='ignore')
+        start_timestamps, end_timestamps, values = self.load_record_columns(attribute)
+        walking_hr_data_df['start_timestamp'] = start_timestamps
+        walking_hr_data_df['end_timestamp'] = end_timestamps
+        walking_hr_data_df['walking_heart_rate'] = pd.to_numeric(values, errors='ignore')
 
         walking_hr_data_df.sort_values('start_timestamp', inplace=True)
 
         return walking_hr_data_df
 
+    @cached_metric('distance')
     def load_distance_data(self):
         attribute = 'HKQuantityTypeIdentifierDistanceWalkingRunning'
-        record_list = self.parse_tag(attribute)
         distance_data_df = pd.DataFrame()
 
-        apple_array = self.parse_record_list(record_list)
-        distance_data_df['start_timestamp'] = apple_array[:, 0]
-        distance_data_df['end_timestamp'] = apple_array[:, 1]
-        distance_data_df['distance_walk_run'] = pd.to_numeric(apple_array[:, 2], errors='ignore')
+        start_timestamps, end_timestamps, values = self.load_record_columns(attribute)
+        distance_data_df['start_timestamp'] = start_timestamps
+        distance_data_df['end_timestamp'] = end_timestamps
+        distance_data_df['distance_walk_run'] = pd.to_numeric(values, errors='ignore')
+
+        distance_data_df.sort_values('start_timestamp', inplace=True)
 
         return distance_data_df
 
+    @cached_metric('basal_energy')
     def load_basal_energy_data(self):
         attribute = 'HKQuantityTypeIdentifierBasalEnergyBurned'
-        record_list = self.parse_tag(attribute)
         energy_burned_data_df = pd.DataFrame()
 
-        apple_array = self.parse_record_list(record_list)
-        energy_burned_data_df['start_timestamp'] = apple_array[:, 0]
-        energy_burned_data_df['end_timestamp'] = apple_array[:, 1]
-        energy_burned_data_df['energy_burned'] = pd.to_numeric(apple_array[:, 2], errors='ignore')
+        start_timestamps, end_timestamps, values = self.load_record_columns(attribute)
+        energy_burned_data_df['start_timestamp'] = start_timestamps
+        energy_burned_data_df['end_timestamp'] = end_timestamps
+        energy_burned_data_df['energy_burned'] = pd.to_numeric(values, errors='ignore')
+
+        energy_burned_data_df.sort_values('start_timestamp', inplace=True)
 
         return energy_burned_data_df
 
+    @cached_metric('stand_hour')
     def load_stand_hour_data(self):
         attribute = 'HKCategoryTypeIdentifierAppleStandHour'
-        record_list = self.parse_tag(attribute)
         stand_hour_df = pd.DataFrame()
 
-        apple_array = self.parse_record_list(record_list)
-        stand_hour_df['start_timestamp'] = apple_array[:, 0]
-        stand_hour_df['end_timestamp'] = apple_array[:, 1]
-        stand_hour_df['stand_hour'] = apple_array[:, 2]
+        start_timestamps, end_timestamps, values = self.load_record_columns(attribute)
+        stand_hour_df['start_timestamp'] = start_timestamps
+        stand_hour_df['end_timestamp'] = end_timestamps
 
         new_labels = {'HKCategoryValueAppleStandHourIdle': 'Idle',
                        'HKCategoryValueAppleStandHourStood': 'Stood'}
-        stand_hour_df['stand_hour'] = stand_hour_df['stand_hour'].replace(new_labels)
+        # one byte per hour: relabel the few categories instead of every row
+        stand_hour_df['stand_hour'] = pd.Categorical(values).rename_categories(lambda label: new_labels.get(label, label))
+
+        stand_hour_df.sort_values('start_timestamp', inplace=True)
 
         return stand_hour_df
 
+    @cached_metric('steps')
     def load_step_data(self):
         attribute = 'HKQuantityTypeIdentifierStepCount'
-        record_list = self.parse_tag(attribute)
         step_data_df = pd.DataFrame()
 
-        apple_array = self.parse_record_list(record_list)
-        step_data_df['start_timestamp'] = apple_array[:, 0]
-        step_data_df['end_timestamp'] = apple_array[:, 1]
-        step_data_df['steps'] = pd.to_numeric(apple_array[:, 2], errors='ignore')
+        start_timestamps, end_timestamps, values = self.load_record_columns(attribute)
+        step_data_df['start_timestamp'] = start_timestamps
+        step_data_df['end_timestamp'] = end_timestamps
+        step_data_df['steps'] = pd.to_numeric(values, errors='ignore')
+
+        step_data_df.sort_values('start_timestamp', inplace=True)
 
         return step_data_df
 
-    def load_Personal_data(self):
-        records = []
+    @cached_metric('sleep')
+    def load_sleep_data(self):
+        """
+        Sleep analysis segments as recorded, possibly overlapping across sources and stages
 
-        # Extract user information
-        me_data = {}
-        for key, value in self.me_element.attrib.items():
-            clean_key = key.replace("HKCharacteristicTypeIdentifier", "")
-            me_data[clean_key] = value.replace("HKBiologicalSex", "").replace("HKBloodType", "").replace("HKFitzpatrickSkinType", "")
+        :return: DataFrame of start_timestamp, end_timestamp and sleep_stage, a categorical of the
+            SLEEP_STAGES labels, sorted by start
+        """
+        attribute = 'HKCategoryTypeIdentifierSleepAnalysis'
+        sleep_df = pd.DataFrame()
 
+        start_timestamps, end_timestamps, values = self.load_record_columns(attribute)
+        sleep_df['start_timestamp'] = start_timestamps
+        sleep_df['end_timestamp'] = end_timestamps
+        # fixed categories, so frames appended to the cache stay categorical; unknown values become NaN
+        values = pd.Categorical(values)
+        # the trailing None is where the missing code -1 lands
+        labels = np.array([SLEEP_STAGES.get(value) for value in values.categories] + [None], dtype=object)
+        sleep_df['sleep_stage'] = pd.Categorical(labels[values.codes], categories=SLEEP_STAGE_PRIORITY)
 
+        sleep_df.sort_values('start_timestamp', inplace=True)
 
-        # Extract height data
-        attribute = 'HKQuantityTypeIdentifierHeight'
-        record_list = self.parse_tag(attribute)
-        if record_list:
-            me_data['UserName'] = record_list[0].attrib['sourceName']
-        # Append user data to records
-        records.append(me_data)     
-        if record_list:
-            record_data = {
-                'type': record_list[0].attrib['type'].replace("HKQuantityTypeIdentifier", ""),
-                'unit': record_list[0].attrib['unit'],
-                'creationDate': record_list[0].attrib.get('creationDate', ''),
-                'startDate': record_list[0].attrib['startDate'],
-                'endDate': record_list[0].attrib['endDate'],
-                'value': record_list[0].attrib['value']
-            }
-            records.append(record_data)
-
-        # Extract body mass data
-        attribute = 'HKQuantityTypeIdentifierBodyMass'
-        record_list = self.parse_tag(attribute)
-        if record_list:
-            record_data = {
-                'type': record_list[0].attrib['type'].replace("HKQuantityTypeIdentifier", ""),
-                'unit': record_list[0].attrib['unit'],
-                'creationDate': record_list[0].attrib.get('creationDate', ''),
-                'startDate': record_list[0].attrib['startDate'],
-                'endDate': record_list[0].attrib['endDate'],
-                'value': record_list[0].attrib['value']
-            }
-            records.append(record_data)
-
-        return records
+        return sleep_df
+
+    @cached_metric('sleep_timeline')
+    def load_sleep_timeline_data(self):
+        """
+        :return: see sleep_timeline
+        """
+        return sleep_timeline(self.load_sleep_data())
+
+    @cached_metric('sleep_nights')
+    def load_sleep_nights_data(self):
+        """
+        :return: see nightly_sleep
+        """
+        return nightly_sleep(self.load_sleep_data())
+
+    @cached_metric('workouts')
+    def load_workout_data(self):
+        """
+        Workouts, one row per Workout element; their routes are read by load_workout_route_data
+
+        :return: DataFrame of start_timestamp, end_timestamp, activity and source as categoricals,
+            duration in minutes as float32 and route, the export's path of the route file or None,
+            sorted by start
+        """
+        columns = self.raw_workout_tables()['workouts']
+        if not columns['startDate']:
+            raise IndexError('No workouts found')
+        workout_df = pd.DataFrame()
+
+        workout_df['start_timestamp'] = parse_timestamps(columns['startDate'], self.timezone)
+        workout_df['end_timestamp'] = parse_timestamps(columns['endDate'], self.timezone)
+        workout_df['activity'] = strip_prefix(columns['workoutActivityType'], 'HKWorkoutActivityType')
+        workout_df['duration'] = duration_minutes(columns['duration'], columns['durationUnit'])
+        workout_df['source'] = pd.Categorical(columns['sourceName'])
+        workout_df['route'] = pd.Series(columns['route'], dtype=object)
+
+        workout_df.sort_values('start_timestamp', inplace=True)
+
+        return workout_df
+
+    @cached_metric('workout_statistics')
+    def load_workout_statistics_data(self):
+        """
+        WorkoutStatistics of every workout, e.g. its active energy, distance or heart rate
+
+        :return: DataFrame of the workout's row label in load_workout_data ('workout'), statistic and unit
+            as categoricals and sum, average, minimum and maximum as float32, NaN where not recorded
+        """
+        statistics = self.raw_workout_tables()['statistics']
+        if not statistics['workout']:
+            raise IndexError('No workout statistics found')
+
+        statistics_df = pd.DataFrame({'workout': np.asarray(statistics['workout'], dtype=np.int32),
+                                      'statistic': strip_prefix(statistics['type'], 'HKQuantityTypeIdentifier')})
+        for name in ('sum', 'average', 'minimum', 'maximum'):
+            statistics_df[name] = pd.to_numeric(pd.Series(statistics[name], dtype=object),
+                                                errors='coerce').astype(np.float32)
+        statistics_df['unit'] = pd.Categorical(statistics['unit'])
+
+        return statistics_df
+
+    @cached_metric('workout_events')
+    def load_workout_events_data(self):
+        """
+        WorkoutEvents of every workout, such as pauses, laps and segments
+
+        :return: DataFrame of the workout's row label in load_workout_data ('workout'), event as a categorical,
+            timestamp and duration in minutes as float32, sorted by timestamp
+        """
+        events = self.raw_workout_tables()['events']
+        if not events['workout']:
+            raise IndexError('No workout events found')
+
+        events_df = pd.DataFrame({'workout': np.asarray(events['workout'], dtype=np.int32),
+                                  'event': strip_prefix(events['type'], 'HKWorkoutEventType'),
+                                  'timestamp': parse_timestamps(events['date'], self.timezone),
+                                  'duration': duration_minutes(events['duration'], events['durationUnit'])})
+        events_df.sort_values('timestamp', inplace=True)
+
+        return events_df
+
+    @cached_metric('workout_route')
+    def load_workout_route_data(self, workout):
+        """
+        Decode the route of one workout from its GPX file, which sits next to export.xml in the
+        export archive; routes are only read when asked for, one workout at a time
+
+        :param workout: row label of the workout in load_workout_data
+        :return: DataFrame of timestamp, latitude and longitude as float64 and elevation as float32
+        :raises IndexError: if the workout has no route, or its file is not next to the export
+        """
+        route = self.load_workout_data()['route'].get(int(workout))
+        export_dir = os.path.dirname(os.path.abspath(self.file_path))
+        route_path = os.path.normpath(os.path.join(export_dir, route.lstrip('/'))) if route else None
+        # the path comes from the export, so never follow it out of the export's directory
+        if route_path is None or os.path.commonpath([route_path, export_dir]) != export_dir or \
+                not os.path.isfile(route_path):
+            raise IndexError(f'No route found for workout {workout}')
+        try:
+            points = read_gpx_route(route_path)
+        except ET.ParseError:
+            raise IndexError(f'Unreadable route for workout {workout}')
+        if not points['time']:
+            raise IndexError(f'No route found for workout {workout}')
+
+        return pd.DataFrame({
+            'timestamp': pd.to_datetime(points['time'], utc=True, format='ISO8601').tz_convert(self.timezone),
+            'latitude': np.asarray(points['lat'], dtype=np.float64),
+            'longitude': np.asarray(points['lon'], dtype=np.float64),
+            'elevation': pd.to_numeric(pd.Series(points['ele'], dtype=object), errors='coerce').astype(np.float32),
+        })
+
+    def load_workout_routes(self, workouts):
+        """
+        Routes of several workouts as one columnar table, decoding only these workouts' files
+
+        :param workouts: row labels in load_workout_data
+        :return: the points of every route in the order of workouts, as load_workout_route_data returns them,
+            and int64 offsets: the points of workouts[i] are rows offsets[i]:offsets[i + 1], none without a route
+        :raises IndexError: if none of the workouts has a route
+        """
+        routes = []
+        for workout in workouts:
+            try:
+                routes.append(self.load_workout_route_data(workout))
+            except (IndexError, ValueError):
+                routes.append(None)
+        if all(route is None for route in routes):
+            raise IndexError('No routes found')
+        offsets = np.zeros(len(routes) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(route) if route is not None else 0 for route in routes])
+        return pd.concat([route for route in routes if route is not None], ignore_index=True), offsets
+
+    @cached_metric('hourly')
+    def load_hourly_rollup(self, metric):
+        """
+        Date x hour sums of a metric, built once per export and cached like the metrics
+
+        :param metric: name from ROLLUP_COLUMNS
+        :return: see hourly_rollup
+        """
+        df = getattr(self, METRIC_LOADERS[metric])()
+        return hourly_rollup(df, ROLLUP_COLUMNS[metric])
+
+    def load_metrics(self, metrics=None):
+        """
+        Load several metrics from one pass over the records.
+
+        :param metrics: names from METRIC_LOADERS, defaults to all of them
+        :return: dict of metric name -> DataFrame; metrics without records are left out
+        """
+        data = {}
+        for metric in metrics or METRIC_LOADERS:
+            try:
+                data[metric] = getattr(self, METRIC_LOADERS[metric])()
+            except (IndexError, ValueError):
+                continue
+        return data
+
+    def load_Personal_data(self):
+        if self.cache is not None and self.cache.get('personal_data') is not None:
+            return self.cache.get('personal_data')
+        self.ensure_ingested()
+        return personal_data(self.me_element.attrib, self.first_record('HKQuantityTypeIdentifierHeight'),
+                             self.first_record('HKQuantityTypeIdentifierBodyMass'))
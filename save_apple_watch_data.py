@@ -1,9 +1,18 @@
 import os
+import io
+import sqlite3
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from datetime import datetime
 import logging
+import numpy as np
 import pandas as pd
 
 from read_apple_watch_data import *
+from cache_apple_watch_data import atomic_path
+from stage_timing import timings
 # SHOW_ saveS = True
 
 # create logger object
@@ -13,147 +22,386 @@ logger = logging.getLogger(__name__)
 # TODO: add requirements text file for python libraries needed and respective versions
 # TODO: Add start and end dates to  save (sub)titles
 
+# rows formatted and written per step when streaming a ZIP or filling SQLite, bounding the memory of one step
+ZIP_CHUNK_ROWS = 50000
 
-def save_heart_rate(apple_watch):
+
+def local_datetime_chars(timestamps):
+    """
+    Local wall-clock 'YYYY-MM-DDTHH:MM:SS' of tz-aware timestamps as an (n, 19) array of characters,
+    formatted by numpy in one pass instead of one strftime call per row
+    """
+    local = timestamps.dt.tz_localize(None).to_numpy().astype('datetime64[s]')
+    return local.astype('U19').view('U1').reshape(-1, 19)
+
+
+def join_chars(chars):
+    return np.ascontiguousarray(chars).view(f'U{chars.shape[1]}').ravel()
+
+
+def format_dates(timestamps):
+    """
+    :return: '%m/%d/%y' strings of tz-aware timestamps
+    """
+    chars = local_datetime_chars(timestamps)
+    slash = np.full((len(chars), 1), '/')
+    return join_chars(np.hstack([chars[:, 5:7], slash, chars[:, 8:10], slash, chars[:, 2:4]]))
+
+
+def format_times(timestamps):
+    """
+    :return: '%H:%M:%S' strings of tz-aware timestamps
+    """
+    return join_chars(local_datetime_chars(timestamps)[:, 11:19])
+
+
+def format_timestamps(timestamps):
+    """
+    :return: strings of tz-aware timestamps as to_csv writes them, e.g. '2023-01-02 13:00:00-06:00'
+    """
+    nanoseconds = timestamps.dt.tz_localize(None).to_numpy().astype(np.int64)
+    if (nanoseconds % 10**9 != 0).any():
+        # sub-second timestamps are rare enough to leave to pandas
+        return timestamps.astype(str).to_numpy()
+    chars = local_datetime_chars(timestamps)
+    chars[:, 10] = ' '
+    # offsets take few distinct values, so format each once
+    utc = timestamps.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy().astype(np.int64)
+    offsets, inverse = np.unique((nanoseconds - utc) // 10**9 // 60, return_inverse=True)
+    suffixes = np.array([f"{'-' if minutes < 0 else '+'}{abs(minutes) // 60:02d}:{abs(minutes) % 60:02d}"
+                         for minutes in offsets])
+    strings = np.char.add(join_chars(chars), suffixes[inverse])
+    strings[timestamps.isna().to_numpy()] = ''
+    return strings
+
+
+def csv_table(df):
+    """
+    Copy of a table with its timestamp columns formatted, which to_csv would otherwise do row by row
+    """
+    df = df.copy(deep=False)
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.DatetimeTZDtype):
+            df[column] = format_timestamps(df[column])
+    return df
+
+
+def heart_rate_table(apple_watch):
 
     logger.info('Loading and  saveting Heart Rate Data')
     df = apple_watch.load_heart_rate_data()
  
-    df['date'] = list(map(lambda dt: dt.strftime('%m/%d/%y'), df['start_timestamp']))
-    df['time'] = list(map(lambda d: d.time(), df['start_timestamp']))
-    df.to_csv('download/heart_rate.csv', index=False)
+    df['date'] = format_dates(df['start_timestamp'])
+    df['time'] = format_times(df['start_timestamp'])
+    return df
 
-def save_heart_rate_variability(apple_watch):
+def heart_rate_variability_table(apple_watch):
 
     logger.info('Loading and  saveting Heart Rate Variability Data')
     df = apple_watch.load_heart_rate_variability_data()
  
-    df['date'] = list(map(lambda d: d.strftime('%m/%d/%y'), df['start_timestamp']))
-    df['time'] = list(map(lambda d: d.strftime('%H:%M:%S'), df['start_timestamp']))
-    dates = list(df['date'].unique())
+    df['date'] = format_dates(df['start_timestamp'])
+    df['time'] = format_times(df['start_timestamp'])
+    return df
+
+def heart_rate_beats_table(apple_watch):
+
+    logger.info('Loading and  saveting Instantaneous Heart Rate Data')
+    df = apple_watch.load_heart_rate_beats_data()
 
-    # remove instantaneous data, bokeh doesn't not like dictionary format
-    del df['instantaneous_bpm']
-    df.to_csv('download/heart_rate_variability.csv', index=False)
+    # record is the row of the HRV measurement in heart_rate_variability.csv, which keeps no index
+    hrv_rows = apple_watch.load_heart_rate_variability_data().index
+    df['record'] = pd.Index(hrv_rows).get_indexer(df['record'])
+    return df
 
-def save_resting_heart_rate(apple_watch):
+def resting_heart_rate_table(apple_watch):
 
     logger.info('Loading and  saveting Resting Heart Rate Data')
     df = apple_watch.load_resting_heart_rate_data()
  
-    df['date'] = list(map(lambda dt: dt.strftime('%m/%d/%y'), df['start_timestamp']))
-    # save dataframe
-    df.to_csv('download/resting_heart_rate.csv', index=False)
+    df['date'] = format_dates(df['start_timestamp'])
+    return df
 
-def save_walking_heart_rate(apple_watch):
+def walking_heart_rate_table(apple_watch):
     logger.info('Loading and  saveting Walking/Running Data')
     df = apple_watch.load_walking_heart_rate_data()
  
-    df['date'] = list(map(lambda dt: dt.strftime('%m/%d/%y'), df['start_timestamp']))
+    df['date'] = format_dates(df['start_timestamp'])
+    return df
 
-    # save dataframe
-    df.to_csv('download/walking_heart_rate.csv', index=False)
-
-def save_distance(apple_watch):
+def distance_table(apple_watch):
 
     logger.info('Loading and  saveting Distance Walked/Ran Data')
     df = apple_watch.load_distance_data()
  
-    df['date'] = list(map(lambda d: d.strftime('%m/%d/%y'), df['start_timestamp']))
-    df['hour'] = list(map(lambda d: int(d.strftime('%H')), df['start_timestamp']))
-
-    # group by hour and date and calculate sum of steps
-    hourly_distance = df.groupby(['hour', 'date'])['distance_walk_run'].agg(['sum']).reset_index()
-    hourly_distance.rename(columns={'sum': 'distance'}, inplace=True)
-
-    # resort by date
-    hourly_distance['datetime'] = pd.to_datetime(hourly_distance['date'])
-    hourly_distance.sort_values(by=['datetime'], inplace=True)
-    dates = hourly_distance['date'].unique()
+    df['date'] = format_dates(df['start_timestamp'])
+    df['hour'] = df['start_timestamp'].dt.hour
+    return df
 
-
-    # save dataframe
-    df.to_csv('download/distance_walked_ran.csv', index=False)
-
-def save_basal_energy(apple_watch):
+def basal_energy_table(apple_watch):
 
     logger.info('Generating Basal Energy  save')
 
     df = apple_watch.load_basal_energy_data()
  
-    df['date'] = list(map(lambda d: d.strftime('%m/%d/%y'), df['start_timestamp']))
-    df['hour'] = list(map(lambda d: int(d.strftime('%H')), df['start_timestamp']))
-
-    # group by hour and date and calculate sum of steps
-    basal_energy = df.groupby(['hour', 'date'])['energy_burned'].agg(['sum']).reset_index()
-    basal_energy.rename(columns={'sum': 'energy_burned'}, inplace=True)
+    df['date'] = format_dates(df['start_timestamp'])
+    df['hour'] = df['start_timestamp'].dt.hour
+    return df
 
-    # resort date
-    basal_energy['datetime'] = pd.to_datetime(basal_energy['date'])
-    basal_energy.sort_values(by=['datetime'], inplace=True)
-
-    # save dataframe
-    df.to_csv('download/basal_energy.csv', index=False)
-
-def save_stand_hour(apple_watch):
+def stand_hour_table(apple_watch):
     logger.info('Loading and Generating Stand Hour Heat Map')
 
     df = apple_watch.load_stand_hour_data()
  
-    df['date'] = list(map(lambda d: d.strftime('%m/%d/%y'), df['start_timestamp']))
-    df['hour'] = list(map(lambda d: int(d.strftime('%H')), df['start_timestamp']))
-    df['stand_hour'] = list(map(lambda label: 1 if label == 'Stood' else 0, df['stand_hour']))
-    # save dataframe
-    df.to_csv('download/stand_hour.csv', index=False)
+    df['date'] = format_dates(df['start_timestamp'])
+    df['hour'] = df['start_timestamp'].dt.hour
+    df['stand_hour'] = (df['stand_hour'] == 'Stood').astype(np.int64)
+    return df
 
-def save_steps(apple_watch):
+def steps_table(apple_watch):
     logger.info('Loading and Generating Steps Heat Map')
     df = apple_watch.load_step_data()
  
-    df['date'] = list(map(lambda d: d.strftime('%m/%d/%y'), df['start_timestamp']))
-    df['hour'] = list(map(lambda d: int(d.strftime('%H')), df['start_timestamp']))
-
-    # save data frame
-    df.to_csv('download/step_counts.csv', index=False)
-
-def tocsv(apple_watch):
-
-    try:
-         save_heart_rate(apple_watch)
-    except (IndexError, ValueError):
-        logger.warning('Missing heart rate data!')
-
-    try:
-         save_heart_rate_variability(apple_watch)
-    except (IndexError, ValueError):
-        logger.warning('Missing heart rate variability data!')
-
-    try:
-         save_resting_heart_rate(apple_watch)
-    except (IndexError, ValueError):
-        logger.warning('Missing resting heart rate data!')
-
-    try:
-         save_walking_heart_rate(apple_watch)
-    except (IndexError, ValueError):
-        logger.warning('Missing walking heart rate data!')
-
-    try:
-         save_distance(apple_watch)
-    except (IndexError, ValueError):
-        logger.warning('Missing distance walked data!')
-
-    try:
-         save_basal_energy(apple_watch)
-    except (IndexError, ValueError):
-        logger.warning('Missing basal energy data!')
-
-    try:
-         save_stand_hour(apple_watch)
-    except (IndexError, ValueError):
-        logger.warning('Missing stand hour data!')
-
+    df['date'] = format_dates(df['start_timestamp'])
+    df['hour'] = df['start_timestamp'].dt.hour
+    return df
+
+def sleep_table(apple_watch):
+    logger.info('Loading and Generating Sleep Analysis Data')
+    df = apple_watch.load_sleep_data()
+
+    df['date'] = format_dates(df['start_timestamp'])
+    return df
+
+def sleep_nights_table(apple_watch):
+    logger.info('Loading and Generating Nightly Sleep Data')
+    # hours per night, keyed by the date each night ends on
+    return apple_watch.load_sleep_nights_data().reset_index()
+
+def workouts_table(apple_watch):
+    logger.info('Loading and Generating Workouts Data')
+    df = apple_watch.load_workout_data()
+
+    df['date'] = format_dates(df['start_timestamp'])
+    return df
+
+def workout_rows(apple_watch, df):
+    # workout is the row of the parent workout in workouts.csv, which keeps no index
+    rows = apple_watch.load_workout_data().index
+    df['workout'] = pd.Index(rows).get_indexer(df['workout'])
+    return df
+
+def workout_statistics_table(apple_watch):
+    logger.info('Loading and Generating Workout Statistics Data')
+    return workout_rows(apple_watch, apple_watch.load_workout_statistics_data())
+
+def workout_events_table(apple_watch):
+    logger.info('Loading and Generating Workout Events Data')
+    return workout_rows(apple_watch, apple_watch.load_workout_events_data())
+
+# file name -> (function building its table, what is missing when the export has no records for it)
+CSV_EXPORTS = {
+    'heart_rate.csv': (heart_rate_table, 'heart rate'),
+    'heart_rate_variability.csv': (heart_rate_variability_table, 'heart rate variability'),
+    'heart_rate_beats.csv': (heart_rate_beats_table, 'instantaneous heart rate'),
+    'resting_heart_rate.csv': (resting_heart_rate_table, 'resting heart rate'),
+    'walking_heart_rate.csv': (walking_heart_rate_table, 'walking heart rate'),
+    'distance_walked_ran.csv': (distance_table, 'distance walked'),
+    'basal_energy.csv': (basal_energy_table, 'basal energy'),
+    'stand_hour.csv': (stand_hour_table, 'stand hour'),
+    'step_counts.csv': (steps_table, 'step count'),
+    'sleep.csv': (sleep_table, 'sleep analysis'),
+    'sleep_nights.csv': (sleep_nights_table, 'nightly sleep'),
+    'workouts.csv': (workouts_table, 'workout'),
+    'workout_statistics.csv': (workout_statistics_table, 'workout statistics'),
+    'workout_events.csv': (workout_events_table, 'workout event'),
+}
+
+def save_csv(apple_watch, filename, directory='download'):
+    """
+    Write one CSV_EXPORTS table to directory
+
+    :raises IndexError: if the export has no records for it
+    """
+    build, _ = CSV_EXPORTS[filename]
+    write_table(build(apple_watch), os.path.join(directory, filename), 'csv')
+
+def save_heart_rate(apple_watch, directory='download'):
+    save_csv(apple_watch, 'heart_rate.csv', directory)
+
+def save_heart_rate_variability(apple_watch, directory='download'):
+    save_csv(apple_watch, 'heart_rate_variability.csv', directory)
+
+def save_resting_heart_rate(apple_watch, directory='download'):
+    save_csv(apple_watch, 'resting_heart_rate.csv', directory)
+
+def save_walking_heart_rate(apple_watch, directory='download'):
+    save_csv(apple_watch, 'walking_heart_rate.csv', directory)
+
+def save_distance(apple_watch, directory='download'):
+    save_csv(apple_watch, 'distance_walked_ran.csv', directory)
+
+def save_basal_energy(apple_watch, directory='download'):
+    save_csv(apple_watch, 'basal_energy.csv', directory)
+
+def save_stand_hour(apple_watch, directory='download'):
+    save_csv(apple_watch, 'stand_hour.csv', directory)
+
+def save_steps(apple_watch, directory='download'):
+    save_csv(apple_watch, 'step_counts.csv', directory)
+
+# formats tocsv and stream_export_zip write; sqlite puts every table in one database
+EXPORT_FORMATS = ('csv', 'parquet', 'feather', 'sqlite')
+SQLITE_FILENAME = 'apple_watch.sqlite'
+# columns indexed in the SQLite tables, when present
+SQLITE_INDEX_COLUMNS = ('start_timestamp', 'timestamp', 'record', 'workout')
+
+def load_table(apple_watch, filename):
+    """
+    :return: the table of one CSV_EXPORTS file, or None if the export has no records for it
+    """
+    build, description = CSV_EXPORTS[filename]
     try:
-         save_steps(apple_watch)
+        with timings.span('export.build', table=table_name(filename)) as span:
+            df = build(apple_watch)
+            span.items = len(df)
+        return df
     except (IndexError, ValueError):
-        logger.warning('Missing step count data!')
\ No newline at end of file
+        logger.warning(f'Missing {description} data!')
+        return None
+
+def table_name(filename):
+    return os.path.splitext(filename)[0]
+
+def write_table(df, path, export_format):
+    """
+    Write one table as csv, or as zstd-compressed parquet or feather keeping its column types
+    """
+    with timings.span('export.write', format=export_format) as span:
+        span.items = len(df)
+        write_table_format(df, path, export_format)
+
+def write_table_format(df, path, export_format):
+    if export_format == 'csv':
+        csv_table(df).to_csv(path, index=False)
+    elif export_format == 'parquet':
+        df.to_parquet(path, compression='zstd', index=False)
+    elif export_format == 'feather':
+        df.reset_index(drop=True).to_feather(path, compression='zstd')
+    else:
+        raise ValueError(f'Unknown export format {export_format}')
+
+def save_table(apple_watch, filename, directory, formats):
+    """
+    :return: the table, for the formats written after all files
+    """
+    df = load_table(apple_watch, filename)
+    if df is not None:
+        for export_format in formats:
+            if export_format != 'sqlite':
+                write_table(df, os.path.join(directory, f'{table_name(filename)}.{export_format}'), export_format)
+    return df
+
+def write_sqlite(tables, path):
+    """
+    Write tables to one SQLite database, indexing their time and link columns
+
+    :param tables: dict of table name -> DataFrame
+    :param path: database file, replaced once complete
+    """
+    with timings.span('export.write', format='sqlite') as span, atomic_path(path) as tmp_path, \
+            closing(sqlite3.connect(tmp_path)) as connection:
+        span.items = sum(len(df) for df in tables.values())
+        for name, df in tables.items():
+            csv_table(df).to_sql(name, connection, index=False, chunksize=ZIP_CHUNK_ROWS)
+            for column in SQLITE_INDEX_COLUMNS:
+                if column in df:
+                    connection.execute(f'CREATE INDEX "ix_{name}_{column}" ON "{name}" ("{column}")')
+        connection.commit()
+
+def tocsv(apple_watch, directory='download', workers=4, formats=('csv',)):
+    """
+    Write every CSV_EXPORTS table to a directory in each requested format, several tables at a time
+
+    :param directory: target directory
+    :param workers: tables written in parallel
+    :param formats: any of EXPORT_FORMATS
+    """
+    os.makedirs(directory, exist_ok=True)
+    with timings.span('tocsv', formats=','.join(formats)):
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {filename: pool.submit(save_table, apple_watch, filename, directory, formats)
+                       for filename in CSV_EXPORTS}
+            tables = {table_name(filename): future.result() for filename, future in futures.items()}
+        if 'sqlite' in formats:
+            write_sqlite({name: df for name, df in tables.items() if df is not None},
+                         os.path.join(directory, SQLITE_FILENAME))
+
+class ZipStream(io.RawIOBase):
+    """
+    Unseekable sink for zipfile, collecting the bytes written since they were last taken
+    """
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def stream_export_zip(apple_watch, export_format='csv'):
+    """
+    Generate a ZIP of every CSV_EXPORTS table in one format piece by piece, so it can be sent
+    while it is being built
+
+    CSV is written in ZIP_CHUNK_ROWS steps and never held whole. Parquet and feather files are
+    built in memory one table at a time and stored uncompressed, being compressed already.
+    SQLite needs a file, so the database is built in a temporary directory first.
+
+    :param export_format: one of EXPORT_FORMATS
+    :return: iterator of bytes
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown export format {export_format}')
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        if export_format == 'sqlite':
+            with tempfile.TemporaryDirectory() as directory:
+                tables = {table_name(filename): load_table(apple_watch, filename) for filename in CSV_EXPORTS}
+                path = os.path.join(directory, SQLITE_FILENAME)
+                write_sqlite({name: df for name, df in tables.items() if df is not None}, path)
+                del tables
+                with open(path, 'rb') as database, archive.open(SQLITE_FILENAME, 'w') as entry:
+                    for chunk in iter(lambda: database.read(1 << 20), b''):
+                        entry.write(chunk)
+                        yield stream.take()
+            filenames = ()
+        else:
+            filenames = CSV_EXPORTS
+
+        for filename in filenames:
+            df = load_table(apple_watch, filename)
+            if df is None:
+                continue
+            name = f'{table_name(filename)}.{export_format}'
+            if export_format == 'csv':
+                df = csv_table(df)
+                with archive.open(name, 'w') as entry:
+                    for start in range(0, len(df), ZIP_CHUNK_ROWS):
+                        df.iloc[start:start + ZIP_CHUNK_ROWS].to_csv(entry, index=False, header=start == 0)
+                        yield stream.take()
+            else:
+                buffer = io.BytesIO()
+                write_table(df, buffer, export_format)
+                archive.writestr(name, buffer.getvalue(), compress_type=zipfile.ZIP_STORED)
+                yield stream.take()
+    # the central directory, written when the archive closes
+    yield stream.take()
\ No newline at end of file
@@ -0,0 +1,172 @@
+'''
+Timing spans around the pipeline's stages, exported in the Prometheus text format
+and optionally logged as one JSON line per span
+'''
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the stage duration histogram buckets, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+METRIC_PREFIX = 'apple_watch'
+
+
+def rss_bytes():
+    """
+    Resident memory of this process, or None where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Span:
+    """
+    One timed stage; set items to the number of records or rows it handled
+    """
+    def __init__(self, stage, labels):
+        self.stage = stage
+        self.labels = labels
+        self.items = None
+
+
+class StageClock:
+    """
+    Times consecutive steps of one piece of work, each lap starting where the previous one ended,
+    so steps can be timed without wrapping them in blocks
+    """
+    def __init__(self, timings, **labels):
+        self.timings = timings
+        self.labels = labels
+        self.restart()
+
+    def restart(self, **labels):
+        """
+        Start timing from now, e.g. at the start of a new section, replacing the clock's labels if given
+        """
+        if labels:
+            self.labels = labels
+        self.started = time.perf_counter()
+        self.rss = rss_bytes()
+
+    def lap(self, stage, items=None, **labels):
+        started, rss = self.started, self.rss
+        self.restart()
+        rss_delta = self.rss - rss if self.rss is not None and rss is not None else None
+        self.timings.observe(stage, self.started - started, items, rss_delta, **{**self.labels, **labels})
+
+
+class StageTimings:
+    """
+    Histogram of durations, item counts and the last memory delta per stage and label set.
+
+    Labels become Prometheus labels, so callers keep their values to a small, fixed set.
+    """
+    def __init__(self, buckets=DURATION_BUCKETS, log_stages=False):
+        self.buckets = buckets
+        self.log_stages = log_stages
+        self.stages = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds, items=None, rss_delta=None, **labels):
+        key = (stage, tuple(sorted(labels.items())))
+        with self.lock:
+            entry = self.stages.get(key)
+            if entry is None:
+                entry = self.stages[key] = {'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0.0,
+                                            'items': 0, 'rss_delta': None}
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    entry['buckets'][i] += 1
+            entry['count'] += 1
+            entry['sum'] += seconds
+            entry['items'] += items or 0
+            if rss_delta is not None:
+                entry['rss_delta'] = rss_delta
+        if self.log_stages:
+            logger.info(json.dumps({'stage': stage, **labels, 'seconds': round(seconds, 6), 'items': items,
+                                    'rss_delta_bytes': rss_delta}))
+
+    @contextmanager
+    def span(self, stage, **labels):
+        """
+        Time the enclosed block as one stage; the span is recorded even if the block raises
+        """
+        span = Span(stage, labels)
+        rss = rss_bytes()
+        started = time.perf_counter()
+        try:
+            yield span
+        finally:
+            seconds = time.perf_counter() - started
+            after = rss_bytes()
+            rss_delta = after - rss if after is not None and rss is not None else None
+            self.observe(stage, seconds, span.items, rss_delta, **span.labels)
+
+    def clock(self, **labels):
+        return StageClock(self, **labels)
+
+    def add_collector(self, collect):
+        """
+        Register a callable returning (name, type, help, value) tuples, rendered with the stage metrics,
+        for values owned elsewhere such as cache sizes
+        """
+        self.collectors.append(collect)
+
+    def render(self):
+        """
+        :return: every metric in the Prometheus text exposition format
+        """
+        with self.lock:
+            stages = {key: dict(entry, buckets=list(entry['buckets'])) for key, entry in self.stages.items()}
+
+        seconds = f'{METRIC_PREFIX}_stage_seconds'
+        items = f'{METRIC_PREFIX}_stage_items_total'
+        rss_delta = f'{METRIC_PREFIX}_stage_rss_delta_bytes'
+        lines = [f'# HELP {seconds} Time spent in each pipeline stage.', f'# TYPE {seconds} histogram']
+        for (stage, labels), entry in sorted(stages.items()):
+            labels = (('stage', stage),) + labels
+            for bound, count in zip(self.buckets, entry['buckets']):
+                lines.append(f'{seconds}_bucket{format_labels(labels, [("le", bound)])} {count}')
+            lines.append(f'{seconds}_bucket{format_labels(labels, [("le", "+Inf")])} {entry["count"]}')
+            lines.append(f'{seconds}_sum{format_labels(labels)} {entry["sum"]:.6f}')
+            lines.append(f'{seconds}_count{format_labels(labels)} {entry["count"]}')
+        lines += [f'# HELP {items} Records or rows handled by each pipeline stage.', f'# TYPE {items} counter']
+        for (stage, labels), entry in sorted(stages.items()):
+            lines.append(f'{items}{format_labels((("stage", stage),) + labels)} {entry["items"]}')
+        lines += [f'# HELP {rss_delta} Change in resident memory over the last run of each stage.',
+                  f'# TYPE {rss_delta} gauge']
+        for (stage, labels), entry in sorted(stages.items()):
+            if entry['rss_delta'] is not None:
+                lines.append(f'{rss_delta}{format_labels((("stage", stage),) + labels)} {entry["rss_delta"]}')
+
+        rss = rss_bytes()
+        if rss is not None:
+            name = f'{METRIC_PREFIX}_process_resident_memory_bytes'
+            lines += [f'# HELP {name} Resident memory of the process.', f'# TYPE {name} gauge', f'{name} {rss}']
+        for collect in self.collectors:
+            for name, metric_type, help_text, value in collect():
+                name = f'{METRIC_PREFIX}_{name}'
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+# process-level timings shared by the data, export and app modules;
+# STAGE_LOG=1 also logs every span as a JSON line
+timings = StageTimings(log_stages=os.environ.get('STAGE_LOG') == '1')
@@ -0,0 +1,56 @@
+'''
+Synthetic exports shared by the tests, written once per session
+'''
+import os
+import sys
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+from generate_export import generate_export
+
+# about 73 days from New Year, so the exports span the change to daylight saving time
+RECORDS = 50000
+# the older export of the same user holds what was created before this
+OLDER_EXPORT_DATE = datetime(2021, 2, 1, tzinfo=timezone.utc)
+
+
+def created_before(element, moment):
+    stamp = element.attrib.get('creationDate')
+    return stamp is None or datetime.strptime(stamp, '%Y-%m-%d %H:%M:%S %z') < moment
+
+
+def write_older_export(file_path, older_path, moment):
+    """
+    Write the export the same user would have got at an earlier moment: the records and workouts
+    created before it, in their original order
+    """
+    tree = ET.parse(file_path)
+    root = tree.getroot()
+    for element in [element for element in root if not created_before(element, moment)]:
+        root.remove(element)
+    tree.write(older_path, encoding='UTF-8', xml_declaration=True)
+
+
+@pytest.fixture(scope='session')
+def export_path(tmp_path_factory):
+    file_path = str(tmp_path_factory.mktemp('export') / 'export.xml')
+    generate_export(file_path, RECORDS, routes=True)
+    return file_path
+
+
+@pytest.fixture(scope='session')
+def older_export_path(tmp_path_factory, export_path):
+    older_path = str(tmp_path_factory.mktemp('older_export') / 'export.xml')
+    write_older_export(export_path, older_path, OLDER_EXPORT_DATE)
+    return older_path
+
+
+@pytest.fixture(scope='session')
+def export_metrics(export_path):
+    from read_apple_watch_data import AppleWatchData
+    return AppleWatchData(export_path, 'Apple Watch', streaming=True).load_metrics()
@@ -0,0 +1,103 @@
+'''
+Parquet caches: incremental ingest of a user's newer exports
+'''
+from datetime import timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import pandas as pd
+import pytest
+
+import cache_apple_watch_data
+from cache_apple_watch_data import ParquetCache
+from read_apple_watch_data import AppleWatchData, PARENT_METRICS, ROLLUP_COLUMNS
+
+SOURCE = 'Apple Watch'
+
+
+def comparable(data):
+    """
+    Metrics in a form that does not depend on how rows were labelled: an incremental ingest labels
+    appended rows after the cached ones, a full ingest in document order
+    """
+    frames = {}
+    for metric, df in data.items():
+        df = df.copy()
+        if metric in PARENT_METRICS:
+            parent, column = PARENT_METRICS[metric]
+            df[column] = data[parent]['start_timestamp'].reindex(df[column]).to_numpy()
+        for column in df.columns:
+            if isinstance(df[column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype(object)
+        frames[metric] = df.sort_values(list(df.columns), kind='stable').reset_index(drop=True)
+    return frames
+
+
+def assert_same_metrics(data, expected):
+    assert data.keys() == expected.keys()
+    data, expected = comparable(data), comparable(expected)
+    for metric in expected:
+        pd.testing.assert_frame_equal(data[metric], expected[metric], obj=metric)
+
+
+def open_incremental(file_path, cache_dir):
+    return AppleWatchData(file_path, SOURCE, cache_dir=cache_dir, incremental=True)
+
+
+def test_cache_hit_after_restart(tmp_path, monkeypatch, export_path, export_metrics):
+    personal_data = AppleWatchData(export_path, SOURCE, cache_dir=tmp_path).load_Personal_data()
+
+    # a new process has hashed nothing yet, and must not parse the XML again
+    monkeypatch.setattr(cache_apple_watch_data, '_content_hashes', {})
+
+    def ingest(self, checkpoint=None):
+        raise AssertionError('the export was parsed again')
+    monkeypatch.setattr(AppleWatchData, 'ingest', ingest)
+
+    watch_data = AppleWatchData(export_path, SOURCE, cache_dir=tmp_path)
+    assert watch_data.timezone == ZoneInfo('America/Chicago')
+    assert watch_data.load_Personal_data() == personal_data
+    data = watch_data.load_metrics()
+    assert data.keys() == export_metrics.keys()
+    for metric in export_metrics:
+        pd.testing.assert_frame_equal(data[metric], export_metrics[metric], obj=metric)
+
+
+def test_incremental_ingest_matches_full(tmp_path, older_export_path, export_path, export_metrics):
+    open_incremental(older_export_path, tmp_path)
+    data = open_incremental(export_path, tmp_path).load_metrics()
+    assert_same_metrics(data, export_metrics)
+
+
+def test_reopening_older_export_appends_nothing(tmp_path, older_export_path, export_path, export_metrics):
+    for file_path in (older_export_path, export_path, older_export_path, export_path):
+        watch_data = open_incremental(file_path, tmp_path)
+    assert_same_metrics(watch_data.load_metrics(), export_metrics)
+
+
+def test_interrupted_persist_is_not_appended_twice(tmp_path, monkeypatch, older_export_path, export_path,
+                                                   export_metrics):
+    open_incremental(older_export_path, tmp_path)
+
+    def interrupt(self, values):
+        raise RuntimeError('interrupted')
+    # every metric is appended, but the manifest is never committed
+    with monkeypatch.context() as patch:
+        patch.setattr(ParquetCache, 'update', interrupt)
+        with pytest.raises(RuntimeError):
+            open_incremental(export_path, tmp_path)
+
+    data = open_incremental(export_path, tmp_path).load_metrics()
+    assert_same_metrics(data, export_metrics)
+
+
+def test_incremental_ingest_infers_the_zone_again(tmp_path, older_export_path, export_path):
+    # the older export ends before the change to daylight saving time, so it only shows one offset
+    assert open_incremental(older_export_path, tmp_path).timezone == timezone(timedelta(hours=-6))
+
+    watch_data = open_incremental(export_path, tmp_path)
+    full = AppleWatchData(export_path, SOURCE, streaming=True)
+    assert watch_data.timezone == full.timezone == ZoneInfo('America/Chicago')
+    for metric in ROLLUP_COLUMNS:
+        pd.testing.assert_frame_equal(watch_data.load_hourly_rollup(metric), full.load_hourly_rollup(metric),
+                                      check_freq=False)
+    pd.testing.assert_frame_equal(watch_data.load_sleep_nights_data(), full.load_sleep_nights_data())
@@ -0,0 +1,37 @@
+'''
+Tree, streaming and parallel ingest of the same export
+'''
+import pandas as pd
+
+import read_apple_watch_data
+from read_apple_watch_data import AppleWatchData
+
+SOURCE = 'Apple Watch'
+
+
+def assert_same_metrics(data, expected):
+    assert data.keys() == expected.keys()
+    for metric in expected:
+        pd.testing.assert_frame_equal(data[metric], expected[metric], obj=metric)
+
+
+def test_tree_ingest_matches_streaming(export_path, export_metrics):
+    watch_data = AppleWatchData(export_path, SOURCE)
+    assert_same_metrics(watch_data.load_metrics(), export_metrics)
+    assert watch_data.load_Personal_data() == AppleWatchData(export_path, SOURCE, streaming=True).load_Personal_data()
+
+
+def test_parallel_ingest_matches_streaming(monkeypatch, export_path, export_metrics):
+    # the test export is far below the size worth splitting
+    monkeypatch.setattr(read_apple_watch_data, 'PARALLEL_MIN_BYTES', 0)
+    watch_data = AppleWatchData(export_path, SOURCE, workers=2)
+    assert watch_data.parallel()
+    assert_same_metrics(watch_data.load_metrics(), export_metrics)
+
+
+def test_loaders_keep_local_wall_clock_times_across_daylight_saving(export_path):
+    watch_data = AppleWatchData(export_path, SOURCE, streaming=True)
+    start_dates = watch_data.raw_record_columns('HKQuantityTypeIdentifierStepCount')['startDate']
+    local = watch_data.load_step_data()['start_timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S')
+    assert sorted(local) == sorted(date[:19] for date in start_dates)
+    assert {date[20:] for date in start_dates} == {'-0600', '-0500'}
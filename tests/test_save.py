@@ -0,0 +1,86 @@
+'''
+Exports written by tocsv and stream_export_zip, read back
+'''
+import io
+import os
+import sqlite3
+import zipfile
+
+import pandas as pd
+import pytest
+
+from read_apple_watch_data import AppleWatchData
+from save_apple_watch_data import (CSV_EXPORTS, SQLITE_FILENAME, csv_table, load_table, stream_export_zip, table_name,
+                                   tocsv)
+
+
+@pytest.fixture(scope='module')
+def apple_watch(export_path):
+    return AppleWatchData(export_path, 'Apple Watch', streaming=True)
+
+
+@pytest.fixture(scope='module')
+def tables(apple_watch):
+    tables = {table_name(filename): load_table(apple_watch, filename) for filename in CSV_EXPORTS}
+    return {name: df for name, df in tables.items() if df is not None}
+
+
+@pytest.fixture(scope='module')
+def export_dir(tmp_path_factory, apple_watch):
+    directory = str(tmp_path_factory.mktemp('download'))
+    tocsv(apple_watch, directory, formats=('csv', 'parquet', 'feather', 'sqlite'))
+    return directory
+
+
+def in_zones_of(df, like):
+    """
+    :return: df with its timestamp columns in the time zone objects of like's, which pyarrow reads back as its own
+    """
+    df = df.copy()
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.DatetimeTZDtype):
+            df[column] = df[column].dt.tz_convert(like[column].dt.tz)
+    return df
+
+
+def test_every_table_is_exported(tables):
+    assert set(tables) == {table_name(filename) for filename in CSV_EXPORTS}
+
+
+@pytest.mark.parametrize('export_format, read', [('parquet', pd.read_parquet), ('feather', pd.read_feather)])
+def test_typed_formats_round_trip(export_dir, tables, export_format, read):
+    for name, df in tables.items():
+        stored = read(os.path.join(export_dir, f'{name}.{export_format}'))
+        pd.testing.assert_frame_equal(in_zones_of(stored, df), df.reset_index(drop=True), obj=name)
+
+
+def test_csv_matches_pandas(export_dir, tables):
+    # timestamps are formatted in bulk, and must read back as to_csv's own formatting does
+    for name, df in tables.items():
+        pd.testing.assert_frame_equal(pd.read_csv(os.path.join(export_dir, f'{name}.csv')),
+                                      pd.read_csv(io.StringIO(df.to_csv(index=False))), obj=name)
+
+
+def test_sqlite_holds_the_csv_tables(export_dir, tables):
+    with sqlite3.connect(os.path.join(export_dir, SQLITE_FILENAME)) as connection:
+        for name, df in tables.items():
+            # SQLite keeps text, integers and doubles: timestamps as the CSV writes them, categories as labels
+            expected = csv_table(df).reset_index(drop=True)
+            dates = [column for column in expected.columns if pd.api.types.is_datetime64_dtype(expected[column])]
+            stored = pd.read_sql(f'SELECT * FROM "{name}"', connection, parse_dates=dates)
+            for column in expected.columns:
+                if isinstance(expected[column].dtype, pd.CategoricalDtype):
+                    expected[column] = expected[column].astype(object)
+            pd.testing.assert_frame_equal(stored, expected, check_dtype=False, obj=name)
+
+
+@pytest.mark.parametrize('export_format', ['csv', 'parquet', 'feather', 'sqlite'])
+def test_zip_holds_the_exported_files(export_dir, apple_watch, export_format):
+    with zipfile.ZipFile(io.BytesIO(b''.join(stream_export_zip(apple_watch, export_format)))) as archive:
+        if export_format == 'sqlite':
+            assert archive.namelist() == [SQLITE_FILENAME]
+            return
+        for entry in archive.namelist():
+            with open(os.path.join(export_dir, entry), 'rb') as f:
+                assert archive.read(entry) == f.read(), entry
+        assert len(archive.namelist()) == len(CSV_EXPORTS)